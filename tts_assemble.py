@@ -0,0 +1,492 @@
+# tts_assemble.py
+# Сборка озвученной книги из part_XXXX.mp3 в файлы глав или одну книгу — без перекодирования:
+# звуковые кадры MP3 частей склеиваются как есть (разбор заголовков кадров, без декодирования).
+# Поддерживает:
+# - источник частей: output_mp3 и запечатанные пачки, папки/архивы (zip, tar) на диске, пачки на B2
+# - главы из <книга>_chapters.json (или группы по N частей, если оглавления нет)
+# - метки глав ID3v2 CHAP/CTOC, кадр Xing/Info с таблицей перемотки
+# - индекс глав: cue-файл, ffmetadata для ffmpeg и, по желанию, M4B (MP3 внутри MP4, без перекодирования)
+#
+# Примеры:
+#   python tts_assemble.py                          # одна книга с главами из локальных частей (и B2, если настроен)
+#   python tts_assemble.py --by chapters            # отдельный файл на каждую главу
+#   python tts_assemble.py --source b2 --m4b        # только из пачек на B2, плюс M4B
+#   python tts_assemble.py --dir mp3_results.zip    # из скачанного артефакта
+
+import os
+import re
+import sys
+import time
+import shutil
+import bisect
+import zipfile
+import tarfile
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+import tts_batch
+
+PART_NAME_RE = re.compile(r"(?:^|/)part_(\d+)\.mp3$")
+
+# ================== ИСТОЧНИКИ ЧАСТЕЙ ==================
+
+class PartArchive:
+    """Части part_XXXX.mp3 внутри zip- или tar-архива пачки; читаются по одной, без распаковки всего архива."""
+    def __init__(self, path):
+        self.path = path
+        self.parts = {}
+        self._zip = self._tar = None
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            for name in self._zip.namelist():
+                m = PART_NAME_RE.search(name)
+                if m:
+                    self.parts[int(m.group(1))] = name
+        else:
+            self._tar = tarfile.open(path, "r:")
+            for member in self._tar.getmembers():
+                m = PART_NAME_RE.search(member.name)
+                if m and member.isfile():
+                    self.parts[int(m.group(1))] = member
+
+    def read(self, index):
+        if self._zip is not None:
+            return self._zip.read(self.parts[index])
+        return self._tar.extractfile(self.parts[index]).read()
+
+    def close(self):
+        (self._zip or self._tar).close()
+
+def default_local_paths():
+    return [tts_batch.OUTPUT_MP3_DIR] + tts_batch.BackgroundUploader.pending_sealed_dirs()
+
+class LocalPartSource:
+    """Части на диске: папки с part_XXXX.mp3 и архивы пачек (например, скачанный артефакт mp3_results.zip)."""
+    def __init__(self, paths):
+        self._parts = {}
+        self._archives = []
+        for path in paths:
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    m = PART_NAME_RE.search(name)
+                    if m:
+                        self._parts.setdefault(int(m.group(1)), os.path.join(path, name))
+            elif os.path.isfile(path):
+                archive = PartArchive(path)
+                self._archives.append(archive)
+                for index in archive.parts:
+                    self._parts.setdefault(index, archive)
+
+    def indices(self):
+        return set(self._parts)
+
+    def read(self, index):
+        entry = self._parts.get(index)
+        if entry is None:
+            return None
+        if isinstance(entry, PartArchive):
+            return entry.read(index)
+        with open(entry, "rb") as f:
+            return f.read()
+
+    def close(self):
+        for archive in self._archives:
+            archive.close()
+
+class B2PartSource:
+    """
+    Части из пачек, выгруженных на B2 (номер пачки каждой части записан в файле состояния).
+    Пачка скачивается во временную папку один раз, следующая нужная — заранее в фоне, пока
+    собирается текущая. Архив удаляется сразу после последней нужной из него части,
+    поэтому на диске одновременно лежат одна-две пачки, а не вся книга.
+    """
+    def __init__(self, progress_data, wanted, tmp_dir=None):
+        credentials = tts_batch.b2_credentials()
+        if credentials is None:
+            raise RuntimeError("B2 credentials or bucket id not set in environment variables.")
+        key_id, app_key, _ = credentials
+        self._batches = {b["batch"]: b for b in progress_data.get("batches", [])}
+        self._batch_of = {}
+        for key, entry in progress_data.get("fragments", {}).items():
+            if entry.get("status") == "ok" and entry.get("batch") in self._batches and int(key) in wanted:
+                self._batch_of[int(key)] = entry["batch"]
+        # Пачки в порядке первой нужной части и номер последней нужной из каждой
+        self._order = []
+        self._last_use = {}
+        for index in sorted(self._batch_of):
+            batch = self._batch_of[index]
+            if batch not in self._last_use:
+                self._order.append(batch)
+            self._last_use[batch] = index
+        self._auth = tts_batch.b2_authorize(key_id, app_key) if self._order else None
+        self._tmp_dir = tempfile.mkdtemp(prefix="tts_assemble_", dir=tmp_dir)
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="b2-download")
+        self._downloads = {}
+        self._open = {}
+        self._failed = set()
+
+    def indices(self):
+        return set(self._batch_of)
+
+    @property
+    def batch_count(self):
+        return len(self._order)
+
+    def read(self, index):
+        batch = self._batch_of.get(index)
+        if batch is None or batch in self._failed:
+            return None
+        try:
+            archive = self._archive(batch)
+            return archive.read(index) if index in archive.parts else None
+        except Exception as e:
+            self._failed.add(batch)
+            print(f"Пачка {batch} ({self._batches[batch].get('remote_name')}) недоступна: {e}")
+            return None
+        finally:
+            if self._last_use[batch] == index:
+                self._release(batch)
+
+    def _archive(self, batch):
+        if batch not in self._open:
+            position = self._order.index(batch)
+            for ahead in self._order[position:position + 2]:
+                if ahead not in self._downloads:
+                    self._downloads[ahead] = self._pool.submit(self._download, ahead)
+            self._open[batch] = PartArchive(self._downloads[batch].result())
+        return self._open[batch]
+
+    def _download(self, batch):
+        info = self._batches[batch]
+        ext = ".tar" if info.get("remote_name", "").endswith(".tar") else ".zip"
+        path = os.path.join(self._tmp_dir, f"batch_{batch:03}{ext}")
+        started = time.perf_counter()
+        with open(path, "wb") as f:
+            size = tts_batch.b2_download_file_by_id(self._auth, info["fileId"], f)
+        print(f"Пачка {batch} скачана с B2: {size / (1024 * 1024):.1f} МБ за {time.perf_counter() - started:.1f} с")
+        return path
+
+    def _release(self, batch):
+        archive = self._open.pop(batch, None)
+        if archive is not None:
+            archive.close()
+            os.remove(archive.path)
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        for batch in list(self._open):
+            self._release(batch)
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+# ================== ГЛАВЫ ==================
+
+def chapter_plan(manifest, indices, group_parts):
+    """
+    Главы [{"number", "title", "first_part", "last_part"}] в пределах имеющихся номеров частей:
+    из оглавления CHAPTERS_FILE, а если его нет — группы по group_parts частей.
+    Незаконченная последняя глава обрезается по последней части.
+    """
+    if not indices:
+        return []
+    first, last = min(indices), max(indices)
+    chapters = []
+    if manifest and manifest.get("chapters"):
+        for number, chapter in enumerate(manifest["chapters"], 1):
+            a, b = max(chapter["first_part"], first), min(chapter["last_part"], last)
+            if a <= b:
+                chapters.append({"number": number, "title": chapter["title"], "first_part": a, "last_part": b})
+        return chapters
+    for number, a in enumerate(range(first, last + 1, group_parts), 1):
+        b = min(a + group_parts - 1, last)
+        chapters.append({"number": number, "title": f"Части {a}–{b}", "first_part": a, "last_part": b})
+    return chapters
+
+def safe_file_name(title, limit=80):
+    name = " ".join(re.sub(r'[\\/:*?"<>|\x00-\x1f]+', " ", title).split()).strip(" .")
+    return name[:limit].rstrip(" .") or "Глава"
+
+# ================== ID3 И XING ==================
+
+def id3_frame(frame_id, data):
+    """Кадр ID3v2.3: размер — обычное 32-битное число (не syncsafe, как в v2.4)."""
+    return frame_id.encode("ascii") + len(data).to_bytes(4, "big") + b"\x00\x00" + data
+
+def id3_text_frame(frame_id, text):
+    return id3_frame(frame_id, b"\x01" + text.encode("utf-16"))
+
+def id3v2_tag(title, album=None, track=None, chapters=()):
+    """
+    Тег ID3v2.3: название, альбом, номер дорожки и главы по спецификации ID3v2 Chapter
+    Frame Addendum — CTOC (оглавление, до 255 ссылок) и CHAP с временем начала/конца в мс.
+    """
+    frames = [id3_text_frame("TIT2", title), id3_text_frame("TCON", "Audiobook")]
+    if album:
+        frames.append(id3_text_frame("TALB", album))
+    if track:
+        frames.append(id3_text_frame("TRCK", track))
+    if chapters:
+        ids = [f"ch{n}".encode("ascii") for n in range(len(chapters))]
+        listed = ids[:255]
+        frames.append(id3_frame("CTOC", b"toc\x00" + b"\x03" + bytes([len(listed)]) + b"".join(i + b"\x00" for i in listed)))
+        for element_id, chapter in zip(ids, chapters):
+            body = element_id + b"\x00" + chapter["start"].to_bytes(4, "big") + chapter["end"].to_bytes(4, "big") + b"\xff" * 8
+            frames.append(id3_frame("CHAP", body + id3_text_frame("TIT2", chapter["title"])))
+    body = b"".join(frames)
+    size = len(body)
+    return b"ID3\x03\x00\x00" + bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F]) + body
+
+def make_xing_frame(first_header, frames, audio_size, marks, cbr):
+    """
+    Служебный кадр Xing (Info для постоянного битрейта) перед звуком: число кадров, байт
+    и таблица перемотки из 100 точек, иначе плееры оценивают длительность склейки
+    по первому кадру. marks — (секунд, байт) на границах частей; внутри части смещение
+    интерполируется линейно.
+    """
+    b1 = first_header[1] | 0x01
+    bitrate_index = first_header[2] >> 4
+    for index in range(bitrate_index, 15):
+        header = bytes([0xFF, b1, (index << 4) | (first_header[2] & 0x0C), first_header[3]])
+        info = tts_batch.parse_mp3_frame_header(header)
+        offset = 4 + tts_batch.mp3_side_info_size(info)
+        if info["length"] >= offset + 116:
+            break
+    total_size = info["length"] + audio_size
+    total_time = marks[-1][0]
+    times = [m[0] for m in marks]
+    toc = bytearray(100)
+    for i in range(100):
+        t = total_time * i / 100
+        k = max(0, bisect.bisect_right(times, t) - 1)
+        if k + 1 < len(marks) and marks[k + 1][0] > marks[k][0]:
+            pos = marks[k][1] + (marks[k + 1][1] - marks[k][1]) * (t - marks[k][0]) / (marks[k + 1][0] - marks[k][0])
+        else:
+            pos = marks[k][1]
+        toc[i] = min(255, int((info["length"] + pos) * 256 / total_size))
+    frame = bytearray(info["length"])
+    frame[:4] = header
+    frame[offset:offset + 4] = b"Info" if cbr else b"Xing"
+    frame[offset + 4:offset + 8] = (0x07).to_bytes(4, "big")
+    frame[offset + 8:offset + 12] = frames.to_bytes(4, "big")
+    frame[offset + 12:offset + 16] = total_size.to_bytes(4, "big")
+    frame[offset + 16:offset + 116] = toc
+    return bytes(frame)
+
+# ================== СБОРКА ==================
+
+class Mp3BookWriter:
+    """
+    Один выходной MP3. Звуковые кадры частей дописываются во временный файл как есть,
+    по ходу считаются длительность и размер; finish() пишет итоговый файл:
+    тег ID3v2 (с главами), кадр Xing/Info, затем звук.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        self._audio = open(self._tmp_path, "wb")
+        self._marks = [(0.0, 0)]
+        self.duration = 0.0
+        self.size = 0
+        self.frames = 0
+        self.format = None
+        self.bitrates = set()
+        self.mismatched = []
+        self._first_header = None
+
+    @property
+    def position_ms(self):
+        return int(round(self.duration * 1000))
+
+    def add_part(self, index, data):
+        """Дописывает кадры части. Возвращает длительность в секундах или None, если кадров MP3 нет."""
+        scan = tts_batch.scan_mp3_frames(data)
+        if not scan["frames"]:
+            return None
+        fmt = (scan["version"], scan["sample_rate"], scan["mono"])
+        if self.format is None:
+            self.format = fmt
+            self._first_header = data[scan["spans"][0][0]:scan["spans"][0][0] + 4]
+        elif fmt != self.format:
+            self.mismatched.append(index)
+        view = memoryview(data)
+        for start, end in scan["spans"]:
+            self._audio.write(view[start:end])
+            self.size += end - start
+        self.frames += scan["frames"]
+        self.duration += scan["duration"]
+        self.bitrates |= scan["bitrates"]
+        self._marks.append((self.duration, self.size))
+        return scan["duration"]
+
+    def finish(self, title, album=None, track=None, chapters=()):
+        """Записывает итоговый файл. False — ни одной части не было, файл не создан."""
+        self._audio.close()
+        if not self.frames:
+            os.remove(self._tmp_path)
+            return False
+        xing = make_xing_frame(self._first_header, self.frames, self.size, self._marks, cbr=len(self.bitrates) == 1)
+        with open(self.path, "wb") as out:
+            out.write(id3v2_tag(title, album, track, chapters))
+            out.write(xing)
+            with open(self._tmp_path, "rb") as src:
+                shutil.copyfileobj(src, out, 4 * 1024 * 1024)
+        os.remove(self._tmp_path)
+        return True
+
+def cue_time(ms):
+    """Время cue: мм:сс:кк, где кк — кадры CD (1/75 с)."""
+    return f"{ms // 60000:02}:{ms // 1000 % 60:02}:{ms % 1000 * 75 // 1000:02}"
+
+def cue_quote(text):
+    return '"' + text.replace('"', "'") + '"'
+
+def write_cue(path, title, files):
+    """cue-файл: files — [(имя mp3, [глава, ...])], у главы title и start (мс от начала файла)."""
+    lines = [f"TITLE {cue_quote(title)}"]
+    track = 0
+    for file_name, chapters in files:
+        lines.append(f"FILE {cue_quote(file_name)} MP3")
+        for chapter in chapters:
+            track += 1
+            lines += [f"  TRACK {track:02} AUDIO", f"    TITLE {cue_quote(chapter['title'])}", f"    INDEX 01 {cue_time(chapter['start'])}"]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def ffmetadata_escape(text):
+    return re.sub(r"([=;#\\\n])", r"\\\1", text)
+
+def write_ffmetadata(path, title, chapters):
+    """Главы в формате FFMETADATA1 — для ffmpeg (-map_chapters) и сборки M4B."""
+    lines = [";FFMETADATA1", f"title={ffmetadata_escape(title)}", "genre=Audiobook"]
+    for chapter in chapters:
+        lines += ["[CHAPTER]", "TIMEBASE=1/1000", f"START={chapter['start']}", f"END={chapter['end']}", f"title={ffmetadata_escape(chapter['title'])}"]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def make_m4b(mp3_path, metadata_path, m4b_path):
+    """M4B с главами: звук MP3 переносится в контейнер MP4 без перекодирования (-c:a copy)."""
+    cmd = [tts_batch.FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", "-i", mp3_path, "-i", metadata_path,
+           "-map", "0:a", "-map_metadata", "1", "-map_chapters", "1", "-c:a", "copy", "-f", "mp4", m4b_path]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.decode("utf-8", "replace").strip() or f"ffmpeg код {proc.returncode}")
+
+def plan_outputs(by, title, chapters, total):
+    """Выходные файлы: одна книга со всеми главами или по файлу на главу (номер — по оглавлению книги)."""
+    if by == "book":
+        return [{"file": f"{safe_file_name(title)}.mp3", "title": title, "track": None, "chapters": chapters}]
+    return [
+        {"file": f"{ch['number']:03} {safe_file_name(ch['title'])}.mp3", "title": ch["title"], "track": f"{ch['number']}/{total}", "chapters": [ch]}
+        for ch in chapters
+    ]
+
+def assemble(args):
+    progress = tts_batch.read_progress_file(args.progress) or {}
+    manifest = tts_batch.read_json_file(args.chapters)
+    allowed = tts_batch.parse_part_ranges(args.parts)
+    sources = []
+    local = None
+    if args.source in ("auto", "local"):
+        local = LocalPartSource(args.dir or default_local_paths())
+        sources.append(local)
+    try:
+        available = local.indices() if local else set()
+        uploaded = {int(k) for k, e in progress.get("fragments", {}).items() if e.get("status") == "ok" and e.get("batch")}
+        if args.source == "b2" or (args.source == "auto" and uploaded - available and tts_batch.b2_credentials()):
+            b2 = B2PartSource(progress, uploaded - available, args.tmp)
+            sources.append(b2)
+            available |= b2.indices()
+            print(f"С B2 понадобится пачек: {b2.batch_count}")
+        if allowed is not None:
+            available &= allowed
+        chapters = chapter_plan(manifest, available, args.group_parts)
+        if not chapters:
+            print("Нет частей для сборки.")
+            return 1
+        title = args.title or (manifest or {}).get("book") or tts_batch.BOOK_BASENAME
+        os.makedirs(args.out, exist_ok=True)
+
+        def read_part(index):
+            for source in sources:
+                data = source.read(index)
+                if data is not None:
+                    return data
+            return None
+
+        started = time.perf_counter()
+        missing = []
+        mismatched = []
+        cue_files = []
+        book_chapters = []
+        total_parts = sum(ch["last_part"] - ch["first_part"] + 1 for ch in chapters)
+        total_bytes = 0
+        with tqdm(total=total_parts, desc="Сборка", unit="part") as bar:
+            total_chapters = len((manifest or {}).get("chapters") or []) or chapters[-1]["number"]
+            for output in plan_outputs(args.by, title, chapters, total_chapters):
+                path = os.path.join(args.out, output["file"])
+                writer = Mp3BookWriter(path)
+                marks = []
+                for chapter in output["chapters"]:
+                    start = writer.position_ms
+                    for index in range(chapter["first_part"], chapter["last_part"] + 1):
+                        data = read_part(index) if allowed is None or index in allowed else None
+                        if data is None or writer.add_part(index, data) is None:
+                            missing.append(index)
+                        bar.update(1)
+                    if writer.position_ms > start:
+                        marks.append({"title": chapter["title"], "start": start, "end": writer.position_ms})
+                if not writer.finish(output["title"], title, output["track"], marks if args.by == "book" else ()):
+                    continue
+                mismatched += writer.mismatched
+                total_bytes += os.path.getsize(path)
+                cue_files.append((output["file"], marks))
+                book_chapters = marks
+    finally:
+        for source in sources:
+            source.close()
+
+    base = os.path.join(args.out, safe_file_name(title))
+    write_cue(base + ".cue", title, cue_files)
+    if args.by == "book" and cue_files:
+        write_ffmetadata(base + ".ffmetadata", title, book_chapters)
+        if args.m4b:
+            make_m4b(os.path.join(args.out, cue_files[0][0]), base + ".ffmetadata", base + ".m4b")
+    elapsed = time.perf_counter() - started
+    duration = sum(m[-1]["end"] for _, m in cue_files if m) // 1000
+    print(f"Собрано файлов: {len(cue_files)}, глав: {sum(len(m) for _, m in cue_files)}, "
+          f"длительность {duration // 3600}:{duration // 60 % 60:02}:{duration % 60:02}, "
+          f"{total_bytes / (1024 * 1024):.1f} МБ за {elapsed:.1f} с -> {args.out}")
+    if missing:
+        print(f"Нет аудио для частей ({len(missing)}): {tts_batch.format_part_ranges(missing)}")
+    if mismatched:
+        print(f"Внимание: формат MP3 (частота/каналы) отличается у частей {tts_batch.format_part_ranges(mismatched)} — "
+              f"некоторые плееры воспроизведут их неверно.")
+    return 0
+
+# ================== ЗАПУСК ==================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сборка part_XXXX.mp3 в главы/книгу без перекодирования")
+    parser.add_argument("--by", choices=["book", "chapters"], default="book",
+                        help="одна книга с метками глав (по умолчанию) или отдельный файл на главу")
+    parser.add_argument("--source", choices=["auto", "local", "b2"], default="auto",
+                        help="auto — локальные части, недостающие — из пачек на B2 (если B2 настроен)")
+    parser.add_argument("--dir", nargs="+", help="папки и архивы с частями (по умолчанию output_mp3 и output_mp3_sealed_*)")
+    parser.add_argument("--out", default=f"{tts_batch.BOOK_BASENAME}_audiobook", help="папка для результата")
+    parser.add_argument("--title", help="название книги (по умолчанию — имя файла книги)")
+    parser.add_argument("--parts", help="только эти номера частей, например 1-300")
+    parser.add_argument("--group-parts", type=int, default=100, help="частей в «главе», если нет оглавления")
+    parser.add_argument("--progress", default=tts_batch.PROGRESS_FILE, help="файл состояния (номера пачек на B2)")
+    parser.add_argument("--chapters", default=tts_batch.CHAPTERS_FILE, help="оглавление, записанное при разбивке по главам")
+    parser.add_argument("--m4b", action="store_true", help="дополнительно собрать M4B с главами (нужен ffmpeg)")
+    parser.add_argument("--tmp", help="папка для скачанных с B2 пачек (по умолчанию системная временная)")
+    args = parser.parse_args(argv)
+    if args.m4b and args.by != "book":
+        parser.error("--m4b собирается только вместе с --by book")
+    return assemble(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
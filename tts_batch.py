@@ -10,6 +10,7 @@
 # - автоматическое создание отдельного лог-файла для каждой книги
 # - запись также в общий tts_batch.log для совместимости с workflow
 # - финальная выгрузка остатка (если остались файлы после основного цикла)
+# - параллельную генерацию фрагментов (FREETTS_CONCURRENCY) с фиксацией результатов по порядку
 
 import os
 import sys
@@ -18,24 +19,48 @@ import glob
 import requests
 import re
 import zipfile
+import tarfile
 import hashlib
 import json
 import time
 import base64
+import threading
+import collections
+import queue
+import shutil
+import random
+import email.utils
+import unicodedata
+import codecs
+import bisect
+import math
+import heapq
+from xml.etree import ElementTree
+import atexit
+import signal
+import subprocess
+import io
+import wave
+import contextlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, TimeoutError as FuturesTimeoutError
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from bs4 import BeautifulSoup
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # ================== НАСТРОЙКИ ПОЛЬЗОВАТЕЛЯ ==================
 
-# Название исходного текстового файла (может быть .txt или .fb2)
-TEXT_FILE_NAME = "Nadejdin_Jizn_Naoborot.txt"
+# Название исходного текстового файла (может быть .txt или .fb2); TTS_TEXT_FILE в окружении важнее
+TEXT_FILE_NAME = os.environ.get("TTS_TEXT_FILE") or "Nadejdin_Jizn_Naoborot.txt"
 
 # Папка для готовых mp3 файлов
 OUTPUT_MP3_DIR = "output_mp3"
 
-# Временная папка для промежуточных wav файлов
-TMP_AUDIO_DIR = "tmp_audio"
-
 # Минимальный и максимальный размер mp3 файла в КБ
 MIN_SIZE_KB = 15
 MAX_SIZE_KB = 5000
@@ -49,6 +74,11 @@ SAMPLE_RATE_HZ = 24000
 # Битрейт MP3 при конвертации из WAV (например: "64k", "96k", "128k")
 MP3_BITRATE = "128k"
 
+# Конвертация WAV -> MP3: ffmpeg читает WAV из stdin и пишет MP3 в stdout (без временных файлов).
+# Одновременно работает до TTS_TRANSCODE_WORKERS процессов ffmpeg, пока идут следующие запросы к API.
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+TTS_TRANSCODE_WORKERS = max(1, int(os.environ.get("TTS_TRANSCODE_WORKERS", str(os.cpu_count() or 2))))
+
 # Голоса и языки (можно расширять)
 VOICES_DATA = {"voices": []}
 LANGS_DATA = {"langs": []}
@@ -70,11 +100,16 @@ def env_value(name, default=None):
         return default
     return value
 
-FREETTS_BASE_URL = "https://freetts.ru"
-FREETTS_SYNTHESIS_URL = "https://freetts.ru/api/synthesis"
+# Адрес сервиса можно подменить (например, на tts_mock_server.py для бенчмарков)
+FREETTS_BASE_URL = env_value("FREETTS_BASE_URL", "https://freetts.ru").rstrip("/")
+FREETTS_SYNTHESIS_URL = FREETTS_BASE_URL + "/api/synthesis"
 FREETTS_AUDIO_EXT = env_value("FREETTS_AUDIO_EXT", "mp3")
 FREETTS_POLL_ATTEMPTS = int(env_value("FREETTS_POLL_ATTEMPTS", "30"))
 FREETTS_POLL_DELAY = int(env_value("FREETTS_POLL_DELAY_SEC", "2"))
+# Опрос незавершённых заданий: интервал растёт в FREETTS_POLL_BACKOFF раз до FREETTS_POLL_MAX_DELAY_SEC,
+# общий срок ожидания задания — FREETTS_POLL_ATTEMPTS * FREETTS_POLL_DELAY_SEC секунд
+FREETTS_POLL_BACKOFF = float(env_value("FREETTS_POLL_BACKOFF", "1.5"))
+FREETTS_POLL_MAX_DELAY = float(env_value("FREETTS_POLL_MAX_DELAY_SEC", "15"))
 FREETTS_REQUEST_DELAY = int(env_value("FREETTS_REQUEST_DELAY_SEC", "3"))
 FREETTS_TOKEN = env_value("FREETTS_TOKEN")
 FREETTS_VOICE_ID = env_value("FREETTS_VOICE_ID")
@@ -83,10 +118,116 @@ FREETTS_FALLBACK_VOICE_ID = env_value("FREETTS_FALLBACK_VOICE_ID", "VbNqRtKmLpOz
 FREETTS_FALLBACK_LANG_CODE = env_value("FREETTS_FALLBACK_LANG_CODE", "ru")
 FREETTS_COOKIE = env_value("FREETTS_COOKIE")
 
+# Локальный кэш между запусками (каталог голосов и т.п.); в workflow сохраняется через actions/cache
+TTS_CACHE_DIR = env_value("TTS_CACHE_DIR", ".tts_cache")
+# Сколько часов считать свежим сохранённый каталог голосов/языков freetts.ru (0 — всегда загружать заново)
+FREETTS_CATALOG_TTL_HOURS = float(env_value("FREETTS_CATALOG_TTL_HOURS", "24"))
+FREETTS_CATALOG_CACHE = os.path.join(TTS_CACHE_DIR, "freetts_catalog.json")
+# Токен, cookie и адрес скрипта, в котором нашёлся токен (перепроверяются при первом status=error)
+FREETTS_SESSION_CACHE = os.path.join(TTS_CACHE_DIR, "freetts_session.json")
+# Кэш готового аудио по содержимому фрагмента (текст + голос + язык + формат).
+# TTS_AUDIO_CACHE_MB — предел размера локального кэша (0 — выключен), старые записи вытесняются.
+# TTS_AUDIO_CACHE_B2=1 — дополнительно хранить и искать аудио в бакете B2 под префиксом TTS_AUDIO_CACHE_B2_PREFIX.
+TTS_AUDIO_CACHE_DIR = os.path.join(TTS_CACHE_DIR, "audio")
+TTS_AUDIO_CACHE_MB = float(env_value("TTS_AUDIO_CACHE_MB", "1024"))
+TTS_AUDIO_CACHE_B2 = env_value("TTS_AUDIO_CACHE_B2", "0") == "1"
+TTS_AUDIO_CACHE_B2_PREFIX = env_value("TTS_AUDIO_CACHE_B2_PREFIX", "tts_cache/")
+# Сколько скриптов страницы загружать одновременно при поиске токена
+FREETTS_SCRIPT_FETCH_THREADS = max(1, int(env_value("FREETTS_SCRIPT_FETCH_THREADS", "8")))
+
+# Дозаполнение пропусков: перед продолжением заново озвучить фрагменты до точки
+# возобновления, которые не получились раньше (txt-заглушки, удалённые по размеру и т.п.)
+TTS_RESUME_GAPS = env_value("TTS_RESUME_GAPS", "0") == "1"
+
+# Разбивка текста на фрагменты: "sentence" — по границам предложений с плотной упаковкой,
+# "chapters" — для FB2: по главам (<section>/<title>), фрагменты не переходят границу главы,
+# "legacy" — прежний алгоритм. По умолчанию (auto) книга, начатая прежним алгоритмом,
+# продолжает им же, чтобы номера частей не сдвинулись; новая FB2 разбивается по главам.
+TEXT_SPLITTER = env_value("TEXT_SPLITTER", "auto")
+# Максимальная длина фрагмента (символов) — близко к пределу API
+TEXT_FRAGMENT_MAX_CHARS = int(env_value("TEXT_FRAGMENT_MAX_CHARS", "980"))
+# Книга читается потоком: кусками по TEXT_STREAM_BLOCK_CHARS байт, кодировка — по первым не-ASCII байтам
+TEXT_STREAM_BLOCK_CHARS = 256 * 1024
+TEXT_ENCODING_PREFIX_BYTES = 64 * 1024
+
+# Восстановление по ссылкам из AUDIO_URLS_LOG вместо повторного синтеза:
+# "1" — скачать записанные части, которых нет ни на диске, ни в выгруженных на B2 пачках, и продолжить озвучку;
+# "only" — только скачать (и выгрузить), без синтеза. TTS_RECOVER_PARTS ограничивает номера, например "1-300,412".
+TTS_RECOVER_FROM_URLS = env_value("TTS_RECOVER_FROM_URLS", "0")
+TTS_RECOVER_PARTS = env_value("TTS_RECOVER_PARTS")
+TTS_RECOVER_THREADS = max(1, int(env_value("TTS_RECOVER_THREADS", "8")))
+
+# Проверка аудио до записи на диск (вместо одной проверки размера): длительность по заголовкам
+# кадров MP3 сравнивается с ожидаемой по числу символов, тишина ищется по RMS декодированного звука.
+# Негодный ответ сразу запрашивается заново (до TTS_VALIDATE_RETRIES раз), потом часть пропускается.
+# TTS_VALIDATE_AUDIO=0 — только прежняя проверка размера.
+TTS_VALIDATE_AUDIO = env_value("TTS_VALIDATE_AUDIO", "1") == "1"
+TTS_VALIDATE_RETRIES = max(0, int(env_value("TTS_VALIDATE_RETRIES", "2")))
+# Темп речи для ожидаемой длительности, пока в книге мало принятых частей (дальше — медиана по ним)
+TTS_CHARS_PER_SEC = float(env_value("TTS_CHARS_PER_SEC", "14"))
+TTS_MIN_DURATION_RATIO = float(env_value("TTS_MIN_DURATION_RATIO", "0.45"))
+TTS_MAX_DURATION_RATIO = float(env_value("TTS_MAX_DURATION_RATIO", "3"))
+# Тишина: весь звук тише TTS_SILENCE_DBFS или тихих окон по 50 мс больше TTS_MAX_SILENCE_SHARE
+TTS_SILENCE_DBFS = float(env_value("TTS_SILENCE_DBFS", "-50"))
+TTS_MAX_SILENCE_SHARE = float(env_value("TTS_MAX_SILENCE_SHARE", "0.6"))
+
+# Количество одновременных запросов к API (1 — последовательный режим, как раньше)
+FREETTS_CONCURRENCY = max(1, int(env_value("FREETTS_CONCURRENCY", "1")))
+# Сколько ещё фрагментов может ждать готовности на сервере сверх FREETTS_CONCURRENCY: пока их
+# опрашивает общий поток, следующие фрагменты уже отправляются (0 — ждать по одному, как раньше).
+# Каждый такой фрагмент — ещё один рабочий поток, поэтому по умолчанию выключено
+FREETTS_PENDING_JOBS = max(0, int(env_value("FREETTS_PENDING_JOBS", "0")))
+
+# Адаптивный темп запросов (запросов в секунду). Стартовый темп берётся из FREETTS_REQUEST_DELAY_SEC,
+# при успехах растёт на FREETTS_RATE_STEP, при ошибках/429/5xx умножается на FREETTS_RATE_BACKOFF.
+FREETTS_RATE_INITIAL = float(env_value("FREETTS_RATE_INITIAL", str(1.0 / FREETTS_REQUEST_DELAY if FREETTS_REQUEST_DELAY > 0 else 1.0)))
+FREETTS_RATE_MIN = float(env_value("FREETTS_RATE_MIN", "0.0167"))
+FREETTS_RATE_MAX = float(env_value("FREETTS_RATE_MAX", "2"))
+FREETTS_RATE_STEP = float(env_value("FREETTS_RATE_STEP", "0.05"))
+FREETTS_RATE_BACKOFF = float(env_value("FREETTS_RATE_BACKOFF", "0.5"))
+FREETTS_RATE_BURST = max(1, int(env_value("FREETTS_RATE_BURST", "1")))
+# Верхняя граница паузы между повторами (экспоненциальный рост от RETRY_DELAY_SEC)
+RETRY_MAX_DELAY = int(env_value("RETRY_MAX_DELAY_SEC", "120"))
+
+# Размыкатель: после N фрагментов подряд с одинаковой ошибкой провайдера работа
+# останавливается (abort) или приостанавливается на FREETTS_BREAKER_PAUSE_SEC (pause).
+FREETTS_BREAKER_THRESHOLD = int(env_value("FREETTS_BREAKER_THRESHOLD", "5"))
+FREETTS_BREAKER_MODE = env_value("FREETTS_BREAKER_MODE", "abort")
+FREETTS_BREAKER_PAUSE_SEC = int(env_value("FREETTS_BREAKER_PAUSE_SEC", "300"))
+FREETTS_BREAKER_MAX_PAUSES = int(env_value("FREETTS_BREAKER_MAX_PAUSES", "3"))
+
+# Провайдеры синтеза через запятую: freetts, openai_fm. Фрагменты распределяются между ними
+# пропорционально наблюдаемой скорости, поэтому все перечисленные должны звучать похоже
+# (один голосовой профиль). По умолчанию — только freetts, как раньше.
+TTS_BACKENDS = [name.strip() for name in env_value("TTS_BACKENDS", "freetts").split(",") if name.strip()]
+# Попыток на одном провайдере, прежде чем фрагмент уйдёт к следующему (если провайдеров несколько),
+# и сколько секунд фрагмент готов ждать темпа провайдера, если следующий свободен
+TTS_FAILOVER_ATTEMPTS = max(1, int(env_value("TTS_FAILOVER_ATTEMPTS", "3")))
+TTS_FAILOVER_WAIT_SEC = float(env_value("TTS_FAILOVER_WAIT_SEC", "15"))
+
+# ----------------- openai.fm -----------------
+OPENAIFM_URL = env_value("OPENAIFM_URL", "https://www.openai.fm/api/generate")
+OPENAIFM_VOICES = ["Alloy", "Ash", "Ballad", "Coral", "Echo", "Fable", "Onyx", "Nova", "Sage", "Shimmer", "Verse"]
+OPENAIFM_VIBES = {
+    "Calm (Спокойный)": ["Emotion: Искреннее сочувствие, уверенность.", "Emphasis: Выделите ключевые мысли."],
+    "Energetic (Энергичный)": ["Emotion: Яркий, энергичный тон.", "Emphasis: Выделите эмоциональные слова."],
+}
+OPENAIFM_VOICE = env_value("OPENAIFM_VOICE", "Verse")
+OPENAIFM_VIBE = env_value("OPENAIFM_VIBE", "Calm (Спокойный)")
+OPENAIFM_CONCURRENCY = max(1, int(env_value("OPENAIFM_CONCURRENCY", "1")))
+OPENAIFM_REQUEST_DELAY = float(env_value("OPENAIFM_REQUEST_DELAY_SEC", "3"))
+
 # ----------------- ЛОГ-ФАЙЛЫ -----------------
 BOOK_BASENAME = os.path.splitext(os.path.basename(TEXT_FILE_NAME))[0]
 LOG_FILE = BOOK_BASENAME + ".log"
 AUDIO_URLS_LOG = BOOK_BASENAME + "_audio_urls.jsonl"
+# Файл состояния: статус каждого фрагмента (коммитится workflow вместе с логом).
+# Изменения по фрагментам дописываются в журнал <книга>_progress_journal.jsonl, а в сам файл
+# сворачиваются при выгрузке пачки, в конце запуска и каждые PROGRESS_JOURNAL_MAX_LINES записей
+PROGRESS_FILE = BOOK_BASENAME + "_progress.json"
+PROGRESS_JOURNAL_MAX_LINES = 1000
+# Оглавление для разбивки "chapters": название главы и диапазон её частей
+CHAPTERS_FILE = BOOK_BASENAME + "_chapters.json"
 
 def resolve_global_log_file(book_basename):
     """
@@ -114,25 +255,294 @@ B2_MARKER_FILE = ".b2_upload_ok.json"
 # Имя zip архива с результатами (временное имя, удаляется после upload)
 ZIP_FILE_NAME = "mp3_results.zip"
 
+# Формат архива пачки: store — mp3/wav без повторного сжатия, txt сжимаются (по умолчанию);
+# deflate — сжимать всё (как раньше); tar — несжатый tar-поток (только для выгрузки на B2)
+ARCHIVE_CODEC = env_value("ARCHIVE_CODEC", "store")
+AUDIO_FILE_EXTENSIONS = (".mp3", ".wav")
+
+# Backblaze B2: адрес API, размер куска и число потоков для загрузки больших архивов
+B2_API_URL = env_value("B2_API_URL", "https://api.backblazeb2.com")
+B2_PART_SIZE_MB = int(env_value("B2_PART_SIZE_MB", "50"))
+B2_UPLOAD_THREADS = int(env_value("B2_UPLOAD_THREADS", "3"))
+
+# Структурированный лог (JSON lines) рядом с обычным: TTS_STRUCTURED_LOG=1
+TTS_STRUCTURED_LOG = env_value("TTS_STRUCTURED_LOG", "0") == "1"
+STRUCTURED_LOG_FILE = BOOK_BASENAME + "_log.jsonl"
+
+# Метрики запуска: время этапов и попыток, повторы, байты, простой. В конце запуска сводка
+# дописывается строкой в TTS_METRICS_FILE (JSON lines, по строке на запуск; 0 — не писать),
+# при заданном TTS_METRICS_PROM — ещё и в текстовый файл Prometheus (node_exporter textfile collector)
+TTS_METRICS_FILE = env_value("TTS_METRICS_FILE", BOOK_BASENAME + "_metrics.jsonl")
+TTS_METRICS_PROM = env_value("TTS_METRICS_PROM")
+
+# Логи пишутся пачками: сброс на диск раз в TTS_LOG_FLUSH_SEC секунд,
+# при накоплении TTS_LOG_FLUSH_KB килобайт и при завершении/сигнале
+TTS_LOG_FLUSH_SEC = float(env_value("TTS_LOG_FLUSH_SEC", "2"))
+TTS_LOG_FLUSH_KB = int(env_value("TTS_LOG_FLUSH_KB", "64"))
+
 # ================== ФУНКЦИИ ==================
 
+class BufferedLogWriter:
+    """
+    Держит файлы логов открытыми на дозапись и сбрасывает накопленные строки пачкой:
+    по таймеру (фоновый поток), по объёму буфера и при flush()/close().
+    Все записи идут под одной блокировкой, поэтому строки из разных потоков не перемешиваются.
+    """
+    def __init__(self, flush_interval, flush_bytes):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._handles = {}
+        self._buffers = collections.OrderedDict()
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self, path, text):
+        with self._lock:
+            self._buffers.setdefault(path, []).append(text)
+            self._buffered += len(text)
+            if self._buffered >= self.flush_bytes:
+                self._flush_locked()
+            elif self._thread is None and self.flush_interval > 0:
+                self._thread = threading.Thread(target=self._run, name="log-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _flush_locked(self):
+        for path, lines in self._buffers.items():
+            if not lines:
+                continue
+            try:
+                handle = self._handles.get(path)
+                if handle is None:
+                    handle = self._handles[path] = open(path, "a", encoding="utf-8")
+                handle.write("".join(lines))
+                handle.flush()
+            except Exception:
+                pass
+            lines.clear()
+        self._buffered = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def try_flush(self, timeout=0):
+        """
+        Сброс без ожидания блокировки дольше timeout (для обработчика сигнала): если её держит
+        сам прерванный основной поток, ждать бесполезно — вернёт False, буфер сбросят позже.
+        """
+        if not self._lock.acquire(timeout=timeout):
+            return False
+        try:
+            self._flush_locked()
+        finally:
+            self._lock.release()
+        return True
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._flush_locked()
+            for handle in self._handles.values():
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+            self._handles.clear()
+
+LOG_WRITER = BufferedLogWriter(TTS_LOG_FLUSH_SEC, TTS_LOG_FLUSH_KB * 1024)
+atexit.register(LOG_WRITER.close)
+
+def install_log_signal_handlers():
+    """
+    По SIGTERM/SIGHUP (отмена job в Actions; SIGKILL придёт через несколько секунд) останавливаемся сразу:
+    STOP_REQUESTED прерывает повторы и ожидания в рабочих потоках, логи сбрасываются тут же,
+    а SystemExit разматывает основной поток. Блокировку писателя обработчик ждёт не дольше
+    секунды — её может держать сам прерванный основной поток; тогда логи сбросит
+    LOG_WRITER.flush() в __main__ сразу после размотки, ещё до ожидания рабочих потоков и atexit.
+    """
+    def handler(signum, frame):
+        STOP_REQUESTED.set()
+        LOG_WRITER.try_flush(timeout=1.0)
+        sys.exit(128 + signum)
+    for name in ("SIGTERM", "SIGHUP"):
+        if hasattr(signal, name):
+            try:
+                signal.signal(getattr(signal, name), handler)
+            except (ValueError, OSError):
+                pass
+
 def log_to_file(message):
     """
     Записывает message с меткой времени в:
      - персональный лог (LOG_FILE)
      - общий лог (GLOBAL_LOG_FILE) — теперь уникальный для книги
+     - структурированный лог STRUCTURED_LOG_FILE (если TTS_STRUCTURED_LOG=1)
+    Запись буферизуется в LOG_WRITER.
     """
-    ts = f"{datetime.datetime.now()} {message}\n"
-    try:
-        with open(LOG_FILE, "a", encoding='utf-8') as f:
-            f.write(ts)
-    except Exception:
-        pass
-    try:
-        with open(GLOBAL_LOG_FILE, "a", encoding='utf-8') as f:
-            f.write(ts)
-    except Exception:
-        pass
+    now = datetime.datetime.now()
+    ts = f"{now} {message}\n"
+    LOG_WRITER.write(LOG_FILE, ts)
+    LOG_WRITER.write(GLOBAL_LOG_FILE, ts)
+    if TTS_STRUCTURED_LOG:
+        record = {"ts": now.isoformat(), "thread": threading.current_thread().name, "msg": message}
+        tag = re.match(r"\[([A-Z0-9_]+)\]", message)
+        if tag:
+            record["tag"] = tag.group(1)
+        part = re.search(r"part_(\d+)", message)
+        if part:
+            record["part"] = int(part.group(1))
+        LOG_WRITER.write(STRUCTURED_LOG_FILE, json.dumps(record, ensure_ascii=False) + "\n")
+
+# ------------------- Метрики запуска -------------------
+class RunMetrics:
+    """
+    Метрики одного запуска, общие для всех потоков:
+     - timings: длительности этапов и попыток (observe/timed) — число, сумма, максимум,
+       p50/p95 по последним TIMING_SAMPLES значениям и накопительные корзины BUCKETS;
+     - events: счётчики событий (попытки по исходам, повторы, фрагменты по статусам);
+     - bytes: объёмы по видам (получено от провайдеров, сохранено, выгружено);
+     - idle: секунды ожидания (темп запросов, паузы между повторами, готовность на сервере).
+    Имена этапов — «провайдер.этап» (freetts.submit) или просто этап (save, upload).
+    """
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    TIMING_SAMPLES = 5000
+
+    def __init__(self):
+        self.started = time.time()
+        self.timings = {}
+        self.events = collections.Counter()
+        self.bytes = collections.Counter()
+        self.idle = collections.Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {
+                    "count": 0, "sum": 0.0, "max": 0.0,
+                    "buckets": [0] * len(self.BUCKETS),
+                    "samples": collections.deque(maxlen=self.TIMING_SAMPLES),
+                }
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["samples"].append(seconds)
+            position = bisect.bisect_left(self.BUCKETS, seconds)
+            if position < len(self.BUCKETS):
+                timing["buckets"][position] += 1
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.events[name] += value
+
+    def add_bytes(self, name, value):
+        with self._lock:
+            self.bytes[name] += value
+
+    def add_idle(self, name, seconds):
+        if seconds > 0:
+            with self._lock:
+                self.idle[name] += seconds
+
+    def summary(self):
+        """Сводка для JSON: всё в секундах и байтах, корзины — накопительные, как в Prometheus."""
+        with self._lock:
+            timings = {}
+            for name, timing in sorted(self.timings.items()):
+                samples = sorted(timing["samples"])
+                timings[name] = {
+                    "count": timing["count"],
+                    "sum": round(timing["sum"], 3),
+                    "mean": round(timing["sum"] / timing["count"], 3),
+                    "p50": round(samples[len(samples) // 2], 3),
+                    "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+                    "max": round(timing["max"], 3),
+                    "buckets": dict(zip([str(b) for b in self.BUCKETS], itertools.accumulate(timing["buckets"]))),
+                }
+            return {
+                "book": BOOK_BASENAME,
+                "started": datetime.datetime.fromtimestamp(self.started).isoformat(),
+                "wall_sec": round(time.time() - self.started, 3),
+                "run_id": os.environ.get("GITHUB_RUN_ID"),
+                "timings": timings,
+                "events": dict(sorted(self.events.items())),
+                "bytes": dict(sorted(self.bytes.items())),
+                "idle_sec": {k: round(v, 3) for k, v in sorted(self.idle.items())},
+            }
+
+    def prometheus_text(self, summary):
+        """Текстовый формат Prometheus: гистограмма tts_stage_seconds и счётчики с меткой book."""
+        book = summary["book"].replace("\\", "\\\\").replace('"', '\\"')
+        lines = [
+            "# HELP tts_run_wall_seconds Длительность запуска tts_batch.py.",
+            "# TYPE tts_run_wall_seconds gauge",
+            f'tts_run_wall_seconds{{book="{book}"}} {summary["wall_sec"]}',
+            "# HELP tts_run_timestamp_seconds Время начала запуска (unix).",
+            "# TYPE tts_run_timestamp_seconds gauge",
+            f'tts_run_timestamp_seconds{{book="{book}"}} {self.started:.0f}',
+            "# HELP tts_stage_seconds Длительность этапов и попыток.",
+            "# TYPE tts_stage_seconds histogram",
+        ]
+        for name, timing in summary["timings"].items():
+            labels = f'book="{book}",stage="{name}"'
+            for bound, cumulative in timing["buckets"].items():
+                lines.append(f'tts_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'tts_stage_seconds_bucket{{{labels},le="+Inf"}} {timing["count"]}')
+            lines.append(f"tts_stage_seconds_sum{{{labels}}} {timing['sum']}")
+            lines.append(f"tts_stage_seconds_count{{{labels}}} {timing['count']}")
+        for metric, label, values, help_text in (
+            ("tts_events_total", "event", summary["events"], "События: попытки по исходам, повторы, фрагменты."),
+            ("tts_bytes_total", "kind", summary["bytes"], "Объём данных по видам."),
+            ("tts_idle_seconds_total", "reason", summary["idle_sec"], "Время ожидания по причинам."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, value in values.items():
+                lines.append(f'{metric}{{book="{book}",{label}="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=TTS_METRICS_FILE, prom_path=TTS_METRICS_PROM):
+        """Дописывает сводку в path (JSON lines) и перезаписывает prom_path. Ошибки только логируются."""
+        summary = self.summary()
+        if path and path != "0":
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+            except Exception as e:
+                log_to_file(f"[METRICS] Не удалось записать {path}: {e}")
+        if prom_path:
+            try:
+                # Атомарно: сборщик textfile не должен увидеть файл наполовину
+                tmp_path = prom_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.prometheus_text(summary))
+                os.replace(tmp_path, prom_path)
+            except Exception as e:
+                log_to_file(f"[METRICS] Не удалось записать {prom_path}: {e}")
+        busiest = sorted(summary["timings"].items(), key=lambda item: item[1]["sum"], reverse=True)[:6]
+        log_to_file(
+            f"[METRICS] Запуск {summary['wall_sec']:.0f} с; этапы (сумма по потокам): "
+            + ", ".join(f"{name} {t['sum']:.1f} с/{t['count']}" for name, t in busiest)
+            + f"; ожидание: {', '.join(f'{k} {v:.0f} с' for k, v in summary['idle_sec'].items()) or 'нет'}."
+        )
+        return summary
+
+METRICS = RunMetrics()
 
 def write_audio_url_log(part_name, voice_id, voice_name, lang_code, lang_name, url):
     entry = {
@@ -144,22 +554,74 @@ def write_audio_url_log(part_name, voice_id, voice_name, lang_code, lang_name, u
         "lang_name": lang_name,
         "url": url
     }
-    try:
-        with open(AUDIO_URLS_LOG, "a", encoding="utf-8") as f:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-    except Exception:
-        pass
+    LOG_WRITER.write(AUDIO_URLS_LOG, json.dumps(entry, ensure_ascii=False) + "\n")
+
+def read_audio_url_ledger(path=AUDIO_URLS_LOG):
+    """Последняя записанная ссылка на аудио для каждого part_XXXX из AUDIO_URLS_LOG."""
+    ledger = {}
+    LOG_WRITER.flush()
+    if not os.path.exists(path):
+        return ledger
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("part") and entry.get("url"):
+                ledger[entry["part"]] = entry
+    return ledger
 
-def read_text_file(file_path):
-    encodings = ["utf-8", "utf-8-sig", "cp1251", "latin-1"]
-    for enc in encodings:
+# Порядок кодировок: следующая берётся, если текущая встретила недопустимые байты
+TEXT_ENCODINGS = ("utf-8", "cp1251", "latin-1")
+
+def detect_text_encoding(file_path, prefix_size=TEXT_ENCODING_PREFIX_BYTES):
+    """
+    Кодировка по первым prefix_size байтам, начиная с первого не-ASCII байта (файл целиком не читается):
+    ASCII-начало (лицензия, английский титул) одинаково в любой кодировке и ничего не решает.
+    utf-8, если этот участок корректен в UTF-8 (обрезанный в конце символ не считается ошибкой), иначе cp1251.
+    """
+    sample = b""
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(prefix_size), b""):
+            if not sample:
+                start = next((i for i, byte in enumerate(chunk) if byte >= 0x80), None)
+                if start is None:
+                    continue
+                chunk = chunk[start:]
+            sample += chunk
+            if len(sample) >= prefix_size:
+                break
+    for enc in TEXT_ENCODINGS:
         try:
-            with open(file_path, "r", encoding=enc) as file:
-                return file.read()
-        except Exception:
+            codecs.getincrementaldecoder(enc)().decode(sample[:prefix_size], final=False)
+            return enc
+        except UnicodeDecodeError:
             continue
-    with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
-        return file.read()
+    return "latin-1"
+
+def read_text_file(file_path):
+    return "".join(iter_text_blocks(file_path))
+
+def write_json_atomic(path, data):
+    """Записывает JSON через временный файл + os.replace, чтобы прерванный запуск не оставил битый файл."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_json_file(path):
+    """Содержимое JSON-файла или None, если файла нет или он повреждён."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
 
 def extract_token_from_html(content):
     if not content:
@@ -177,61 +639,690 @@ def extract_token_from_html(content):
             return match.group(1)
     return None
 
-def extract_token_from_scripts(session, html):
-    soup = BeautifulSoup(html, "html.parser")
-    scripts = [s.get("src") for s in soup.find_all("script") if s.get("src")]
-    for src in scripts:
-        if src.startswith("//"):
-            url = "https:" + src
-        elif src.startswith("/"):
-            url = FREETTS_BASE_URL + src
-        elif src.startswith("http"):
-            url = src
-        else:
-            url = FREETTS_BASE_URL + "/" + src.lstrip("./")
-        try:
-            resp = session.get(url, timeout=30)
-            if resp.status_code != 200:
-                continue
-            token = extract_token_from_html(resp.text)
+def script_url_from_src(src):
+    if src.startswith("//"):
+        return "https:" + src
+    if src.startswith("/"):
+        return FREETTS_BASE_URL + src
+    if src.startswith("http"):
+        return src
+    return FREETTS_BASE_URL + "/" + src.lstrip("./")
+
+def fetch_token_from_script(session, url):
+    try:
+        resp = session.get(url, timeout=30)
+        if resp.status_code != 200:
+            return None
+        return extract_token_from_html(resp.text)
+    except Exception:
+        return None
+
+def extract_token_from_scripts(session, script_urls, preferred_url=None):
+    """
+    Ищет токен в скриптах страницы. Сначала проверяется preferred_url (скрипт, где токен
+    нашёлся в прошлый раз), остальные загружаются параллельно; побеждает первый найденный.
+    Возвращает (token, url) или (None, None).
+    """
+    if preferred_url and preferred_url in script_urls:
+        token = fetch_token_from_script(session, preferred_url)
+        if token:
+            return token, preferred_url
+        script_urls = [u for u in script_urls if u != preferred_url]
+    if not script_urls:
+        return None, None
+    pool = ThreadPoolExecutor(max_workers=min(FREETTS_SCRIPT_FETCH_THREADS, len(script_urls)), thread_name_prefix="token")
+    try:
+        futures = {pool.submit(fetch_token_from_script, session, url): url for url in script_urls}
+        for future in as_completed(futures):
+            token = future.result()
             if token:
-                return token
-        except Exception:
-            continue
-    return None
+                return token, futures[future]
+        return None, None
+    finally:
+        # Остальные скрипты уже не нужны — не ждём их
+        pool.shutdown(wait=False, cancel_futures=True)
 
 # ------------------- Текстовые утилиты -------------------
+# Символы, которые выбрасываются из текста FB2
+FB2_UNWANTED_CHARS = set("{[*+=<>#@\\$&'\"~`/|\\()]}")
+
 def clean_text_from_fb2(file_path):
     print(f"Очистка текста из файла FB2: {file_path}")
     content = read_text_file(file_path)
     soup = BeautifulSoup(content, 'xml')
     text = ' '.join([p.get_text() for p in soup.find_all('p')])
-    unwanted_chars = set("{[*+=<>#@\\$&'\"~`/|\\()]}") 
-    cleaned_text = ''.join(c for c in text if c not in unwanted_chars)
+    cleaned_text = ''.join(c for c in text if c not in FB2_UNWANTED_CHARS)
     print("Очистка текста из FB2 завершена.")
     return cleaned_text
 
-def split_text_fragments(text, max_length=980):
-    print("Разбивка текста на фрагменты...")
+def iter_text_blocks(file_path, block_chars=TEXT_STREAM_BLOCK_CHARS):
+    """
+    Текст файла кусками (по block_chars байт); кодировка определяется по первым не-ASCII байтам.
+    Декодирование строгое: если дальше в файле встретились недопустимые для неё байты,
+    с места ошибки продолжаем следующей кодировкой из TEXT_ENCODINGS — символы не выбрасываются.
+    """
+    encoding = detect_text_encoding(file_path)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    # Переводы строк \r\n и \r приводим к \n, как при чтении файла в текстовом режиме
+    newlines = io.IncrementalNewlineDecoder(None, translate=True)
+    with open(file_path, "rb") as file:
+        # Пустой кусок в конце дочитывает хвост декодера (final=True)
+        for raw in itertools.chain(iter(lambda: file.read(block_chars), b""), [b""]):
+            data = decoder.getstate()[0] + raw
+            decoder.reset()
+            text = ""
+            while True:
+                try:
+                    text += decoder.decode(data, final=not raw)
+                    break
+                except UnicodeDecodeError as e:
+                    # Байты до ошибки корректны в текущей кодировке, с места ошибки — следующая
+                    text += data[:e.start].decode(encoding)
+                    encoding = TEXT_ENCODINGS[TEXT_ENCODINGS.index(encoding) + 1]
+                    print(f"Текст {file_path}: {e.reason} в {e.encoding} — дальше читаем как {encoding}.")
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                    data = data[e.start:]
+            text = newlines.decode(text, final=not raw)
+            if text:
+                yield text
+
+def iter_fb2_paragraphs(file_path):
+    """
+    Тексты <p> книги FB2 по порядку, без построения всего дерева: iterparse,
+    а обработанные элементы сразу удаляются из родителя, так что память не растёт.
+    Если XML некорректен, дочитывает книгу прежним способом (BeautifulSoup),
+    пропустив уже отданные абзацы.
+    """
+    yielded = 0
+    stack = []
+    in_paragraph = 0
+    try:
+        with open(file_path, "rb") as f:
+            for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+                is_paragraph = elem.tag.rsplit("}", 1)[-1] == "p"
+                if event == "start":
+                    stack.append(elem)
+                    in_paragraph += is_paragraph
+                    continue
+                stack.pop()
+                if is_paragraph:
+                    in_paragraph -= 1
+                    yield "".join(elem.itertext())
+                    yielded += 1
+                # Разметку внутри абзаца (<emphasis> и т.п.) не трогаем, пока абзац не прочитан
+                if stack and not in_paragraph:
+                    stack[-1].remove(elem)
+        return
+    except ElementTree.ParseError as e:
+        log_to_file(f"[FB2] Потоковый разбор прерван на абзаце {yielded + 1}: {e}. Дочитываем через BeautifulSoup.")
+    soup = BeautifulSoup(read_text_file(file_path), "xml")
+    for i, p in enumerate(soup.find_all("p")):
+        if i >= yielded:
+            yield p.get_text()
+
+def iter_book_text(file_path):
+    """Текст книги кусками — тот же текст, что даёт read_text_file / clean_text_from_fb2 целиком."""
+    if not file_path.lower().endswith(".fb2"):
+        yield from iter_text_blocks(file_path)
+        return
+    for i, paragraph in enumerate(iter_fb2_paragraphs(file_path)):
+        cleaned = "".join(c for c in paragraph if c not in FB2_UNWANTED_CHARS)
+        yield cleaned if i == 0 else " " + cleaned
+
+def iter_legacy_spans(text, max_length=980):
+    """Границы (start, end) фрагментов прежнего алгоритма (см. split_text_fragments_legacy)."""
     delimiters = {'.', '!', '?', '...'}
-    fragments, start = [], 0
+    start = 0
     while start < len(text):
         end = start + max_length
         if end >= len(text):
-            fragments.append(text[start:])
+            yield start, len(text)
             break
         while end > start and text[end-1] not in delimiters:
             end -= 1
         if end == start:
             end = start + max_length
-        fragments.append(text[start:end].strip())
+        yield start, end
+        start = end
+
+def split_text_fragments_legacy(text, max_length=980):
+    """
+    Прежний алгоритм разбивки. Оставлен без изменений, чтобы у книг, начатых им,
+    не сдвинулись номера частей при возобновлении.
+    """
+    print("Разбивка текста на фрагменты...")
+    spans = list(iter_legacy_spans(text, max_length))
+    fragments = [text[start:end].strip() for start, end in spans[:-1]]
+    if spans:
+        # Последний фрагмент прежний алгоритм не обрезал
+        fragments.append(text[spans[-1][0]:])
+    print(f"Текст разбит на {len(fragments)} фрагментов.")
+    return fragments
+
+# Конец предложения: . ! ? … (в т.ч. повторённые), затем закрывающие кавычки/скобки и пробел.
+# Не граница, если дальше идёт строчная буква (сокращения «т. е.») или авторская речь
+# после реплики («— Стой! — крикнул он»).
+SENTENCE_END_RE = re.compile(r'[.!?…]+["»”’)\]]*(?=\s)(?!\s*[—–-]?\s*[a-zа-яё])')
+# Абзац или новая реплика диалога — всегда граница
+PARAGRAPH_END_RE = re.compile(r'\s*\n\s*')
+# Слабые границы для слишком длинных предложений: запятая, точка с запятой, двоеточие, тире
+CLAUSE_END_RE = re.compile(r'[,;:]\s|\s[—–]\s')
+
+def sentence_boundaries(text):
+    """Отсортированные позиции, где можно резать текст: после конца предложения или абзаца."""
+    bounds = {m.end() for m in SENTENCE_END_RE.finditer(text)}
+    bounds.update(m.start() for m in PARAGRAPH_END_RE.finditer(text) if m.start() > 0)
+    return sorted(bounds)
+
+def iter_sentence_spans(text, max_length=TEXT_FRAGMENT_MAX_CHARS, target_length=None):
+    """
+    Границы (start, end) непустых фрагментов: жадная упаковка целых предложений
+    в max_length. Предложение длиннее max_length режется по запятой/тире, затем
+    по пробелу; посреди слова — только если в окне нет ни одного пробела. O(n).
+    С target_length берётся граница, ближайшая к start + target_length (но не дальше
+    max_length), — так фрагменты главы выходят ровными, без крошечного хвоста.
+    """
+    bounds = sentence_boundaries(text)
+    n = len(text)
+    start = 0
+    while True:
+        while start < n and text[start].isspace():
+            start += 1
+        if start >= n:
+            break
+        limit = start + max_length
+        if limit >= n:
+            yield start, n
+            break
+        # Границы предложений в окне (start, limit]: самая дальняя или ближайшая к цели
+        lo = bisect.bisect_right(bounds, start)
+        hi = bisect.bisect_right(bounds, limit)
+        end = None
+        if lo < hi:
+            if target_length:
+                goal = start + target_length
+                end = min(bounds[lo:hi], key=lambda pos: (abs(pos - goal), -pos))
+            else:
+                end = bounds[hi - 1]
+        if end is None:
+            window = text[start:limit]
+            clause = None
+            for m in CLAUSE_END_RE.finditer(window):
+                clause = m
+            if clause is not None:
+                end = start + clause.end()
+            else:
+                space = window.rfind(" ")
+                end = start + space if space > 0 else limit
+        if text[start:end].strip():
+            yield start, end
         start = end
+
+def split_text_fragments(text, max_length=TEXT_FRAGMENT_MAX_CHARS):
+    """Разбивка по границам предложений и абзацев с жадной упаковкой (см. iter_sentence_spans)."""
+    print("Разбивка текста на фрагменты...")
+    fragments = [text[start:end].strip() for start, end in iter_sentence_spans(text, max_length)]
     print(f"Текст разбит на {len(fragments)} фрагментов.")
     return fragments
 
+TEXT_SPLITTERS = {
+    "legacy": lambda text: split_text_fragments_legacy(text, max_length=980),
+    "sentence": lambda text: split_text_fragments(text, max_length=TEXT_FRAGMENT_MAX_CHARS),
+}
+
+# Для потоковой разбивки: (функция границ, максимальная длина фрагмента)
+TEXT_SPAN_SPLITTERS = {
+    "legacy": (iter_legacy_spans, 980),
+    "sentence": (iter_sentence_spans, TEXT_FRAGMENT_MAX_CHARS),
+}
+
+def iter_text_fragments(pieces, splitter):
+    """
+    Потоковая разбивка: текст приходит кусками (pieces), фрагменты отдаются по мере
+    готовности. Фрагмент отдаётся, только когда после его конца в буфере есть запас
+    больше max_length — решение о разрезе зависит лишь от ближайших max_length символов,
+    поэтому результат совпадает с разбивкой всего текста целиком.
+    """
+    span_func, max_length = TEXT_SPAN_SPLITTERS[splitter]
+    margin = max_length + 4096
+    buffer = ""
+    pending = []
+    pending_size = 0
+    for piece in pieces:
+        pending.append(piece)
+        pending_size += len(piece)
+        if pending_size < TEXT_STREAM_BLOCK_CHARS:
+            continue
+        buffer += "".join(pending)
+        pending, pending_size = [], 0
+        consumed = 0
+        for start, end in span_func(buffer, max_length):
+            if end > len(buffer) - margin:
+                break
+            yield buffer[start:end].strip()
+            consumed = end
+        buffer = buffer[consumed:]
+    buffer += "".join(pending)
+    for start, end in span_func(buffer, max_length):
+        yield buffer[start:end].strip()
+
+def iter_book_fragments(file_path, splitter, manifest=None):
+    """Фрагменты книги без чтения её целиком в память (manifest — оглавление для "chapters")."""
+    if splitter == "chapters":
+        return iter_chapter_fragments(file_path, manifest)
+    return iter_text_fragments(iter_book_text(file_path), splitter)
+
+class FragmentStream:
+    """
+    Итератор (idx, chunk) по фрагментам книги. Общее число фрагментов становится
+    известно, только когда поток дочитан (тогда вызывается on_total(total));
+    до этого в прогрессе показывается число из прошлого запуска, если оно есть.
+    """
+    def __init__(self, fragments, expected_total=None, on_total=None):
+        self._fragments = fragments
+        self.expected_total = expected_total
+        self.on_total = on_total
+        self.count = 0
+        self.total = None
+
+    def __iter__(self):
+        for idx, chunk in enumerate(self._fragments):
+            self.count = idx + 1
+            yield idx, chunk
+        self.total = self.count
+        if self.on_total:
+            self.on_total(self.total)
+
+    @property
+    def total_label(self):
+        if self.total is not None:
+            return str(self.total)
+        if self.expected_total:
+            return f"~{self.expected_total}"
+        return "?"
+
+# ------------------- Главы FB2 -------------------
+# В режиме глав кавычки и скобки сохраняются — они нужны для интонации
+FB2_CHAPTER_UNWANTED_CHARS = set("{[*+=<>#@\\$&~`/|]}")
+# Элементы FB2, текст которых читается как отдельный абзац
+FB2_PARAGRAPH_TAGS = {"p", "v", "subtitle", "text-author"}
+
+def fb2_local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def iter_fb2_chapters(file_path):
+    """
+    Главы книги FB2 по порядку: (путь заголовков, текст). Глава — текст одного <section>
+    до вложенных секций (и после них, если он есть); абзацы разделены переводом строки,
+    заголовок секции идёт первым абзацем. Короткое вступление секции с подсекциями
+    (заголовок, эпиграф) присоединяется к первой подсекции. Примечания (<body name="notes">) не читаются.
+    Разбор потоковый (iterparse), обработанные элементы удаляются из дерева.
+    """
+    stack = []
+    sections = []
+    in_paragraph = 0
+    in_title = 0
+    skip_body = False
+    title_parts = []
+
+    def flush(section):
+        if section["paras"]:
+            titles = [s["title"] for s in sections if s["title"]]
+            text = "\n".join(section["paras"])
+            section["paras"] = []
+            return titles, text
+        return None
+
+    with open(file_path, "rb") as f:
+        for event, elem in ElementTree.iterparse(f, events=("start", "end")):
+            name = fb2_local_name(elem.tag)
+            if event == "start":
+                stack.append(elem)
+                if name == "body":
+                    skip_body = elem.get("name") == "notes"
+                    sections = [{"title": None, "paras": []}]
+                elif name == "section" and not skip_body and sections:
+                    # Короткое вступление родительской секции (заголовок, эпиграф) начинает первую
+                    # подсекцию, длинное — отдельная глава перед подсекциями
+                    carried = []
+                    if sum(len(p) for p in sections[-1]["paras"]) < TEXT_FRAGMENT_MAX_CHARS:
+                        carried, sections[-1]["paras"] = sections[-1]["paras"], []
+                    else:
+                        chapter = flush(sections[-1])
+                        if chapter:
+                            yield chapter
+                    sections.append({"title": None, "paras": carried})
+                elif name == "title":
+                    in_title += 1
+                    title_parts = []
+                in_paragraph += name in FB2_PARAGRAPH_TAGS
+                continue
+            stack.pop()
+            if name in FB2_PARAGRAPH_TAGS:
+                in_paragraph -= 1
+                if not skip_body and sections:
+                    text = " ".join("".join(elem.itertext()).split())
+                    text = "".join(c for c in text if c not in FB2_CHAPTER_UNWANTED_CHARS)
+                    if text and in_title:
+                        title_parts.append(text)
+                    elif text:
+                        sections[-1]["paras"].append(text)
+            elif name == "title":
+                in_title -= 1
+                if not skip_body and sections and title_parts:
+                    title = " ".join(title_parts)
+                    sections[-1]["title"] = title
+                    # Заголовок читается вслух; точка даёт паузу после него
+                    sections[-1]["paras"].append(title if title[-1] in ".!?…" else title + ".")
+            elif name == "section" and not skip_body and len(sections) > 1:
+                chapter = flush(sections[-1])
+                if chapter:
+                    yield chapter
+                sections.pop()
+            elif name == "body":
+                if not skip_body and sections:
+                    chapter = flush(sections[0])
+                    if chapter:
+                        yield chapter
+                sections = []
+                skip_body = False
+            if stack and not in_paragraph:
+                stack[-1].remove(elem)
+
+def fb2_is_well_formed(file_path):
+    """Проверка, что FB2 разбирается как XML (потоково, без построения дерева)."""
+    try:
+        with open(file_path, "rb") as f:
+            for _, elem in ElementTree.iterparse(f):
+                elem.clear()
+        return True
+    except ElementTree.ParseError:
+        return False
+
+class ChapterManifest:
+    """
+    Оглавление CHAPTERS_FILE: для каждой главы — название, путь заголовков, номера первой
+    и последней части и число символов. Заполняется по ходу разбивки (глава записывается
+    до выдачи её фрагментов), поэтому main() сразу знает, где кончается текущая глава.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.chapters = []
+        self._ends = set()
+        self._lock = threading.Lock()
+
+    def add(self, titles, first_part, last_part, chars):
+        with self._lock:
+            number = len(self.chapters) + 1
+            self.chapters.append({
+                "chapter": number,
+                "title": titles[-1] if titles else f"Глава {number}",
+                "path": titles,
+                "first_part": first_part,
+                "last_part": last_part,
+                "chars": chars,
+            })
+            self._ends.add(last_part)
+            self._save()
+
+    def ends_at(self, part):
+        return part in self._ends
+
+    def _save(self):
+        try:
+            write_json_atomic(self.path, {"book": BOOK_BASENAME, "chapters": self.chapters})
+        except Exception as e:
+            log_to_file(f"[CHAPTERS] Не удалось сохранить {self.path}: {e}")
+
+def iter_chapter_fragments(file_path, manifest=None, max_length=TEXT_FRAGMENT_MAX_CHARS):
+    """
+    Фрагменты книги FB2 по главам: предложения упаковываются только внутри главы,
+    а длина выравнивается (ceil(длина / max_length) фрагментов примерно равной длины),
+    чтобы в конце главы не оставался крошечный хвост.
+    """
+    part = 0
+    for titles, text in iter_fb2_chapters(file_path):
+        pieces = max(1, math.ceil(len(text) / max_length))
+        target = len(text) / pieces if pieces > 1 else None
+        fragments = [text[start:end].strip() for start, end in iter_sentence_spans(text, max_length, target)]
+        if not fragments:
+            continue
+        if manifest is not None:
+            manifest.add(titles, part + 1, part + len(fragments), len(text))
+        for fragment in fragments:
+            part += 1
+            yield fragment
+
+TEXT_SPLITTER_NAMES = ("legacy", "sentence", "chapters")
+
+def resolve_text_splitter(progress, file_path=None):
+    """
+    Алгоритм разбивки для книги: TEXT_SPLITTER из окружения, иначе записанный в файле
+    состояния. Книга с прогрессом без такой записи начата прежним алгоритмом — legacy.
+    Новая книга: корректная FB2 — по главам, остальное — по предложениям.
+    """
+    fb2 = bool(file_path) and file_path.lower().endswith(".fb2")
+    if TEXT_SPLITTER in TEXT_SPLITTER_NAMES and (TEXT_SPLITTER != "chapters" or fb2):
+        return TEXT_SPLITTER
+    recorded = progress.data.get("splitter")
+    if recorded in TEXT_SPLITTER_NAMES:
+        return recorded
+    if progress.data["fragments"]:
+        return "legacy"
+    if fb2 and fb2_is_well_formed(file_path):
+        return "chapters"
+    return "sentence"
+
+# ------------------- Ограничение темпа запросов -------------------
+class FreettsHTTPError(RuntimeError):
+    """HTTP 429/5xx от сервиса синтеза — сервер просит сбавить темп."""
+    def __init__(self, status_code, retry_after=None):
+        message = f"HTTP {status_code}"
+        if retry_after is not None:
+            message += f" (Retry-After={retry_after:.0f}s)"
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Заголовок Retry-After: число секунд или HTTP-дата. Возвращает секунды или None."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        now = datetime.datetime.now(when.tzinfo)
+        return max(0.0, (when - now).total_seconds())
+    except Exception:
+        return None
+
+def check_throttled(resp):
+    if resp.status_code == 429 or resp.status_code >= 500:
+        raise FreettsHTTPError(resp.status_code, parse_retry_after(resp.headers.get("Retry-After")))
+
+class StopRequested(Exception):
+    """Запуск останавливается (прерван цикл результатов или пришёл SIGTERM) — рабочему потоку пора выйти."""
+
+# Общий флаг остановки: его проверяют повторы и ожидания темпа/готовности в рабочих потоках
+STOP_REQUESTED = threading.Event()
+
+def sleep_unless_stopped(seconds):
+    """time.sleep, прерываемый STOP_REQUESTED (тогда бросает StopRequested)."""
+    if STOP_REQUESTED.wait(seconds):
+        raise StopRequested()
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket с AIMD-подстройкой темпа, общий для всех рабочих потоков.
+    Успешный ответ добавляет к темпу step, ошибка умножает темп на backoff;
+    Retry-After от сервера приостанавливает все запросы на указанное время.
+    """
+    def __init__(self, rate, min_rate, max_rate, step, backoff, burst=1):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.step = step
+        self.backoff = backoff
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, max_wait=None):
+        """
+        Ждёт разрешения на очередной запрос. С max_wait возвращает False, если ждать
+        (с учётом уже ждущих потоков) пришлось бы дольше.
+        """
+        deadline = time.monotonic() + max_wait if max_wait is not None else None
+        waiting = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0:
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return True
+                        wait = (1 - self._tokens) / self.rate
+                    if deadline is not None and now + wait + (self._waiters - waiting) / self.rate > deadline:
+                        return False
+                    if not waiting:
+                        waiting = True
+                        self._waiters += 1
+                if wait >= 0.5:
+                    log_to_file(f"[DELAY] {wait:.1f} секунд перед запросом")
+                sleep_unless_stopped(wait)
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiters -= 1
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_error(self, retry_after=None):
+        with self._lock:
+            old_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.backoff)
+            # Нельзя «накопить» запросы на старом темпе
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        if self.rate < old_rate:
+            log_to_file(f"[RATE] Темп снижен: {old_rate*60:.1f} -> {self.rate*60:.1f} запросов/мин")
+
+    @property
+    def wait_time(self):
+        """Сколько секунд придётся ждать следующего запроса (пауза или нехватка токенов), без учёта других ждущих."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            token_wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            return max(0.0, self._blocked_until - now, token_wait)
+
+    def pause(self, seconds):
+        """Приостанавливает все запросы на seconds секунд."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def retry_delay(self, attempt, base_delay, retry_after=None):
+        """Пауза перед повтором: Retry-After сервера или экспонента от base_delay со случайным разбросом."""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 1)
+        ceiling = min(RETRY_MAX_DELAY, base_delay * (2 ** (attempt - 1)))
+        return random.uniform(ceiling / 2, ceiling)
+
+RATE_LIMITER = AdaptiveRateLimiter(
+    FREETTS_RATE_INITIAL, FREETTS_RATE_MIN, FREETTS_RATE_MAX,
+    FREETTS_RATE_STEP, FREETTS_RATE_BACKOFF, FREETTS_RATE_BURST
+)
+
+class CircuitOpenError(RuntimeError):
+    """Размыкатель сработал: провайдер раз за разом возвращает одну и ту же ошибку."""
+
+class CircuitBreaker:
+    """
+    Считает фрагменты подряд, не озвученные из-за одной и той же ошибки провайдера.
+    На threshold-м таком фрагменте либо размыкается (mode="abort": дальнейшие запросы
+    бросают CircuitOpenError), либо ставит все запросы провайдера на паузу (mode="pause",
+    через rate_limiter, по умолчанию RATE_LIMITER) — но не более max_pauses раз,
+    после чего тоже размыкается.
+    """
+    def __init__(self, threshold, mode="abort", pause_sec=300, max_pauses=3, rate_limiter=None):
+        self.threshold = threshold
+        self.rate_limiter = rate_limiter
+        self.mode = mode
+        self.pause_sec = pause_sec
+        self.max_pauses = max_pauses
+        self.reason = None
+        self._key = None
+        self._streak = 0
+        self._pauses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.reason is not None
+
+    def check(self):
+        if self.reason is not None:
+            raise CircuitOpenError(self.reason)
+
+    def record_success(self):
+        with self._lock:
+            self._key = None
+            self._streak = 0
+
+    def record_failure(self, key, part_name):
+        if self.threshold <= 0:
+            return
+        pause = False
+        with self._lock:
+            if key == self._key:
+                self._streak += 1
+            else:
+                self._key, self._streak = key, 1
+            if self._streak < self.threshold or self.reason is not None:
+                return
+            if self.mode == "pause" and self._pauses < self.max_pauses:
+                self._pauses += 1
+                # «Полуоткрытое» состояние: ещё одна такая же ошибка — снова пауза
+                self._streak = self.threshold - 1
+                pause = True
+            else:
+                self.reason = f"{self.threshold} фрагментов подряд с ошибкой «{key}» (последний {part_name})"
+        if pause:
+            log_to_file(f"[BREAKER] {self.threshold} фрагментов подряд с ошибкой «{key}». Пауза {self.pause_sec} секунд ({self._pauses}/{self.max_pauses}).")
+            (self.rate_limiter or RATE_LIMITER).pause(self.pause_sec)
+            return
+        log_to_file(f"[BREAKER] Размыкатель сработал: {self.reason}")
+        raise CircuitOpenError(self.reason)
+
+CIRCUIT_BREAKER = CircuitBreaker(
+    FREETTS_BREAKER_THRESHOLD, FREETTS_BREAKER_MODE,
+    FREETTS_BREAKER_PAUSE_SEC, FREETTS_BREAKER_MAX_PAUSES
+)
+
 # ------------------- API TTS (низкоуровневый запрос) -------------------
 def make_freetts_session():
     session = requests.Session()
+    # Сессия общая для всех рабочих потоков — пул соединений не меньше числа потоков
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(10, FREETTS_CONCURRENCY + FREETTS_PENDING_JOBS + 4))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     headers = {
         "User-Agent": "Mozilla/5.0",
         "Accept": "*/*",
@@ -245,27 +1336,9 @@ def make_freetts_session():
     if FREETTS_COOKIE:
         headers["Cookie"] = FREETTS_COOKIE
     session.headers.update(headers)
-    try:
-        warmup = session.get(FREETTS_BASE_URL, timeout=30)
-        log_to_file(f"[FREETTS] warmup_status={warmup.status_code}")
-        if not FREETTS_TOKEN:
-            token = extract_token_from_html(warmup.text)
-            if token:
-                session.headers["token"] = token
-                log_to_file("[FREETTS] token_extracted=1")
-            else:
-                token = extract_token_from_scripts(session, warmup.text)
-                if token:
-                    session.headers["token"] = token
-                    log_to_file("[FREETTS] token_extracted=1")
-    except Exception as e:
-        log_to_file(f"[FREETTS] warmup_error={e}")
     return session
 
-def fetch_freetts_voices(session):
-    resp = session.get(FREETTS_BASE_URL, timeout=30)
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
+def parse_freetts_voices(soup):
     voices = []
     seen = set()
     for el in soup.select('[data-type="voice"][data-id][data-name]'):
@@ -280,10 +1353,7 @@ def fetch_freetts_voices(session):
         voices.append({"id": voice_id, "name": voice_name})
     return voices
 
-def fetch_freetts_langs(session):
-    resp = session.get(FREETTS_BASE_URL, timeout=30)
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
+def parse_freetts_langs(soup):
     langs = []
     seen = set()
     for el in soup.select('[data-type="lang"][data-code][data-name]'):
@@ -298,6 +1368,135 @@ def fetch_freetts_langs(session):
         langs.append({"code": lang_code, "name": lang_name})
     return langs
 
+def parse_freetts_page(html):
+    """
+    Один разбор главной страницы freetts.ru: голоса, языки, токен и ссылки на скрипты
+    (в них ищется токен, если на самой странице его нет).
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    return {
+        "voices": parse_freetts_voices(soup),
+        "langs": parse_freetts_langs(soup),
+        "token": extract_token_from_html(html),
+        "scripts": [script_url_from_src(s.get("src")) for s in soup.find_all("script") if s.get("src")],
+    }
+
+class FreettsSessionCache:
+    """
+    Токен, cookie сессии и адрес скрипта с токеном, сохранённые между запусками
+    в FREETTS_SESSION_CACHE. На тёплом старте они подставляются в сессию без проверки;
+    если сервер ответит status=error, FreettsCatalog.fetch получит их заново и перезапишет файл.
+    """
+    def __init__(self, path=FREETTS_SESSION_CACHE):
+        self.path = path
+        self.token = None
+        self.token_script = None
+
+    def load(self, session):
+        """Подставляет сохранённые токен и cookie в сессию. Возвращает True, если токен есть."""
+        cached = read_json_file(self.path)
+        if not isinstance(cached, dict):
+            return False
+        self.token = cached.get("token")
+        self.token_script = cached.get("token_script")
+        now = time.time()
+        restored = 0
+        for c in cached.get("cookies") or []:
+            if c.get("expires") and c["expires"] < now:
+                continue
+            session.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+            restored += 1
+        if self.token and not FREETTS_TOKEN:
+            session.headers["token"] = self.token
+        log_to_file(f"[FREETTS] Сессия из {self.path}: token_set={bool(self.token)} cookies={restored}")
+        return bool(self.token)
+
+    def save(self, session, token, token_script):
+        self.token = token
+        self.token_script = token_script
+        cookies = [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires}
+            for c in session.cookies
+        ]
+        try:
+            write_json_atomic(self.path, {
+                "token": token,
+                "token_script": token_script,
+                "cookies": cookies,
+                "saved_at": time.time(),
+            })
+        except Exception as e:
+            log_to_file(f"[FREETTS] Не удалось сохранить сессию в {self.path}: {e}")
+
+class FreettsCatalog:
+    """
+    Каталог голосов и языков freetts.ru.
+    Главная страница загружается и разбирается один раз; каталог сохраняется в
+    FREETTS_CATALOG_CACHE и при следующих запусках берётся оттуда, пока не старше
+    FREETTS_CATALOG_TTL_HOURS. Токен и cookie с той же страницы хранит FreettsSessionCache;
+    если оба кэша свежие, озвучка начинается без единого запроса к странице.
+    """
+    def __init__(self, path=FREETTS_CATALOG_CACHE, ttl_hours=FREETTS_CATALOG_TTL_HOURS, session_cache=None):
+        self.path = path
+        self.ttl_sec = ttl_hours * 3600
+        self.session_cache = session_cache or FreettsSessionCache()
+        self.data = {"voices": [], "langs": [], "scripts": []}
+        self.source = None
+
+    @property
+    def voices(self):
+        return self.data.get("voices") or []
+
+    @property
+    def langs(self):
+        return self.data.get("langs") or []
+
+    def load(self, session):
+        """Берёт каталог и сессию из кэша, если они есть и свежие, иначе загружает страницу."""
+        has_token = self.session_cache.load(session) or bool(FREETTS_TOKEN)
+        cached = read_json_file(self.path)
+        if has_token and isinstance(cached, dict) and cached.get("voices"):
+            age = time.time() - float(cached.get("fetched_at") or 0)
+            if 0 <= age < self.ttl_sec:
+                self.data = cached
+                self.source = "cache"
+                log_to_file(f"[FREETTS] Каталог голосов взят из {self.path} (возраст {age / 3600:.1f} ч).")
+                return self
+        return self.fetch(session)
+
+    def fetch(self, session):
+        """
+        Загружает и разбирает главную страницу (заодно обновляет cookie сессии и токен)
+        и перезаписывает оба кэша.
+        """
+        with METRICS.timed("freetts.page"):
+            resp = session.get(FREETTS_BASE_URL, timeout=30)
+        log_to_file(f"[FREETTS] warmup_status={resp.status_code}")
+        resp.raise_for_status()
+        data = parse_freetts_page(resp.text)
+        token = data.pop("token")
+        token_script = None
+        # Токен из окружения важнее найденного на странице
+        if not FREETTS_TOKEN:
+            if not token:
+                started = time.time()
+                token, token_script = extract_token_from_scripts(session, data["scripts"], self.session_cache.token_script)
+                METRICS.observe("freetts.token_crawl", time.time() - started)
+                log_to_file(f"[FREETTS] Поиск токена в {len(data['scripts'])} скриптах: {time.time() - started:.1f} с, найден в {token_script}")
+            if token:
+                session.headers["token"] = token
+                log_to_file("[FREETTS] token_extracted=1")
+        data["fetched_at"] = time.time()
+        self.data = data
+        self.source = "network"
+        self.session_cache.save(session, token, token_script)
+        if data["voices"]:
+            try:
+                write_json_atomic(self.path, data)
+            except Exception as e:
+                log_to_file(f"[FREETTS] Не удалось сохранить каталог в {self.path}: {e}")
+        return self
+
 def choose_voice_id(voices, preferred_name, preferred_id):
     if preferred_id:
         for v in voices:
@@ -386,222 +1585,2068 @@ def find_audio_url_in_json(obj):
                 return found
     return None
 
-def send_request(session, text, voice_id, voice_name, lang_code, lang_name, part_name, timeout=90):
+def read_synthesis_response(resp, part_name):
+    """
+    Разбор ответа синтеза или опроса. Возвращает (вид, значение, content_type):
+     ("audio", bytes, content_type), ("url", ссылка на аудио, None), ("error", сообщение, None),
+     ("pending", JSON или None, None) — аудио ещё нет (None — ответ не JSON).
+    """
+    check_throttled(resp)
+    resp.raise_for_status()
+    content_type = resp.headers.get("Content-Type", "") or ""
+    if "audio" in content_type.lower():
+        return "audio", resp.content, content_type
+    try:
+        data = resp.json()
+    except Exception:
+        return "pending", None, None
+    status, message = extract_status_message(data)
+    if status or message:
+        log_to_file(f"[FREETTS] {part_name} status={status} message={message}")
+    if is_error_status(status):
+        return "error", message, None
+    audio_bytes, content_type = extract_audio_from_data(data)
+    if audio_bytes:
+        return "audio", audio_bytes, content_type
+    audio_url = find_audio_url_in_json(data)
+    if audio_url:
+        return "url", audio_url, None
+    return "pending", data, None
+
+# Поля, в которых сервер может вернуть идентификатор задания синтеза. Общие id/uuid не берём:
+# они бывают у чего угодно, а опрос по ним переключил бы опрос на параметр, которого сервер не знает
+JOB_ID_KEYS = ("job_id", "task_id", "jobId", "taskId")
+
+def extract_job_id(data):
+    """(поле, значение) идентификатора задания из ответа сервера или None."""
+    if not isinstance(data, dict):
+        return None
+    for key in JOB_ID_KEYS:
+        value = data.get(key)
+        if isinstance(value, (str, int)) and not isinstance(value, bool) and str(value):
+            return key, str(value)
+    return extract_job_id(data.get("data"))
+
+class SynthesisJob:
+    """Незавершённое задание синтеза одного фрагмента: всё, что нужно для опроса и скачивания."""
+    def __init__(self, session, payload, part_name, voice_id, voice_name, lang_code, lang_name, job_id=None, timeout=90):
+        self.session = session
+        self.payload = payload
+        self.part_name = part_name
+        self.voice = (voice_id, voice_name, lang_code, lang_name)
+        self.job_id = job_id
+        self.timeout = timeout
+        self.future = Future()
+        self.started = time.monotonic()
+        self.delay = FREETTS_POLL_DELAY
+        self.polls = 0
+
+def finish_synthesis(job, kind, value, content_type):
+    """Итог задания по разобранному ответу: аудио, ошибка или скачивание по ссылке."""
+    if kind == "error":
+        return None, f"error:{value}"
+    if kind == "audio":
+        return value, content_type
+    log_to_file(f"[FREETTS] {job.part_name} audio_url={value}")
+    write_audio_url_log(job.part_name, *job.voice, value)
+    with METRICS.timed("freetts.download"):
+        audio_resp = job.session.get(value, timeout=job.timeout)
+        check_throttled(audio_resp)
+        audio_resp.raise_for_status()
+        audio_bytes = audio_resp.content
+    return audio_bytes, audio_resp.headers.get("Content-Type", "")
+
+def submit_synthesis(session, text, voice_id, voice_name, lang_code, lang_name, part_name, timeout=90):
+    """
+    Отправка фрагмента на синтез. Одновременно отправляется не больше FREETTS_CONCURRENCY
+    запросов (REQUEST_SLOTS). Возвращает (job, kind, value, content_type) для fetch_synthesis
+    или None, если сервер не ответил ничем понятным.
+    """
     payload = {
         "ext": FREETTS_AUDIO_EXT,
         "text": text,
         "voiceid": voice_id,
         "lang": lang_code
     }
-    start_json = None
-    try:
-        resp = session.post(FREETTS_SYNTHESIS_URL, json=payload, timeout=timeout)
-        resp.raise_for_status()
-        if "audio" in (resp.headers.get("Content-Type", "") or "").lower():
-            return resp.content, resp.headers.get("Content-Type", "")
+    with REQUEST_SLOTS:
         try:
-            start_json = resp.json()
+            with METRICS.timed("freetts.submit"):
+                resp = session.post(FREETTS_SYNTHESIS_URL, json=payload, timeout=timeout)
+            kind, value, content_type = read_synthesis_response(resp, part_name)
+        except FreettsHTTPError:
+            raise
         except Exception:
-            start_json = None
-    except Exception:
-        start_json = None
+            kind, value, content_type = "pending", None, None
 
-    if start_json is None:
-        try:
-            resp = session.get(FREETTS_SYNTHESIS_URL, params=payload, timeout=timeout)
-            resp.raise_for_status()
-            if "audio" in (resp.headers.get("Content-Type", "") or "").lower():
-                return resp.content, resp.headers.get("Content-Type", "")
+        if kind == "pending" and value is None:
             try:
-                start_json = resp.json()
+                with METRICS.timed("freetts.submit_get"):
+                    resp = session.get(FREETTS_SYNTHESIS_URL, params=payload, timeout=timeout)
+                kind, value, content_type = read_synthesis_response(resp, part_name)
+            except FreettsHTTPError:
+                raise
             except Exception:
-                return None, None
-        except Exception:
-            return None, None
-
-    status, message = extract_status_message(start_json)
-    if status or message:
-        log_to_file(f"[FREETTS] {part_name} status={status} message={message}")
-    if is_error_status(status):
-        return None, f"error:{message}"
+                return None
+            if kind == "pending" and value is None:
+                return None
 
-    audio_bytes, content_type = extract_audio_from_data(start_json)
-    if audio_bytes:
-        return audio_bytes, content_type
-
-    audio_url = find_audio_url_in_json(start_json)
-    if audio_url:
-        log_to_file(f"[FREETTS] {part_name} audio_url={audio_url}")
-        write_audio_url_log(part_name, voice_id, voice_name, lang_code, lang_name, audio_url)
-        audio_resp = session.get(audio_url, timeout=timeout)
-        audio_resp.raise_for_status()
-        return audio_resp.content, audio_resp.headers.get("Content-Type", "")
-
-    for _ in range(FREETTS_POLL_ATTEMPTS):
-        time.sleep(FREETTS_POLL_DELAY)
-        poll_resp = session.get(FREETTS_SYNTHESIS_URL, params=payload, timeout=timeout)
-        poll_resp.raise_for_status()
-        if "audio" in (poll_resp.headers.get("Content-Type", "") or "").lower():
-            return poll_resp.content, poll_resp.headers.get("Content-Type", "")
-        try:
-            poll_json = poll_resp.json()
-        except Exception:
-            continue
-        status, message = extract_status_message(poll_json)
-        if status or message:
-            log_to_file(f"[FREETTS] {part_name} status={status} message={message}")
-        if is_error_status(status):
-            return None, f"error:{message}"
-
-        audio_bytes, content_type = extract_audio_from_data(poll_json)
-        if audio_bytes:
-            return audio_bytes, content_type
-        audio_url = find_audio_url_in_json(poll_json)
-        if audio_url:
-            log_to_file(f"[FREETTS] {part_name} audio_url={audio_url}")
-            write_audio_url_log(part_name, voice_id, voice_name, lang_code, lang_name, audio_url)
-            audio_resp = session.get(audio_url, timeout=timeout)
-            audio_resp.raise_for_status()
-            return audio_resp.content, audio_resp.headers.get("Content-Type", "")
-    return None, None
+    job = SynthesisJob(session, payload, part_name, voice_id, voice_name, lang_code, lang_name,
+                       extract_job_id(value) if kind == "pending" else None, timeout)
+    return job, kind, value, content_type
 
-# ------------------- Обёртка с повторами -------------------
-def generate_audio_with_retries(session, text, voice_id, voice_name, lang_code, lang_name, part_name, max_attempts=DEFAULT_RETRY_ATTEMPTS, delay=DEFAULT_RETRY_DELAY):
+def fetch_synthesis(submitted):
     """
-    Попытки выполнить send_request до max_attempts c паузой delay (сек) между попытками.
-    Если по завершении попыток не получилось — возвращает (None, None) и сохраняет текст фрагмента в OUTPUT_MP3_DIR как .txt.
+    Итог отправленного фрагмента (audio_bytes, content_type). Если аудио ещё не готово,
+    задание передаётся в SYNTHESIS_JOBS и поток ждёт результата, не занимая слот отправки.
     """
-    last_err = None
-    for attempt in range(1, max_attempts + 1):
+    if submitted is None:
+        return None, None
+    job, kind, value, content_type = submitted
+    if kind == "pending":
+        return SYNTHESIS_JOBS.wait(job)
+    return finish_synthesis(job, kind, value, content_type)
+
+# ------------------- Опрос заданий синтеза -------------------
+class SynthesisJobTracker:
+    """
+    Опрос незавершённых заданий синтеза в одном фоновом потоке вместо sleep в каждом рабочем.
+    Первые два опроса — через FREETTS_POLL_DELAY секунд, каждый следующий интервал в FREETTS_POLL_BACKOFF
+    раз длиннее (не больше FREETTS_POLL_MAX_DELAY) со случайным разбросом ±20%; за один проход
+    опрашиваются все задания, чей срок подошёл. Если сервер вернул id задания, опрос идёт по нему,
+    без повторной отправки текста — но только после того, как такой опрос хоть раз дал аудио, ссылку
+    или понятный статус (poll_by_id=True). Пока этого не было, ответ без них (или ошибка HTTP)
+    означает, что сервер опрос по id не понимает: дальше все опрашиваются полным запросом, как раньше.
+    Готовое аудио скачивается сразу в отдельном пуле, не задерживая опрос остальных.
+    Задание, не готовое за FREETTS_POLL_ATTEMPTS * FREETTS_POLL_DELAY секунд, завершается
+    с (None, None), как прежний цикл опроса; ошибки HTTP передаются ждущему потоку.
+    """
+    def __init__(self, backoff, max_delay, deadline, fetch_threads=4):
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.fetch_threads = fetch_threads
+        # None — опрос по id ещё не подтверждён, True — подтверждён, False — отключён
+        self.poll_by_id = None
+        self.polls = 0
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._fetch_pool = None
+
+    @property
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def wait(self, job):
+        """Ставит задание на опрос и ждёт его итога (audio_bytes, content_type)."""
+        with self._cond:
+            if self._thread is None:
+                self._fetch_pool = ThreadPoolExecutor(max_workers=self.fetch_threads, thread_name_prefix="tts-fetch")
+                self._thread = threading.Thread(target=self._run, name="tts-poll", daemon=True)
+                self._thread.start()
+        log_to_file(f"[POLL] {job.part_name}: аудио ещё не готово, задание {'id=' + job.job_id[1] if job.job_id else 'без id'} поставлено на опрос (в очереди: {self.pending + 1}).")
+        self._schedule(job, job.delay)
+        started = time.monotonic()
         try:
-            log_to_file(f"[RETRY] Попытка {attempt}/{max_attempts} генерации аудио...")
-            audio_bytes, content_type = send_request(session, text, voice_id, voice_name, lang_code, lang_name, part_name)
-            # Проверяем content_type — только аудио принимаем как успех
-            if content_type and ("audio" in content_type.lower()):
-                log_to_file(f"[RETRY] Успех на попытке {attempt} (content_type={content_type}).")
-                return audio_bytes, content_type
+            # Ждём с проверкой STOP_REQUESTED: при остановке запуска задание не дожидаемся
+            while True:
+                try:
+                    return job.future.result(timeout=1.0)
+                except FuturesTimeoutError:
+                    if STOP_REQUESTED.is_set():
+                        raise StopRequested()
+        finally:
+            waited = time.monotonic() - started
+            METRICS.observe("freetts.job_wait", waited)
+            METRICS.add_idle("freetts.job_wait", waited)
+
+    def _schedule(self, job, delay):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, job))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+            for job in due:
+                self._poll(job)
+
+    def _poll(self, job):
+        job.polls += 1
+        self.polls += 1
+        try:
+            with METRICS.timed("freetts.poll"):
+                kind, value, content_type = self._request(job)
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        if kind != "pending":
+            self._fetch_pool.submit(self._finish, job, kind, value, content_type)
+            return
+        if job.polls > 1:
+            job.delay = min(self.max_delay, job.delay * self.backoff)
+        delay = job.delay * random.uniform(0.8, 1.2)
+        if time.monotonic() - job.started + delay > self.deadline:
+            log_to_file(f"[POLL] {job.part_name}: аудио не готово за {time.monotonic() - job.started:.0f} с ({job.polls} опросов).")
+            job.future.set_result((None, None))
+            return
+        self._schedule(job, delay)
+
+    def _request(self, job):
+        if job.job_id and self.poll_by_id is not False:
+            key, value = job.job_id
+            try:
+                result = read_synthesis_response(job.session.get(FREETTS_SYNTHESIS_URL, params={key: value}, timeout=job.timeout), job.part_name)
+            except FreettsHTTPError:
+                raise
+            except requests.HTTPError as e:
+                # Сервер не принимает опрос по id — дальше опрашиваем полным запросом, как раньше
+                self.poll_by_id = False
+                log_to_file(f"[POLL] Опрос по {key} не поддерживается ({e}) — опрос полным запросом.")
             else:
-                last_err = f"Неверный Content-Type: {content_type}"
-                log_to_file(f"[RETRY] Попытка {attempt} вернула некорректный Content-Type: {content_type}")
-                if content_type and str(content_type).startswith("error:"):
-                    break
+                kind, data, _ = result
+                if kind in ("audio", "url") or (kind == "pending" and extract_status_message(data)[0]):
+                    if not self.poll_by_id:
+                        self.poll_by_id = True
+                        log_to_file(f"[POLL] Сервер отвечает на опрос по {key} — текст больше не отправляется повторно.")
+                    return result
+                if self.poll_by_id is None:
+                    # Ни аудио, ни понятного статуса: сервер, похоже, не знает параметра — он проигнорирован
+                    self.poll_by_id = False
+                    log_to_file(f"[POLL] Опрос по {key} не дал ни аудио, ни статуса — опрос полным запросом.")
+        return read_synthesis_response(job.session.get(FREETTS_SYNTHESIS_URL, params=job.payload, timeout=job.timeout), job.part_name)
+
+    def _finish(self, job, kind, value, content_type):
+        try:
+            job.future.set_result(finish_synthesis(job, kind, value, content_type))
         except Exception as e:
-            last_err = str(e)
-            log_to_file(f"[RETRY] Попытка {attempt} — ошибка: {e}")
-        # если не последний — ждем и повторяем
-        if attempt < max_attempts:
-            log_to_file(f"[RETRY] Ждём {delay} секунд перед очередной попыткой...")
-            time.sleep(delay)
-    # если дошли сюда — всё не удалось
-    log_to_file(f"[RETRY] Все {max_attempts} попыток завершились неудачей. Ошибка: {last_err}")
-    return None, None
+            job.future.set_exception(e)
 
-# ------------------- Размеры и индексы -------------------
-def get_total_size_mb(directory):
-    total = sum(os.path.getsize(f) for f in glob.glob(os.path.join(directory, "*.mp3")))
-    return total / (1024 * 1024)
+# Слоты отправки: не больше FREETTS_CONCURRENCY одновременных запросов синтеза (опрос и скачивание — вне слотов)
+REQUEST_SLOTS = threading.BoundedSemaphore(FREETTS_CONCURRENCY)
+SYNTHESIS_JOBS = SynthesisJobTracker(FREETTS_POLL_BACKOFF, FREETTS_POLL_MAX_DELAY, FREETTS_POLL_ATTEMPTS * FREETTS_POLL_DELAY)
 
-def get_last_processed_index_from_log(log_file_path):
-    if not os.path.exists(log_file_path):
-        return 0
-    last_successful_index = 0
-    target_string = "в пределах нормы"
-    try:
-        with open(log_file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                if target_string in line:
-                    match = re.search(r"part_(\d+)\.mp3", line)
-                    if match:
-                        idx = int(match.group(1))
-                        if idx > last_successful_index:
-                            last_successful_index = idx
-        return last_successful_index
-    except Exception:
-        return 0
+# ------------------- Провайдеры синтеза -------------------
+class TTSBackend:
+    """
+    Провайдер синтеза речи. Подкласс задаёт:
+     - prepare() — каталог голосов и выбор голоса; False, если провайдер использовать нельзя;
+     - submit(text, selection, part_name) — отправка фрагмента, fetch(handle) — её итог
+       (audio_bytes, content_type);
+     - cache_key(text, selection) — ключ SynthesisCache.
+    Выбор голоса — кортеж (voice_id, voice_name, lang_code, lang_name). Ограничения провайдера —
+    свои темп (rate_limiter), размыкатель (breaker) и число одновременных запросов (concurrency,
+    плюс pending_jobs фрагментов, ждущих готовности на сервере).
+    """
+    name = None
 
-def get_highest_part_index_on_disk():
-    parts = glob.glob(os.path.join(OUTPUT_MP3_DIR, "part_*.mp3"))
-    max_idx = 0
-    for p in parts:
+    def __init__(self, rate_limiter, breaker, concurrency=1, pending_jobs=0):
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.concurrency = concurrency
+        self.pending_jobs = pending_jobs
+        self.selection = None
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        raise NotImplementedError
+
+    def submit(self, text, selection, part_name):
+        raise NotImplementedError
+
+    def fetch(self, handle):
+        return handle
+
+    def synthesize(self, text, selection, part_name):
+        return self.fetch(self.submit(text, selection, part_name))
+
+    def current_selection(self):
+        with self._lock:
+            return self.selection
+
+    def on_rejected(self, voice_id, lang_code):
+        """Сервер отверг голос: новый выбор для повтора или None, если повторять бессмысленно."""
+        return None
+
+    def cache_key(self, text, selection):
+        return synthesis_cache_key(text, selection[0], selection[2])
+
+class FreettsBackend(TTSBackend):
+    """freetts.ru: каталог голосов со страницы сайта, асинхронные задания с опросом (SYNTHESIS_JOBS)."""
+    name = "freetts"
+
+    def __init__(self):
+        super().__init__(RATE_LIMITER, CIRCUIT_BREAKER, FREETTS_CONCURRENCY, FREETTS_PENDING_JOBS)
+        self.session = make_freetts_session()
+        self.catalog = FreettsCatalog()
+        self._refreshed = False
+
+    def report_catalog(self):
+        voices, langs = self.catalog.voices, self.catalog.langs
+        VOICES_DATA["voices"] = [v["name"] for v in voices]
+        LANGS_DATA["langs"] = [l["name"] for l in langs]
+        if voices:
+            voice_list_text = ", ".join([f"{v['name']}({v['id']})" for v in voices])
+            print(f"Доступные голоса: {voice_list_text}")
+            log_to_file(f"Доступные голоса: {voice_list_text}")
+        else:
+            print("Список голосов пуст.")
+            log_to_file("Список голосов пуст.")
+        if langs:
+            lang_list_text = ", ".join([f"{l['name']}({l['code']})" for l in langs])
+            print(f"Доступные языки: {lang_list_text}")
+            log_to_file(f"Доступные языки: {lang_list_text}")
+        else:
+            print("Список языков пуст.")
+            log_to_file("Список языков пуст.")
+        if not voices or not langs:
+            log_to_file(f"[FREETTS] env voice_id={FREETTS_VOICE_ID} fallback_voice_id={FREETTS_FALLBACK_VOICE_ID} lang_code={FREETTS_LANG_CODE} fallback_lang_code={FREETTS_FALLBACK_LANG_CODE} cookie_set={bool(FREETTS_COOKIE)} token_set={bool(FREETTS_TOKEN)}")
+
+    def prepare(self):
+        try:
+            self.catalog.load(self.session)
+        except Exception as e:
+            print(f"Не удалось получить список голосов и языков: {e}")
+            log_to_file(f"Не удалось получить список голосов и языков: {e}")
+            log_to_file(f"[FREETTS] warmup_error={e}")
+
+        self.report_catalog()
+        voice_id, voice_name = choose_voice_id(self.catalog.voices, VOICE_NAME, FREETTS_VOICE_ID)
+        if not voice_id:
+            print("Не выбран voice_id для freetts.ru")
+            log_to_file("Не выбран voice_id для freetts.ru")
+            return False
+
+        lang_code, lang_name = choose_lang_code(self.catalog.langs, LANG_NAME, FREETTS_LANG_CODE)
+        if not lang_code:
+            print("Не выбран язык для freetts.ru")
+            log_to_file("Не выбран язык для freetts.ru")
+            return False
+
+        print(f"Выбран голос: {voice_name} ({voice_id})")
+        log_to_file(f"Выбран голос: {voice_name} ({voice_id})")
+        print(f"Выбран язык: {lang_name} ({lang_code})")
+        log_to_file(f"Выбран язык: {lang_name} ({lang_code})")
+        self.selection = (voice_id, voice_name, lang_code, lang_name)
+        return True
+
+    def submit(self, text, selection, part_name):
+        return submit_synthesis(self.session, text, *selection, part_name)
+
+    def fetch(self, handle):
+        return fetch_synthesis(handle)
+
+    def on_rejected(self, used_voice_id, used_lang_code):
+        """
+        Сервер ответил status=error. Каталог мог устареть (голос убрали или сменили id,
+        истёк токен), поэтому один раз за запуск перечитываем страницу и выбираем голос заново.
+        """
+        with self._lock:
+            refreshed_now = False
+            if not self._refreshed:
+                self._refreshed = True
+                log_to_file(f"[FREETTS] Сервер отклонил запрос (голос {used_voice_id}, язык {used_lang_code}) — обновляем каталог голосов.")
+                try:
+                    self.catalog.fetch(self.session)
+                    refreshed_now = True
+                except Exception as e:
+                    log_to_file(f"[FREETTS] Не удалось обновить каталог: {e}")
+                if refreshed_now:
+                    self.report_catalog()
+                    voice_id, voice_name = choose_voice_id(self.catalog.voices, VOICE_NAME, FREETTS_VOICE_ID)
+                    lang_code, lang_name = choose_lang_code(self.catalog.langs, LANG_NAME, FREETTS_LANG_CODE)
+                    self.selection = (voice_id, voice_name, lang_code, lang_name)
+                    log_to_file(f"Выбран голос: {voice_name} ({voice_id}), язык: {lang_name} ({lang_code})")
+            new_voice_id, _, new_lang_code, _ = self.selection
+            if not new_voice_id or not new_lang_code:
+                return None
+            if refreshed_now or (new_voice_id, new_lang_code) != (used_voice_id, used_lang_code):
+                return self.selection
+            return None
+
+def format_vibe_prompt(vibe_name, vibes_data=OPENAIFM_VIBES):
+    vibe_content = vibes_data.get(vibe_name)
+    if vibe_content:
+        return "\n\n".join(vibe_content)
+    log_to_file(f"[OPENAI_FM] Характер «{vibe_name}» не найден, используется стандартный промпт.")
+    return "Voice Affect: Calm, composed, and reassuring."
+
+class OpenaiFmBackend(TTSBackend):
+    """
+    openai.fm (как в tts_batch(old).py): один синхронный multipart-запрос, в ответ — WAV
+    (его перекодирует iter_transcoded_results). Голос и характер (vibe) — OPENAIFM_VOICE,
+    OPENAIFM_VIBE; в выборе голоса характер стоит на месте языка.
+    """
+    name = "openai_fm"
+    boundary = "----WebKitFormBoundarya027BOtfh6crFn7A"
+
+    def __init__(self):
+        rate_limiter = AdaptiveRateLimiter(
+            1.0 / OPENAIFM_REQUEST_DELAY if OPENAIFM_REQUEST_DELAY > 0 else 1.0, FREETTS_RATE_MIN, FREETTS_RATE_MAX,
+            FREETTS_RATE_STEP, FREETTS_RATE_BACKOFF
+        )
+        breaker = CircuitBreaker(
+            FREETTS_BREAKER_THRESHOLD, FREETTS_BREAKER_MODE,
+            FREETTS_BREAKER_PAUSE_SEC, FREETTS_BREAKER_MAX_PAUSES, rate_limiter=rate_limiter
+        )
+        super().__init__(rate_limiter, breaker, OPENAIFM_CONCURRENCY)
+        self.slots = threading.BoundedSemaphore(OPENAIFM_CONCURRENCY)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(4, OPENAIFM_CONCURRENCY + 2))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "Mozilla/5.0"
+        self.prompt = None
+
+    def prepare(self):
+        voice = next((v for v in OPENAIFM_VOICES if v.lower() == OPENAIFM_VOICE.lower()), None)
+        if voice is None:
+            log_to_file(f"[OPENAI_FM] Голоса {OPENAIFM_VOICE} нет в списке {', '.join(OPENAIFM_VOICES)} — отправляем как есть.")
+            voice = OPENAIFM_VOICE
+        self.prompt = format_vibe_prompt(OPENAIFM_VIBE)
+        self.selection = (voice.lower(), voice, OPENAIFM_VIBE, OPENAIFM_VIBE)
+        print(f"openai.fm: голос {voice}, характер {OPENAIFM_VIBE}")
+        log_to_file(f"[OPENAI_FM] Выбран голос: {voice}, характер: {OPENAIFM_VIBE}")
+        return True
+
+    def submit(self, text, selection, part_name, timeout=90):
+        voice_id, _, vibe_name, _ = selection
+        prompt = self.prompt if vibe_name == OPENAIFM_VIBE else format_vibe_prompt(vibe_name)
+        data = [
+            f"--{self.boundary}", f'Content-Disposition: form-data; name="input"\r\n\r\n{text}',
+            f"--{self.boundary}", f'Content-Disposition: form-data; name="prompt"\r\n\r\n{prompt}',
+            f"--{self.boundary}", f'Content-Disposition: form-data; name="voice"\r\n\r\n{voice_id}',
+            f"--{self.boundary}", f'Content-Disposition: form-data; name="vibe"\r\n\r\nnull',
+            f"--{self.boundary}--"
+        ]
+        headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+        with self.slots, METRICS.timed("openai_fm.request"):
+            resp = self.session.post(OPENAIFM_URL, headers=headers, data="\r\n".join(data).encode("utf-8"), timeout=timeout)
+        check_throttled(resp)
+        resp.raise_for_status()
+        return resp.content, resp.headers.get("Content-Type", "")
+
+    def cache_key(self, text, selection):
+        return synthesis_cache_key(text, f"{self.name}:{selection[0]}", selection[2], self.name)
+
+TTS_BACKEND_CLASSES = {
+    FreettsBackend.name: FreettsBackend,
+    OpenaiFmBackend.name: OpenaiFmBackend,
+}
+
+class BackendScheduler:
+    """
+    Распределяет фрагменты между провайдерами одного голосового профиля пропорционально
+    наблюдаемой скорости: у каждого — скользящее среднее (EWMA) символов в секунду по его
+    последним фрагментам, включая ожидание темпа и повторы; неудача считается нулевой скоростью.
+    Провайдер с разомкнутым размыкателем выводится из работы, приостановленный (Retry-After,
+    пауза размыкателя) и полностью занятый выбираются, только если других нет. Медленному или
+    сбоящему остаётся не меньше min_share от веса лучшего — так видно, когда он восстановится.
+    Если фрагмент не удался у выбранного провайдера (TTS_FAILOVER_ATTEMPTS попыток или ожидание
+    темпа дольше TTS_FAILOVER_WAIT_SEC), он пробуется у остальных по убыванию веса.
+    """
+    def __init__(self, backends, alpha=0.3, min_share=0.05):
+        self.backends = list(backends)
+        self.alpha = alpha
+        self.min_share = min_share
+        self.speed = {b.name: None for b in self.backends}
+        self.stats = {b.name: {"ok": 0, "failed": 0, "chars": 0} for b in self.backends}
+        self._busy = {b.name: 0 for b in self.backends}
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self):
+        return sum(b.concurrency for b in self.backends)
+
+    @property
+    def pending_jobs(self):
+        return sum(b.pending_jobs for b in self.backends)
+
+    def weights(self, backends):
+        with self._lock:
+            known = [self.speed[b.name] for b in backends if self.speed[b.name] is not None]
+            # Ещё не измеренный провайдер получает вес лучшего, чтобы его скорость стала известна
+            top = max(known, default=0) or 1.0
+            return [max(self.speed[b.name] if self.speed[b.name] is not None else top, top * self.min_share) for b in backends]
+
+    def order(self, exclude=()):
+        """Провайдеры для очередного фрагмента: первый выбран случайно с весом по скорости, остальные — по убыванию веса."""
+        candidates = [b for b in self.backends if not b.breaker.is_open and b not in exclude]
+        if len(candidates) <= 1:
+            return candidates
+        with self._lock:
+            free = [b for b in candidates if self._busy[b.name] < b.concurrency + b.pending_jobs]
+        ready = [b for b in free if b.rate_limiter.wait_time < 1] or free or candidates
+        first = random.choices(ready, weights=self.weights(ready))[0]
+        rest = [b for _, b in sorted(zip(self.weights(candidates), candidates), key=lambda pair: -pair[0]) if b is not first]
+        return [first] + rest
+
+    def record(self, backend, chars, elapsed, ok):
+        sample = chars / max(elapsed, 0.001) if ok else 0.0
+        with self._lock:
+            old = self.speed[backend.name]
+            self.speed[backend.name] = sample if old is None else old + self.alpha * (sample - old)
+            stats = self.stats[backend.name]
+            stats["ok" if ok else "failed"] += 1
+            if ok:
+                stats["chars"] += chars
+
+    def synthesize(self, text, part_name, max_attempts, delay):
+        """
+        Озвучивает фрагмент у первого подходящего провайдера, при неудаче — у следующих.
+        Возвращает (audio_bytes, content_type, backend, selection) или (None, None, None, None).
+        CircuitOpenError бросается, только когда разомкнуты размыкатели всех провайдеров.
+        """
+        single = len(self.backends) == 1
+        tried = []
+        while True:
+            candidates = self.order(exclude=tried)
+            if not candidates:
+                break
+            backend = candidates[0]
+            # Последний из оставшихся провайдеров пробует фрагмент в полную силу, как единственный
+            last = len(candidates) == 1
+            attempts = max_attempts if last else min(max_attempts, TTS_FAILOVER_ATTEMPTS)
+            tried.append(backend)
+            if len(tried) > 1:
+                METRICS.count("failover")
+                log_to_file(f"[BACKEND] {part_name}: пробуем {backend.name}.")
+            # Голос мог смениться по ходу попыток (on_rejected) — ключ кэша и повторы идут с итоговым
+            used = {"selection": backend.current_selection()}
+            def track_rejected(rejected_voice_id, rejected_lang_code, backend=backend, used=used):
+                selection = backend.on_rejected(rejected_voice_id, rejected_lang_code)
+                if selection:
+                    used["selection"] = selection
+                return selection
+
+            with self._lock:
+                self._busy[backend.name] += 1
+            started = time.monotonic()
+            try:
+                audio_bytes, content_type = generate_audio_with_retries(
+                    backend, text, used["selection"], part_name,
+                    max_attempts=attempts, delay=delay, on_rejected=track_rejected,
+                    max_wait=None if last else TTS_FAILOVER_WAIT_SEC
+                )
+            except CircuitOpenError as e:
+                if single:
+                    raise
+                log_to_file(f"[BACKEND] {backend.name} выведен из работы: {e}")
+                audio_bytes, content_type = None, None
+            finally:
+                with self._lock:
+                    self._busy[backend.name] -= 1
+            self.record(backend, len(text), time.monotonic() - started, audio_bytes is not None)
+            if audio_bytes is not None:
+                return audio_bytes, content_type, backend, used["selection"]
+        if all(b.breaker.is_open for b in self.backends):
+            raise CircuitOpenError("; ".join(f"{b.name}: {b.breaker.reason}" for b in self.backends))
+        return None, None, None, None
+
+    def summary(self):
+        with self._lock:
+            return ", ".join(
+                f"{b.name}: {self.stats[b.name]['ok']} ок / {self.stats[b.name]['failed']} неудач, "
+                f"{(self.speed[b.name] or 0):.0f} симв/с{' (выведен)' if b.breaker.is_open else ''}"
+                for b in self.backends
+            )
+
+# ------------------- Обёртка с повторами -------------------
+def generate_audio_with_retries(backend, text, selection, part_name, max_attempts=DEFAULT_RETRY_ATTEMPTS, delay=DEFAULT_RETRY_DELAY, on_rejected=None, max_wait=None):
+    """
+    Попытки озвучить фрагмент у провайдера backend (TTSBackend) с голосом selection до max_attempts.
+    Каждый запрос проходит через backend.rate_limiter, пауза между попытками растёт от delay (сек)
+    с разбросом или берётся из Retry-After.
+    Ответ status=error обычно не лечится повтором: если передан on_rejected(voice_id, lang_code)
+    и он вернул новый выбор (voice_id, voice_name, lang_code, lang_name), попытки продолжаются с ним.
+    Если по завершении попыток не получилось — возвращает (None, None) и сохраняет текст фрагмента в OUTPUT_MP3_DIR как .txt.
+    Если задан max_wait и перед запросом пришлось бы ждать дольше (пауза плюс темп провайдера),
+    попытки прекращаются досрочно — фрагмент отдадут другому провайдеру.
+    Неудача учитывается в backend.breaker; если он разомкнут — бросает CircuitOpenError.
+    При STOP_REQUESTED попытки и паузы прекращаются с StopRequested.
+    Время каждой попытки, ожидание темпа и пауз и исход попытки учитываются в METRICS.
+    """
+    rate_limiter, breaker = backend.rate_limiter, backend.breaker
+    name = backend.name
+    voice_id, voice_name, lang_code, lang_name = selection
+    last_err = None
+    last_key = None
+    for attempt in range(1, max_attempts + 1):
+        if STOP_REQUESTED.is_set():
+            raise StopRequested()
+        breaker.check()
+        retry_after = None
+        outcome = "error"
+        attempt_started = None
+        if attempt > 1:
+            METRICS.count(f"{name}.retry")
+        try:
+            log_to_file(f"[RETRY] Попытка {attempt}/{max_attempts} генерации аудио...")
+            wait_started = time.monotonic()
+            acquired = rate_limiter.acquire(max_wait)
+            METRICS.add_idle(f"{name}.rate_limit", time.monotonic() - wait_started)
+            if not acquired:
+                log_to_file(f"[RETRY] Темп {backend.name} требует ждать больше {max_wait:.0f} секунд — передаём {part_name} другому провайдеру.")
+                if last_key is None:
+                    # Запрос так и не ушёл — размыкателю учитывать нечего
+                    return None, None
+                break
+            attempt_started = time.monotonic()
+            audio_bytes, content_type = backend.synthesize(text, (voice_id, voice_name, lang_code, lang_name), part_name)
+            # Проверяем content_type — только аудио принимаем как успех
+            if content_type and ("audio" in content_type.lower()):
+                outcome = "ok"
+                METRICS.add_bytes(f"{name}.received", len(audio_bytes or b""))
+                rate_limiter.on_success()
+                breaker.record_success()
+                log_to_file(f"[RETRY] Успех на попытке {attempt} (content_type={content_type}).")
+                return audio_bytes, content_type
+            else:
+                rate_limiter.on_error()
+                outcome = "no_audio"
+                last_err = f"Неверный Content-Type: {content_type}"
+                last_key = str(content_type)
+                log_to_file(f"[RETRY] Попытка {attempt} вернула некорректный Content-Type: {content_type}")
+                if content_type and str(content_type).startswith("error:"):
+                    outcome = "rejected"
+                    last_key = str(content_type)[len("error:"):]
+                    selection = on_rejected(voice_id, lang_code) if on_rejected else None
+                    if not selection:
+                        break
+                    voice_id, voice_name, lang_code, lang_name = selection
+                    log_to_file(f"[RETRY] Повтор {part_name} с голосом {voice_name} ({voice_id}), язык {lang_name} ({lang_code}).")
+        except FreettsHTTPError as e:
+            outcome = f"http_{e.status_code}"
+            retry_after = e.retry_after
+            rate_limiter.on_error(retry_after)
+            last_err = str(e)
+            last_key = f"HTTP {e.status_code}"
+            log_to_file(f"[RETRY] Попытка {attempt} — сервер ограничивает запросы: {e}")
+        except StopRequested:
+            raise
+        except Exception as e:
+            rate_limiter.on_error()
+            last_err = str(e)
+            last_key = type(e).__name__
+            log_to_file(f"[RETRY] Попытка {attempt} — ошибка: {e}")
+        finally:
+            # Попытки, до которых запрос не дошёл (темп провайдера), не учитываются
+            if attempt_started is not None:
+                METRICS.observe(f"{name}.attempt", time.monotonic() - attempt_started)
+                METRICS.count(f"{name}.attempt.{outcome}")
+        # если не последний — ждем и повторяем
+        if attempt < max_attempts:
+            pause = rate_limiter.retry_delay(attempt, delay, retry_after)
+            if max_wait is not None and pause + rate_limiter.wait_time > max_wait:
+                log_to_file(f"[RETRY] До следующей попытки больше {max_wait:.0f} секунд — передаём {part_name} другому провайдеру.")
+                break
+            log_to_file(f"[RETRY] Ждём {pause:.1f} секунд перед очередной попыткой...")
+            sleep_unless_stopped(pause)
+            METRICS.add_idle(f"{name}.retry_sleep", pause)
+    # если дошли сюда — всё не удалось
+    METRICS.count(f"{name}.fragment_failed")
+    log_to_file(f"[RETRY] Все {max_attempts} попыток завершились неудачей. Ошибка: {last_err}")
+    breaker.record_failure(last_key, part_name)
+    return None, None
+
+# ------------------- Кэш синтеза -------------------
+def normalize_fragment_text(text):
+    """Текст фрагмента для ключа кэша: NFC и схлопнутые пробелы, чтобы разбивка не меняла ключ."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def synthesis_cache_key(text, voice_id, lang_code, ext=None):
+    material = "\0".join([normalize_fragment_text(text), str(voice_id), str(lang_code), ext or FREETTS_AUDIO_EXT])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def audio_ext_for(content_type):
+    return "wav" if "wav" in (content_type or "").lower() else "mp3"
+
+def content_type_for_ext(ext):
+    return "audio/wav" if ext == "wav" else "audio/mpeg"
+
+def is_cacheable_audio(audio_bytes, content_type):
+    """В кэш не кладём то, что основной цикл всё равно отбросит по размеру."""
+    if not audio_bytes:
+        return False
+    if audio_ext_for(content_type) == "mp3":
+        return MIN_SIZE_KB < len(audio_bytes) // 1024 < MAX_SIZE_KB
+    return True
+
+class SynthesisCache:
+    """
+    Кэш готового аудио по содержимому: ключ — SHA-256 от нормализованного текста,
+    voice_id, lang_code и FREETTS_AUDIO_EXT. Повторяющиеся фрагменты (заголовки глав)
+    и повторные прогоны книги не тратят запросов к API.
+     - Локально: TTS_AUDIO_CACHE_DIR/<2 символа>/<ключ>.<mp3|wav>, не больше max_bytes;
+       при переполнении удаляются давно не использованные записи (время — mtime файла).
+     - На B2 (если b2=True): <prefix><ключ>; промах локально проверяется в бакете,
+       новое аудио дублируется туда. Ошибки B2 только пишутся в лог.
+    Методы потокобезопасны.
+    """
+    def __init__(self, directory=TTS_AUDIO_CACHE_DIR, max_bytes=int(TTS_AUDIO_CACHE_MB * 1024 * 1024), b2=False, prefix=TTS_AUDIO_CACHE_B2_PREFIX):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # ключ -> (путь, размер) в порядке от давно использованных к недавним
+        self._entries = collections.OrderedDict()
+        self._total = 0
+        self._b2 = None
+        self._b2_enabled = b2
+        self._b2_lock = threading.Lock()
+        self._b2_local = threading.local()
+        if self.max_bytes > 0:
+            self._scan()
+
+    @property
+    def count(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._total
+
+    def _scan(self):
+        found = []
+        if os.path.isdir(self.directory):
+            for sub in os.scandir(self.directory):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    key, _, ext = entry.name.partition(".")
+                    if entry.is_file() and ext in ("mp3", "wav"):
+                        st = entry.stat()
+                        found.append((st.st_mtime, key, entry.path, st.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._total += size
+        self._evict()
+
+    def _evict(self):
+        while self._total > self.max_bytes and self._entries:
+            _, (path, size) = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+
+    def get(self, key):
+        """(audio_bytes, content_type) из кэша или (None, None)."""
+        return self.get_any([key])[1:]
+
+    def get_any(self, keys):
+        """Первое найденное по нескольким ключам (провайдеры одного голоса): (key, audio_bytes, content_type) или (None, None, None)."""
+        found = (None, None, None)
+        for key in keys:
+            audio_bytes, content_type = self._get_local(key)
+            if audio_bytes is not None:
+                found = (key, audio_bytes, content_type)
+                break
+        if found[1] is None and self._b2_enabled:
+            for key in keys:
+                audio_bytes, content_type = self._get_b2(key)
+                if audio_bytes is not None:
+                    self._put_local(key, audio_bytes, content_type)
+                    found = (key, audio_bytes, content_type)
+                    break
+        with self._lock:
+            if found[1] is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return found
+
+    def put(self, key, audio_bytes, content_type):
+        if not is_cacheable_audio(audio_bytes, content_type):
+            return
+        self._put_local(key, audio_bytes, content_type)
+        if self._b2_enabled:
+            self._put_b2(key, audio_bytes, content_type)
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            self._entries.move_to_end(key)
+        path = entry[0]
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except Exception:
+            with self._lock:
+                if self._entries.pop(key, None):
+                    self._total -= entry[1]
+            return None, None
+        return data, content_type_for_ext(os.path.splitext(path)[1].lstrip("."))
+
+    def _put_local(self, key, audio_bytes, content_type):
+        if self.max_bytes <= 0 or len(audio_bytes) > self.max_bytes:
+            return
+        path = os.path.join(self.directory, key[:2], f"{key}.{audio_ext_for(content_type)}")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(audio_bytes)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            log_to_file(f"[CACHE] Не удалось сохранить {path}: {e}")
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._total -= old[1]
+            self._entries[key] = (path, len(audio_bytes))
+            self._total += len(audio_bytes)
+            self._evict()
+
+    def _b2_auth(self, refresh=False):
+        """Авторизация B2 (одна на все потоки). None — B2 не настроен или недоступен."""
+        with self._b2_lock:
+            if self._b2 is not None and not refresh:
+                return self._b2
+            creds = b2_credentials()
+            if not creds:
+                log_to_file("[CACHE] B2 не настроен — кэш аудио только локальный.")
+                self._b2_enabled = False
+                return None
+            key_id, app_key, bucket_id = creds
+            try:
+                auth = b2_authorize(key_id, app_key)
+            except Exception as e:
+                log_to_file(f"[CACHE] Авторизация B2 для кэша аудио не удалась: {e}")
+                self._b2_enabled = False
+                return None
+            bucket_name = os.environ.get("B2_BUCKET_NAME") or (auth.get("allowed") or {}).get("bucketName")
+            if not bucket_name:
+                log_to_file("[CACHE] Не задан B2_BUCKET_NAME — кэш аудио только локальный.")
+                self._b2_enabled = False
+                return None
+            self._b2 = {"auth": auth, "bucket_id": bucket_id, "bucket_name": bucket_name}
+            self._b2_local = threading.local()
+            return self._b2
+
+    def _get_b2(self, key):
+        b2 = self._b2_auth()
+        if b2 is None:
+            return None, None
+        url = f"{b2['auth']['downloadUrl'].rstrip('/')}/file/{b2['bucket_name']}/{self.prefix}{key}"
+        try:
+            resp = requests.get(url, headers={"Authorization": b2["auth"]["authorizationToken"]}, timeout=60)
+            if resp.status_code == 404:
+                return None, None
+            resp.raise_for_status()
+            return resp.content, resp.headers.get("Content-Type") or content_type_for_ext(FREETTS_AUDIO_EXT)
+        except Exception as e:
+            log_to_file(f"[CACHE] Ошибка чтения {self.prefix}{key} с B2: {e}")
+            return None, None
+
+    def _put_b2(self, key, audio_bytes, content_type):
+        sha1 = hashlib.sha1(audio_bytes).hexdigest()
+        for attempt in range(2):
+            b2 = self._b2_auth(refresh=attempt > 0)
+            if b2 is None:
+                return
+            try:
+                # URL загрузки B2 нельзя делить между потоками — у каждого свой
+                upload = getattr(self._b2_local, "upload", None)
+                if upload is None:
+                    upload = b2_get_upload_url(b2["auth"]["apiUrl"], b2["auth"]["authorizationToken"], b2["bucket_id"])
+                    self._b2_local.upload = upload
+                b2_upload_bytes(upload["uploadUrl"], upload["authorizationToken"], audio_bytes, self.prefix + key, sha1, content_type=content_type_for_ext(audio_ext_for(content_type)))
+                return
+            except Exception as e:
+                self._b2_local.upload = None
+                log_to_file(f"[CACHE] Ошибка записи {self.prefix}{key} на B2 (попытка {attempt + 1}): {e}")
+
+def make_synthesis_cache():
+    """Кэш синтеза по настройкам окружения или None, если он выключен."""
+    if TTS_AUDIO_CACHE_MB <= 0 and not TTS_AUDIO_CACHE_B2:
+        return None
+    return SynthesisCache(b2=TTS_AUDIO_CACHE_B2)
+
+# ------------------- Параллельная генерация -------------------
+def check_audio(validator, audio_bytes, content_type, chars):
+    with METRICS.timed("validate"):
+        return validator.check(audio_bytes, content_type, chars)
+
+def synthesize_fragment(scheduler, idx, chunk, max_attempts, delay, cache=None, validator=None):
+    """
+    Генерирует аудио одного фрагмента (выполняется в рабочем потоке).
+    Провайдера выбирает scheduler (BackendScheduler); темп запросов у каждого провайдера общий для всех потоков.
+    Если передан cache (SynthesisCache), сначала ищет готовое аудио в нём (под голосом любого
+    из провайдеров), а полученное кладёт туда.
+    Если передан validator (AudioValidator), негодный ответ сразу запрашивается заново
+    (до TTS_VALIDATE_RETRIES раз) и в кэш не попадает.
+    Возвращает (audio_bytes, content_type) как generate_audio_with_retries;
+    аудио, так и не прошедшее проверку, — (None, "invalid-audio:<причина>").
+    """
+    base_name = f"part_{idx+1:04}"
+    if cache is not None:
+        keys = [b.cache_key(chunk, b.current_selection()) for b in scheduler.backends]
+        with METRICS.timed("cache.lookup"):
+            key, audio_bytes, content_type = cache.get_any(keys)
+        if audio_bytes is not None:
+            verdict = check_audio(validator, audio_bytes, content_type, len(chunk)) if validator else None
+            if verdict is None or verdict["ok"]:
+                print(f"{base_name}: аудио из кэша ({len(audio_bytes) // 1024} КБ).")
+                log_to_file(f"[CACHE] {base_name} взят из кэша (key={key[:16]}, {len(audio_bytes)} байт).")
+                return audio_bytes, content_type
+            log_to_file(f"[VALIDATE] {base_name} из кэша не прошёл проверку ({verdict['reason']}) — запрашиваем заново.")
+
+    checks = TTS_VALIDATE_RETRIES + 1 if validator else 1
+    for check in range(1, checks + 1):
+        print(f"Генерация {base_name}: {len(chunk)} символов.")
+        audio_bytes, content_type, backend, selection = scheduler.synthesize(chunk, base_name, max_attempts, delay)
+        if audio_bytes is None or validator is None:
+            break
+        verdict = check_audio(validator, audio_bytes, content_type, len(chunk))
+        if verdict["ok"]:
+            break
+        METRICS.count("validate.rejected")
+        log_to_file(f"[VALIDATE] {base_name}: {verdict['reason']} (проверка {check}/{checks}, {backend.name}).")
+        if check == checks:
+            return None, f"invalid-audio:{verdict['reason']}"
+    if audio_bytes is not None and cache is not None:
+        cache.put(backend.cache_key(chunk, selection), audio_bytes, content_type)
+    return audio_bytes, content_type
+
+def iter_synthesis_results(work_items, synthesize, concurrency=1, pending_jobs=0):
+    """
+    Прогоняет work_items [(idx, chunk), ...] через synthesize(idx, chunk) и
+    отдаёт (idx, chunk, audio_bytes, content_type) строго в порядке work_items.
+    В работе одновременно до concurrency + pending_jobs фрагментов: отправку ограничивают
+    слоты провайдеров (у freetts — REQUEST_SLOTS), а ждущие готовности на сервере не мешают
+    отправлять следующие.
+    Готовые результаты ждут своей очереди, чтобы лог и возобновление
+    по-прежнему шли по возрастанию номеров фрагментов.
+    """
+    concurrency += pending_jobs
+    if concurrency <= 1:
+        for idx, chunk in work_items:
+            audio_bytes, content_type = synthesize(idx, chunk)
+            yield idx, chunk, audio_bytes, content_type
+        return
+
+    items = iter(work_items)
+    pending = collections.deque()
+    # Окно опережения: рабочие потоки не простаивают, пока ждём медленный фрагмент
+    window = concurrency * 2
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="tts")
+    try:
+        while True:
+            while len(pending) < window:
+                item = next(items, None)
+                if item is None:
+                    break
+                idx, chunk = item
+                pending.append((idx, chunk, pool.submit(synthesize, idx, chunk)))
+            if not pending:
+                break
+            idx, chunk, future = pending.popleft()
+            audio_bytes, content_type = future.result()
+            yield idx, chunk, audio_bytes, content_type
+    finally:
+        # Если цикл прерван (размыкатель, SIGTERM) — не запускаем уже не нужные запросы,
+        # а идущие повторы прекращаем по STOP_REQUESTED, не дожидаясь их (результат всё равно не нужен)
+        if pending:
+            STOP_REQUESTED.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def stop_on_open_circuit(results, state):
+    """
+    Пропускает результаты iter_synthesis_results, пока не сработал размыкатель.
+    При CircuitOpenError итерация заканчивается, а ошибка сохраняется в state["error"].
+    """
+    try:
+        for item in results:
+            yield item
+    except CircuitOpenError as e:
+        state["error"] = e
+
+# ------------------- Конвертация WAV -> MP3 -------------------
+class TranscodeError(Exception):
+    pass
+
+def transcode_wav_to_mp3(wav_bytes, sample_rate=SAMPLE_RATE_HZ, bitrate=MP3_BITRATE):
+    """WAV (байты) -> MP3 (байты) через ffmpeg по каналам stdin/stdout."""
+    cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-f", "wav", "-i", "pipe:0"]
+    if sample_rate:
+        cmd += ["-ar", str(sample_rate)]
+    cmd += ["-b:a", bitrate, "-f", "mp3", "pipe:1"]
+    try:
+        with METRICS.timed("transcode"):
+            proc = subprocess.run(cmd, input=wav_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise TranscodeError(str(e))
+    if proc.returncode != 0 or not proc.stdout:
+        raise TranscodeError(proc.stderr.decode("utf-8", "replace").strip() or f"ffmpeg код {proc.returncode}")
+    return proc.stdout
+
+def iter_transcoded_results(results, workers=TTS_TRANSCODE_WORKERS, transcode=transcode_wav_to_mp3):
+    """
+    Стадия между синтезом и сохранением: WAV из results уходит на конвертацию в пул
+    (каждая задача — отдельный процесс ffmpeg, поэтому заняты все ядра), а следующий
+    фрагмент тем временем уже синтезируется. Результаты отдаются строго по порядку;
+    WAV заменяется на (mp3_bytes, "audio/mpeg"), ошибка — на (None, "transcode-error:...").
+    """
+    pending = collections.deque()
+    window = workers * 2
+
+    def resolve(entry):
+        idx, chunk, payload = entry
+        if not isinstance(payload, Future):
+            return (idx, chunk) + payload
+        try:
+            return idx, chunk, payload.result(), "audio/mpeg"
+        except Exception as e:
+            return idx, chunk, None, f"transcode-error:{e}"
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ffmpeg") as pool:
+        for idx, chunk, audio_bytes, content_type in results:
+            if audio_bytes is not None and "wav" in (content_type or "").lower():
+                pending.append((idx, chunk, pool.submit(transcode, audio_bytes)))
+            else:
+                pending.append((idx, chunk, (audio_bytes, content_type)))
+            # Готовое отдаём сразу, неготовое ждём, только если окно заполнено
+            while pending and (len(pending) > window or not isinstance(pending[0][2], Future) or pending[0][2].done()):
+                yield resolve(pending.popleft())
+        while pending:
+            yield resolve(pending.popleft())
+
+# ------------------- Разбор MP3 -------------------
+# Битрейты MPEG Layer III, кбит/с: MPEG-1 и MPEG-2/2.5 (индекс 0 — free format, не поддерживается)
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Частоты по полю версии заголовка: 3 — MPEG-1, 2 — MPEG-2, 0 — MPEG-2.5
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def id3v2_size(data):
+    """Длина тега ID3v2 в начале data (0, если тега нет)."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+def mp3_tail_tags_size(data):
+    """Длина тегов в конце файла: ID3v1 (128 байт) и/или APEv2."""
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    if end >= 32 and data[end - 32:end - 24] == b"APETAGEX":
+        size = int.from_bytes(data[end - 20:end - 16], "little")
+        has_header = data[end - 9] & 0x80
+        end -= size + (32 if has_header else 0)
+    return len(data) - max(end, 0)
+
+def parse_mp3_frame_header(data, pos=0):
+    """
+    Заголовок кадра MPEG Layer III в data[pos:pos + 4] -> dict (длина кадра, битрейт,
+    частота, сэмплов в кадре, моно, CRC) или None, если это не заголовок кадра.
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    samples = 1152 if version == 3 else 576
+    return {
+        "version": version,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples": samples,
+        "mono": (b3 >> 6) == 3,
+        "crc": not (b1 & 0x01),
+        "length": samples // 8 * bitrate // sample_rate + ((b2 >> 1) & 0x01),
+    }
+
+def mp3_side_info_size(header):
+    if header["version"] == 3:
+        return 17 if header["mono"] else 32
+    return 9 if header["mono"] else 17
+
+def is_mp3_info_frame(data, pos, header):
+    """Служебный кадр Xing/Info/VBRI в начале файла: метаданные кодировщика, звука в нём нет."""
+    offset = pos + 4 + (2 if header["crc"] else 0) + mp3_side_info_size(header)
+    return data[offset:offset + 4] in (b"Xing", b"Info") or data[pos + 36:pos + 40] == b"VBRI"
+
+def scan_mp3_frames(data):
+    """
+    Проход по кадрам MP3 без декодирования. Пропускает ID3v2 в начале, служебный кадр
+    Xing/Info, теги ID3v1/APE в конце и мусор между кадрами (после сбоя синхронизации
+    заголовок принимается, только если за ним сразу идёт ещё один кадр).
+    Возвращает dict: frames, samples, duration (сек), sample_rate, version, mono,
+    bitrates (множество), junk (пропущено байт), spans — интервалы [начало, конец)
+    звуковых кадров, которые можно склеивать с кадрами других файлов как есть.
+    """
+    pos = id3v2_size(data)
+    end = len(data) - mp3_tail_tags_size(data)
+    result = {"frames": 0, "samples": 0, "duration": 0.0, "sample_rate": None, "version": None,
+              "mono": None, "bitrates": set(), "junk": 0, "spans": []}
+    spans = result["spans"]
+    synced = False
+    first = True
+    while pos + 4 <= end:
+        header = parse_mp3_frame_header(data, pos)
+        next_pos = pos + header["length"] if header else pos
+        ok = header is not None and next_pos <= end
+        if ok and not synced and next_pos + 4 <= end:
+            follow = parse_mp3_frame_header(data, next_pos)
+            ok = follow is not None and follow["sample_rate"] == header["sample_rate"]
+        if not ok:
+            sync = data.find(b"\xff", pos + 1, end)
+            sync = end if sync < 0 else sync
+            result["junk"] += sync - pos
+            pos = sync
+            synced = False
+            continue
+        synced = True
+        if first:
+            first = False
+            if is_mp3_info_frame(data, pos, header):
+                pos = next_pos
+                continue
+        if result["sample_rate"] is None:
+            result.update(sample_rate=header["sample_rate"], version=header["version"], mono=header["mono"])
+        result["frames"] += 1
+        result["samples"] += header["samples"]
+        result["bitrates"].add(header["bitrate"])
+        if spans and spans[-1][1] == pos:
+            spans[-1][1] = next_pos
+        else:
+            spans.append([pos, next_pos])
+        pos = next_pos
+    result["junk"] += max(0, end - pos)
+    if result["sample_rate"]:
+        result["duration"] = result["samples"] / result["sample_rate"]
+    return result
+
+# ------------------- Проверка аудио -------------------
+# Для уровня звука MP3 декодируется в моно 8 кГц — для RMS этого достаточно, а ffmpeg работает быстрее
+VALIDATE_DECODE_RATE = 8000
+# Темп речи калибруется только по частям не короче стольких символов (заголовки глав искажают медиану)
+VALIDATE_CALIBRATION_MIN_CHARS = 200
+
+def read_wav_samples(wav_bytes):
+    """WAV (байты) -> (длительность, сэмплы float32 моно или None без numpy)."""
+    with wave.open(io.BytesIO(wav_bytes), "rb") as w:
+        channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        frames = w.readframes(w.getnframes())
+    duration = len(frames) / float(channels * width * rate)
+    if numpy is None or width != 2:
+        return duration, None
+    samples = numpy.frombuffer(frames[:len(frames) // 2 * 2], dtype="<i2").astype(numpy.float32) / 32768.0
+    return duration, samples[::channels]
+
+def decode_mp3_samples(mp3_bytes, sample_rate=VALIDATE_DECODE_RATE):
+    """MP3 (байты) -> сэмплы float32 моно через ffmpeg по каналам stdin/stdout."""
+    cmd = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+           "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "pipe:1"]
+    proc = subprocess.run(cmd, input=mp3_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+    if not proc.stdout:
+        raise TranscodeError(proc.stderr.decode("utf-8", "replace").strip() or f"ffmpeg код {proc.returncode}")
+    return numpy.frombuffer(proc.stdout[:len(proc.stdout) // 2 * 2], dtype="<i2").astype(numpy.float32) / 32768.0
+
+def audio_levels(samples, sample_rate, window_sec=0.05, silence_dbfs=TTS_SILENCE_DBFS):
+    """(RMS всего звука в дБFS, доля окон по window_sec тише silence_dbfs)."""
+    if not len(samples):
+        return -120.0, 1.0
+    rms_db = 10 * math.log10(max(float(numpy.mean(samples * samples)), 1e-12))
+    n = max(1, int(sample_rate * window_sec))
+    count = len(samples) // n
+    if not count:
+        return rms_db, 0.0 if rms_db >= silence_dbfs else 1.0
+    windows = samples[:count * n].reshape(count, n)
+    window_db = 10 * numpy.log10(numpy.maximum(numpy.mean(windows * windows, axis=1), 1e-12))
+    return rms_db, float(numpy.mean(window_db < silence_dbfs))
+
+class AudioValidator:
+    """
+    Проверка ответа TTS в памяти, до записи на диск и в кэш (вызывается из рабочих потоков):
+     - MP3: размер в пределах MIN_SIZE_KB..MAX_SIZE_KB, кадры разбираются (scan_mp3_frames),
+       мусора не больше 10% — иначе ответ обрезан или повреждён;
+     - длительность по кадрам в пределах TTS_MIN/MAX_DURATION_RATIO от ожидаемой по числу символов;
+     - уровень: RMS декодированного звука и доля тихих окон (ffmpeg + numpy).
+    Ожидаемый темп — медиана секунд на символ по принятым частям книги (поле duration в файле
+    состояния и observe() по ходу запуска), пока их меньше 20 — TTS_CHARS_PER_SEC.
+    При deep=False проверяется только размер, как раньше.
+    """
+    def __init__(self, progress=None, deep=TTS_VALIDATE_AUDIO):
+        self.deep = deep
+        self._rates = collections.deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._levels = deep and numpy is not None
+        if deep and numpy is None:
+            log_to_file("[VALIDATE] numpy не установлен — уровень звука не проверяется.")
+        if progress is not None:
+            for entry in progress.data["fragments"].values():
+                if entry.get("status") == "ok" and entry.get("duration"):
+                    self.observe(entry.get("chars") or 0, entry["duration"])
+
+    def observe(self, chars, duration):
+        """Учитывает принятую часть в темпе речи книги."""
+        if chars >= VALIDATE_CALIBRATION_MIN_CHARS and duration:
+            with self._lock:
+                self._rates.append(duration / chars)
+
+    def expected_duration(self, chars):
+        with self._lock:
+            rates = sorted(self._rates)
+        rate = rates[len(rates) // 2] if len(rates) >= 20 else 1.0 / TTS_CHARS_PER_SEC
+        return chars * rate
+
+    def check_mp3(self, audio_bytes):
+        """
+        Размер MP3 и (при deep) разбор кадров. Возвращает (причина отказа или None, scan или None).
+        Нужна и отдельно: MP3, полученный конвертацией WAV, check() видел ещё как WAV.
+        """
+        size_kb = len(audio_bytes) // 1024
+        if not (MIN_SIZE_KB < size_kb < MAX_SIZE_KB):
+            return f"размер {size_kb} КБ", None
+        if not self.deep:
+            return None, None
+        scan = scan_mp3_frames(audio_bytes)
+        if not scan["frames"]:
+            return "нет кадров MP3", scan
+        if scan["junk"] > len(audio_bytes) * 0.1:
+            return f"повреждённый MP3 ({scan['junk']} байт вне кадров)", scan
+        return None, scan
+
+    def check(self, audio_bytes, content_type, chars):
+        """
+        Возвращает dict: ok, reason (почему не годится), duration и expected (сек),
+        rms_db и silence (доля тихих окон) — None, если уровень не проверялся.
+        """
+        verdict = {"ok": False, "reason": None, "duration": None, "expected": None, "rms_db": None, "silence": None}
+        wav = "wav" in (content_type or "").lower()
+        samples = None
+        if wav:
+            # Размер WAV другой: размер и кадры MP3 после конвертации проверяет main() через check_mp3()
+            try:
+                verdict["duration"], samples = read_wav_samples(audio_bytes)
+            except Exception as e:
+                verdict["reason"] = f"WAV не читается: {e}"
+                return verdict
+        else:
+            verdict["reason"], scan = self.check_mp3(audio_bytes)
+            if verdict["reason"]:
+                return verdict
+            if not self.deep:
+                verdict["ok"] = True
+                return verdict
+            verdict["duration"] = scan["duration"]
+        if not self.deep:
+            verdict["ok"] = True
+            return verdict
+
+        duration = verdict["duration"]
+        expected = verdict["expected"] = self.expected_duration(chars)
+        if duration < expected * TTS_MIN_DURATION_RATIO - 1.0:
+            verdict["reason"] = f"обрезано: {duration:.1f} с при ожидаемых {expected:.1f} с"
+            return verdict
+        if duration > expected * TTS_MAX_DURATION_RATIO + 5.0:
+            verdict["reason"] = f"слишком длинно: {duration:.1f} с при ожидаемых {expected:.1f} с"
+            return verdict
+
+        if self._levels:
+            rate = VALIDATE_DECODE_RATE
+            try:
+                if wav:
+                    with wave.open(io.BytesIO(audio_bytes), "rb") as w:
+                        rate = w.getframerate()
+                else:
+                    samples = decode_mp3_samples(audio_bytes)
+            except OSError as e:
+                # ffmpeg не найден — дальше уровень не проверяем, чтобы не тратить время на каждом фрагменте
+                self._levels = False
+                log_to_file(f"[VALIDATE] ffmpeg недоступен ({e}) — уровень звука не проверяется.")
+            except Exception as e:
+                verdict["reason"] = f"не декодируется: {e}"
+                return verdict
+            if samples is not None:
+                verdict["rms_db"], verdict["silence"] = audio_levels(samples, rate)
+                if verdict["rms_db"] < TTS_SILENCE_DBFS:
+                    verdict["reason"] = f"тишина (RMS {verdict['rms_db']:.0f} дБ)"
+                    return verdict
+                if duration > 3 and verdict["silence"] > TTS_MAX_SILENCE_SHARE:
+                    verdict["reason"] = f"тишина в {verdict['silence'] * 100:.0f}% записи"
+                    return verdict
+        verdict["ok"] = True
+        return verdict
+
+# ------------------- Размеры и индексы -------------------
+def get_total_size_mb(directory):
+    total = sum(os.path.getsize(f) for f in glob.glob(os.path.join(directory, "*.mp3")))
+    return total / (1024 * 1024)
+
+class OutputSizeTracker:
+    """
+    Счётчик байт mp3 в OUTPUT_MP3_DIR без повторного обхода папки после каждого фрагмента.
+    Сверяется с диском один раз при старте (reconcile), дальше обновляется при записи и удалении.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def reconcile(self):
+        total = int(get_total_size_mb(self.directory) * 1024 * 1024)
+        with self._lock:
+            self._bytes = total
+        return total
+
+    @property
+    def total_mb(self):
+        return self._bytes / (1024 * 1024)
+
+    def add(self, size):
+        with self._lock:
+            self._bytes += size
+
+    def remove_file(self, path):
+        """Удаляет файл и вычитает его размер. Возвращает True, если файл удалён."""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except Exception:
+            return False
+        with self._lock:
+            self._bytes = max(0, self._bytes - size)
+        return True
+
+def get_highest_part_index_on_disk(directory=OUTPUT_MP3_DIR):
+    parts = glob.glob(os.path.join(directory, "part_*.mp3"))
+    max_idx = 0
+    for p in parts:
         m = re.search(r"part_(\d+)\.mp3", os.path.basename(p))
         if m:
             max_idx = max(max_idx, int(m.group(1)))
     return max_idx
 
+def get_part_indices_on_disk(directory=OUTPUT_MP3_DIR):
+    indices = []
+    for p in glob.glob(os.path.join(directory, "part_*.mp3")):
+        m = re.search(r"part_(\d+)\.mp3", os.path.basename(p))
+        if m:
+            indices.append(int(m.group(1)))
+    return sorted(indices)
+
+# ------------------- Файл состояния прогресса -------------------
+def progress_journal_path(path):
+    return os.path.splitext(path)[0] + "_journal.jsonl"
+
+def apply_progress_record(data, record):
+    """Применяет к состоянию одну запись журнала: {"mark": номер, "entry": {...}} или {"forget": [номера]}."""
+    if "mark" in record:
+        index = int(record["mark"])
+        data["fragments"][str(index)] = record["entry"]
+        if record["entry"].get("status") == "ok" and index > data.get("last_ok", 0):
+            data["last_ok"] = index
+    for index in record.get("forget", ()):
+        data["fragments"].pop(str(index), None)
+
+def read_progress_file(path):
+    """
+    Файл состояния вместе с ещё не свёрнутым журналом (после прерванного запуска) или None.
+    Оборванная последняя строка журнала пропускается.
+    """
+    data = read_json_file(path)
+    journal = progress_journal_path(path)
+    if not os.path.exists(journal):
+        return data
+    if data is None:
+        data = {"last_ok": 0, "fragments": {}, "batches": []}
+    with open(journal, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                apply_progress_record(data, json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                continue
+    return data
+
+class ProgressStore:
+    """
+    Состояние озвучки книги в PROGRESS_FILE (JSON):
+     - fragments: {"номер": {"status": ok|txt|skipped, "size", "sha1", "chars", "duration", "reason", "batch", "updated"}}
+     - batches: загруженные на B2 архивы (remote_name, fileId, номера частей)
+     - last_ok: наибольший успешно озвученный номер — точка возобновления без чтения логов
+     - splitter, fragment_max_chars: чем разбит текст (номера частей зависят от алгоритма)
+    Изменение фрагмента (mark/forget) — одна строка в журнале progress_journal_path(path), O(1) на фрагмент.
+    Полный файл записывается атомарно (временный файл + os.replace) при выгрузке пачки, смене разбивки,
+    в конце запуска (compact) и каждые PROGRESS_JOURNAL_MAX_LINES записей; тогда журнал очищается.
+    Читать состояние снаружи — через read_progress_file (файл + журнал).
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = progress_journal_path(path)
+        self._journal = None
+        self._journal_lines = 0
+        self._lock = threading.Lock()
+        self.data = {"version": self.VERSION, "book": BOOK_BASENAME, "total": None, "last_ok": 0, "fragments": {}, "batches": []}
+        self.loaded = False
+        if os.path.exists(path) or os.path.exists(self.journal_path):
+            try:
+                self.data.update(read_progress_file(path))
+                self.loaded = True
+            except Exception as e:
+                log_to_file(f"[PROGRESS] Не удалось прочитать {path}: {e}. Состояние будет восстановлено из логов.")
+            if self.loaded and os.path.exists(self.journal_path):
+                # Журнал прерванного запуска сворачиваем сразу
+                with self._lock:
+                    self._save()
+
+    @property
+    def last_ok(self):
+        return self.data["last_ok"]
+
+    def status(self, index):
+        entry = self.data["fragments"].get(str(index))
+        return entry["status"] if entry else None
+
+    def entry(self, index):
+        return self.data["fragments"].get(str(index)) or {}
+
+    def missing_before(self, upto):
+        """Номера 1..upto без успешного mp3 — пропуски, которые стоит озвучить заново."""
+        return [i for i in range(1, upto + 1) if self.status(i) != "ok"]
+
+    def seed_from_logs(self, log_paths):
+        """Однократный перенос прогресса из старых логов (пока файла состояния не было)."""
+        LOG_WRITER.flush()
+        ok_re = re.compile(r"part_(\d+)\.mp3 (\d+) КБ в пределах нормы")
+        skipped_re = re.compile(r"part_(\d+)\.mp3 не прошёл по размеру: (\d+) КБ")
+        txt_re = re.compile(r"Фрагмент (\d+) не озвучен")
+        fragments = {}
+        for log_path in log_paths:
+            if not os.path.exists(log_path):
+                continue
+            try:
+                with open(log_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        m = ok_re.search(line)
+                        if m:
+                            fragments[int(m.group(1))] = {"status": "ok", "size": int(m.group(2)) * 1024}
+                            continue
+                        m = skipped_re.search(line)
+                        if m and fragments.get(int(m.group(1)), {}).get("status") != "ok":
+                            fragments[int(m.group(1))] = {"status": "skipped", "size": int(m.group(2)) * 1024}
+                            continue
+                        m = txt_re.search(line)
+                        if m and fragments.get(int(m.group(1)), {}).get("status") != "ok":
+                            fragments[int(m.group(1))] = {"status": "txt"}
+            except Exception as e:
+                log_to_file(f"[PROGRESS] Ошибка чтения лога {log_path}: {e}")
+        with self._lock:
+            for index, entry in fragments.items():
+                self.data["fragments"][str(index)] = entry
+            self.data["last_ok"] = max([i for i, e in fragments.items() if e["status"] == "ok"], default=0)
+            self._save()
+        return len(fragments)
+
+    def set_splitter(self, name, max_chars):
+        with self._lock:
+            if self.data.get("splitter") != name or self.data.get("fragment_max_chars") != max_chars:
+                self.data["splitter"] = name
+                self.data["fragment_max_chars"] = max_chars
+                self._save()
+
+    def set_total(self, total):
+        with self._lock:
+            if self.data.get("total") != total:
+                self.data["total"] = total
+                self._save()
+
+    def mark(self, index, status, **fields):
+        entry = {"status": status, "updated": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"}
+        entry.update(fields)
+        self._record({"mark": index, "entry": entry})
+
+    def forget(self, indices):
+        self._record({"forget": list(indices)})
+
+    def _record(self, record):
+        with self._lock:
+            apply_progress_record(self.data, record)
+            try:
+                if self._journal is None:
+                    self._journal = open(self.journal_path, "a", encoding="utf-8")
+                self._journal.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._journal_lines += 1
+            except Exception as e:
+                log_to_file(f"[PROGRESS] Не удалось дописать {self.journal_path}: {e}")
+                self._save()
+                return
+            if self._journal_lines >= PROGRESS_JOURNAL_MAX_LINES:
+                self._save()
+
+    def compact(self):
+        """Сворачивает журнал в файл состояния (в конце запуска и после выгрузки пачки)."""
+        with self._lock:
+            if self._journal_lines or os.path.exists(self.journal_path):
+                self._save()
+
+    def mark_uploaded(self, indices, remote_name, file_id):
+        with self._lock:
+            batch_no = len(self.data["batches"]) + 1
+            self.data["batches"].append({
+                "batch": batch_no,
+                "remote_name": remote_name,
+                "fileId": file_id,
+                "first_part": min(indices) if indices else None,
+                "last_part": max(indices) if indices else None,
+                "parts": len(indices),
+                "timestamp": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
+            })
+            for index in indices:
+                entry = self.data["fragments"].get(str(index))
+                if entry is not None:
+                    entry["batch"] = batch_no
+            self._save()
+
+    def _save(self):
+        try:
+            write_json_atomic(self.path, self.data)
+        except Exception as e:
+            log_to_file(f"[PROGRESS] Не удалось сохранить {self.path}: {e}")
+            return
+        # Всё из журнала теперь в файле — журнал больше не нужен
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._journal_lines = 0
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_to_file(f"[PROGRESS] Не удалось удалить {self.journal_path}: {e}")
+
+# ------------------- Восстановление по ссылкам -------------------
+def parse_part_ranges(spec):
+    """'1-300,412' -> {1, ..., 300, 412}; пустая строка — None (без ограничения)."""
+    if not spec:
+        return None
+    parts = set()
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-", 1)
+            parts.update(range(int(first), int(last) + 1))
+        else:
+            parts.add(int(item))
+    return parts
+
+def format_part_ranges(indices):
+    """{1, 2, 3, 7} -> '1-3,7' (обратное к parse_part_ranges)."""
+    ranges = []
+    for index in sorted(indices):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+def looks_like_mp3(data):
+    return data[:3] == b"ID3" or (len(data) > 1 and data[0] == 0xFF and (data[1] & 0xE0) == 0xE0)
+
+def select_recovery_parts(ledger, progress, allowed=None):
+    """
+    Номера частей, которые можно скачать по ссылкам: есть mp3-ссылка в журнале,
+    файла нет ни в OUTPUT_MP3_DIR, ни в запечатанных пачках, и часть не выгружена на B2.
+    """
+    on_disk = set(get_part_indices_on_disk(OUTPUT_MP3_DIR))
+    for sealed_dir in glob.glob(f"{OUTPUT_MP3_DIR}_sealed_*"):
+        on_disk.update(get_part_indices_on_disk(sealed_dir))
+    selected = []
+    for part_name, entry in ledger.items():
+        m = re.match(r"part_(\d+)$", part_name)
+        if not m:
+            continue
+        index = int(m.group(1))
+        if allowed is not None and index not in allowed:
+            continue
+        if index in on_disk or progress.entry(index).get("batch"):
+            continue
+        if not entry["url"].lower().split("?")[0].endswith(".mp3"):
+            continue
+        selected.append(index)
+    return sorted(selected)
+
+def fetch_recorded_audio(session, url, expected_sha1=None, timeout=60):
+    """
+    Скачивает ранее выданное сервером аудио. Сначала HEAD: ссылка жива, это аудио и
+    размер в пределах MIN_SIZE_KB..MAX_SIZE_KB; затем GET с проверкой длины, заголовка MP3
+    и SHA-1 из файла состояния (если он записан). Возвращает (bytes, None) или (None, причина).
+    """
+    try:
+        head = session.head(url, timeout=timeout, allow_redirects=True)
+        if head.status_code == 200:
+            ctype = (head.headers.get("Content-Type") or "").lower()
+            if ctype and "audio" not in ctype and "octet-stream" not in ctype:
+                return None, f"HEAD Content-Type={ctype}"
+            length = head.headers.get("Content-Length")
+            if length and not (MIN_SIZE_KB < int(length) // 1024 < MAX_SIZE_KB):
+                return None, f"HEAD Content-Length={length}"
+        elif head.status_code != 405:
+            # 405 — сервер не поддерживает HEAD, тогда проверяем уже сам ответ GET
+            return None, f"HEAD HTTP {head.status_code}"
+        resp = session.get(url, timeout=timeout)
+        if resp.status_code != 200:
+            return None, f"GET HTTP {resp.status_code}"
+        data = resp.content
+        length = resp.headers.get("Content-Length")
+        if length and int(length) != len(data):
+            return None, f"получено {len(data)} из {length} байт"
+        if not (MIN_SIZE_KB < len(data) // 1024 < MAX_SIZE_KB):
+            return None, f"размер {len(data) // 1024} КБ"
+        if not looks_like_mp3(data):
+            return None, "не MP3"
+        if expected_sha1 and hashlib.sha1(data).hexdigest() != expected_sha1:
+            return None, "SHA-1 не совпадает с файлом состояния"
+        return data, None
+    except Exception as e:
+        return None, str(e)
+
+def recover_from_audio_urls(session, progress, output_size, allowed=None, threads=TTS_RECOVER_THREADS, on_saved=None):
+    """
+    Режим восстановления: параллельно скачивает части из AUDIO_URLS_LOG в OUTPUT_MP3_DIR
+    вместо повторного синтеза (после потерянного артефакта или неудачной выгрузки).
+    Файлы сохраняются по возрастанию номеров; после каждого вызывается on_saved()
+    (main запечатывает там пачку, если она заполнилась). Возвращает (скачано, не удалось).
+    """
+    ledger = read_audio_url_ledger()
+    indices = select_recovery_parts(ledger, progress, allowed)
+    log_to_file(f"[RECOVER] В {AUDIO_URLS_LOG} ссылок: {len(ledger)}, к скачиванию: {len(indices)} ({threads} потоков).")
+    if not indices:
+        return 0, 0
+    recovered = failed = 0
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="recover") as pool:
+        futures = [
+            (index, pool.submit(fetch_recorded_audio, session, ledger[f"part_{index:04}"]["url"], progress.entry(index).get("sha1")))
+            for index in indices
+        ]
+        for index, future in tqdm(futures, desc="Восстановление", unit="part"):
+            data, reason = future.result()
+            base_name = f"part_{index:04}"
+            if data is None:
+                failed += 1
+                log_to_file(f"[RECOVER] {base_name}: ссылка не годится ({reason}), часть остаётся для синтеза.")
+                continue
+            out_mp3 = os.path.join(OUTPUT_MP3_DIR, f"{base_name}.mp3")
+            with open(out_mp3, "wb") as f:
+                f.write(data)
+            output_size.add(len(data))
+            entry = progress.entry(index)
+            fields = {"size": len(data), "sha1": hashlib.sha1(data).hexdigest(), "source": "url"}
+            if entry.get("chars"):
+                fields["chars"] = entry["chars"]
+            progress.mark(index, "ok", **fields)
+            recovered += 1
+            if on_saved:
+                on_saved()
+    log_to_file(f"[RECOVER] Скачано {recovered}, не удалось {failed} за {time.time() - started:.1f} с.")
+    return recovered, failed
+
+
 # ------------------- Хеш/zip для B2 -------------------
-def compute_sha1_of_file(path):
-    sha1 = hashlib.sha1()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024*1024), b""):
-            sha1.update(chunk)
-    return sha1.hexdigest()
+def archive_name_for(codec):
+    return os.path.splitext(ZIP_FILE_NAME)[0] + ".tar" if codec == "tar" else ZIP_FILE_NAME
+
+def zip_compression_for(file_name, codec):
+    """MP3 уже сжат — deflate на нём тратит CPU почти без выигрыша, поэтому в режиме store аудио не сжимается."""
+    if codec == "deflate":
+        return zipfile.ZIP_DEFLATED
+    if file_name.lower().endswith(AUDIO_FILE_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def write_output_archive(fileobj, codec=ARCHIVE_CODEC, source_dir=None):
+    """Пишет содержимое OUTPUT_MP3_DIR архивом (zip или tar-поток) в fileobj — файл на диске или поток на B2."""
+    source_dir = source_dir or OUTPUT_MP3_DIR
+    entries = []
+    for root, _, files in os.walk(source_dir):
+        for f in sorted(files):
+            entries.append((os.path.join(root, f), os.path.normpath(os.path.join(os.path.relpath(root, source_dir), f))))
+    if codec == "tar":
+        with tarfile.open(fileobj=fileobj, mode="w|") as tf:
+            for path, arcname in entries:
+                tf.add(path, arcname=arcname)
+        return
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, arcname in entries:
+            zf.write(path, arcname=arcname, compress_type=zip_compression_for(arcname, codec))
 
 def zip_output_mp3(zip_name=ZIP_FILE_NAME):
-    with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as zf:
-        for root, _, files in os.walk(OUTPUT_MP3_DIR):
-            for f in files:
-                zf.write(
-                    os.path.join(root, f),
-                    arcname=os.path.join(os.path.relpath(root, OUTPUT_MP3_DIR), f)
-                )
+    # Локальный архив идёт в артефакт workflow, поэтому всегда zip
+    codec = "deflate" if ARCHIVE_CODEC == "deflate" else "store"
+    with open(zip_name, "wb") as f, METRICS.timed("zip"):
+        write_output_archive(f, codec)
     size = os.path.getsize(zip_name)
     return zip_name, size
 
 # ------------------- B2 functions -------------------
 def b2_authorize(key_id, app_key):
     resp = requests.get(
-        "https://api.backblazeb2.com/b2api/v2/b2_authorize_account",
+        B2_API_URL.rstrip("/") + "/b2api/v2/b2_authorize_account",
         auth=(key_id, app_key), timeout=30
     )
     resp.raise_for_status()
     return resp.json()
 
-def b2_get_upload_url(api_url, auth_token, bucket_id):
-    url = api_url.rstrip("/") + "/b2api/v2/b2_get_upload_url"
-    headers = {"Authorization": auth_token}
-    payload = {"bucketId": bucket_id}
-    resp = requests.post(url, headers=headers, json=payload, timeout=30)
+def b2_api_call(api_url, auth_token, method, payload):
+    url = api_url.rstrip("/") + "/b2api/v2/" + method
+    resp = requests.post(url, headers={"Authorization": auth_token}, json=payload, timeout=30)
     resp.raise_for_status()
     return resp.json()
 
-def b2_upload_file_to_bucket(upload_url, upload_auth_token, local_file_path, remote_file_name):
-    size = os.path.getsize(local_file_path)
-    sha1 = compute_sha1_of_file(local_file_path)
+def b2_get_upload_url(api_url, auth_token, bucket_id):
+    return b2_api_call(api_url, auth_token, "b2_get_upload_url", {"bucketId": bucket_id})
+
+def b2_upload_bytes(upload_url, upload_auth_token, data, remote_file_name, sha1, content_type="application/zip"):
     headers = {
         "Authorization": upload_auth_token,
         "X-Bz-File-Name": remote_file_name,
-        "Content-Type": "application/zip",
-        "Content-Length": str(size),
+        "Content-Type": content_type,
+        "Content-Length": str(len(data)),
         "X-Bz-Content-Sha1": sha1
     }
-    with open(local_file_path, "rb") as f:
-        resp = requests.post(upload_url, headers=headers, data=f, timeout=300)
+    resp = requests.post(upload_url, headers=headers, data=data, timeout=300)
     resp.raise_for_status()
     return resp.json()
 
-def upload_zip_to_b2_and_verify(zip_path, bucket_id, bucket_name, key_id, app_key):
+def b2_download_file_by_id(auth, file_id, fileobj, chunk_size=1024 * 1024):
+    """
+    Скачивает файл B2 по fileId потоком в fileobj. Длина и SHA-1 (если B2 её знает —
+    у large file её нет) сверяются с заголовками ответа. Возвращает число байт.
+    """
+    url = auth["downloadUrl"].rstrip("/") + "/b2api/v2/b2_download_file_by_id"
+    with requests.get(url, params={"fileId": file_id}, headers={"Authorization": auth["authorizationToken"]}, stream=True, timeout=300) as resp:
+        resp.raise_for_status()
+        expected_size = resp.headers.get("Content-Length")
+        expected_sha1 = resp.headers.get("X-Bz-Content-Sha1", "")
+        sha1 = hashlib.sha1()
+        size = 0
+        for chunk in resp.iter_content(chunk_size):
+            sha1.update(chunk)
+            fileobj.write(chunk)
+            size += len(chunk)
+    if expected_size and int(expected_size) != size:
+        raise RuntimeError(f"B2 download {file_id}: получено {size} из {expected_size} байт")
+    expected_sha1 = expected_sha1.replace("unverified:", "")
+    if len(expected_sha1) == 40 and expected_sha1 != sha1.hexdigest():
+        raise RuntimeError(f"B2 download {file_id}: SHA-1 не совпадает")
+    return size
+
+class B2StreamingUpload:
+    """
+    Файловый объект «только запись» для zipfile: поток архива сразу считается в SHA-1
+    и уходит на B2 без промежуточного zip на диске.
+     - Если весь архив уместился в один кусок part_size — обычный b2_upload_file.
+     - Иначе — large file API (не меньше двух кусков, как требует B2): b2_start_large_file,
+       когда набралось больше part_size байт, затем куски по мере появления
+       параллельно (b2_upload_part, до threads одновременно), в конце b2_finish_large_file.
+    В памяти одновременно не больше threads + 1 кусков.
+    """
+    def __init__(self, auth, bucket_id, remote_name, part_size, threads, content_type="application/zip"):
+        self.auth = auth
+        self.bucket_id = bucket_id
+        self.remote_name = remote_name
+        self.content_type = content_type
+        self.part_size = max(part_size, int(auth.get("absoluteMinimumPartSize", 5 * 1024 * 1024)))
+        self.threads = max(1, threads)
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self._buffer = bytearray()
+        self._file_id = None
+        self._parts = []
+        self._pool = None
+        self._slots = threading.Semaphore(self.threads + 1)
+        self._local = threading.local()
+
+    # --- интерфейс файла для zipfile ---
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        self._buffer += data
+        # Кусок отправляем, только когда за ним есть ещё данные: архив ровно в part_size
+        # должен уйти одним b2_upload_file, а не large file из одного куска
+        while len(self._buffer) > self.part_size:
+            self._emit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    # --- загрузка кусков ---
+    def _emit_part(self, data):
+        if self._file_id is None:
+            started = b2_api_call(self.auth["apiUrl"], self.auth["authorizationToken"], "b2_start_large_file", {
+                "bucketId": self.bucket_id, "fileName": self.remote_name, "contentType": self.content_type
+            })
+            self._file_id = started["fileId"]
+            self._pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="b2-part")
+        part_number = len(self._parts) + 1
+        self._slots.acquire()
+        future = self._pool.submit(self._upload_part, part_number, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _upload_part(self, part_number, data):
+        part_sha1 = hashlib.sha1(data).hexdigest()
+        last_err = None
+        for _ in range(3):
+            try:
+                if getattr(self._local, "upload", None) is None:
+                    self._local.upload = b2_api_call(self.auth["apiUrl"], self.auth["authorizationToken"], "b2_get_upload_part_url", {"fileId": self._file_id})
+                with METRICS.timed("b2.part"):
+                    resp = requests.post(self._local.upload["uploadUrl"], headers={
+                        "Authorization": self._local.upload["authorizationToken"],
+                        "X-Bz-Part-Number": str(part_number),
+                        "Content-Length": str(len(data)),
+                        "X-Bz-Content-Sha1": part_sha1
+                    }, data=data, timeout=300)
+                resp.raise_for_status()
+                return part_sha1
+            except Exception as e:
+                # URL загрузки мог «протухнуть» — на следующей попытке берём новый
+                last_err = e
+                self._local.upload = None
+        raise RuntimeError(f"B2 part {part_number} upload failed: {last_err}")
+
+    def finish(self):
+        """Дозагружает остаток и возвращает ответ B2 о файле."""
+        if self._file_id is None:
+            upload_info = b2_get_upload_url(self.auth["apiUrl"], self.auth["authorizationToken"], self.bucket_id)
+            return b2_upload_bytes(upload_info["uploadUrl"], upload_info["authorizationToken"], bytes(self._buffer), self.remote_name, self.sha1.hexdigest(), self.content_type)
+        if self._buffer:
+            self._emit_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            part_sha1s = [f.result() for f in self._parts]
+        finally:
+            self._pool.shutdown(wait=True)
+        return b2_api_call(self.auth["apiUrl"], self.auth["authorizationToken"], "b2_finish_large_file", {
+            "fileId": self._file_id, "partSha1Array": part_sha1s
+        })
+
+    def abort(self):
+        if self._pool is not None:
+            for f in self._parts:
+                f.cancel()
+            self._pool.shutdown(wait=True)
+        if self._file_id is not None:
+            try:
+                b2_api_call(self.auth["apiUrl"], self.auth["authorizationToken"], "b2_cancel_large_file", {"fileId": self._file_id})
+            except Exception:
+                pass
+
+def stream_output_to_b2(remote_name, bucket_id, key_id, app_key, source_dir=None):
+    """
+    Один проход по файлам source_dir (по умолчанию OUTPUT_MP3_DIR): архив собирается
+    прямо в B2StreamingUpload, SHA-1 считается на лету. Возвращает сведения для маркера.
+    """
     auth = b2_authorize(key_id, app_key)
-    upload_info = b2_get_upload_url(auth["apiUrl"], auth["authorizationToken"], bucket_id)
-    remote_name = f"{BOOK_BASENAME}/{os.path.basename(zip_path)}"
-    result = b2_upload_file_to_bucket(
-        upload_info["uploadUrl"],
-        upload_info["authorizationToken"],
-        zip_path,
-        remote_name
-    )
+    content_type = "application/x-tar" if ARCHIVE_CODEC == "tar" else "application/zip"
+    sink = B2StreamingUpload(auth, bucket_id, remote_name, B2_PART_SIZE_MB * 1024 * 1024, B2_UPLOAD_THREADS, content_type)
+    try:
+        # Архив, SHA-1 и загрузка идут одним потоком — этап upload включает всё
+        with METRICS.timed("upload"):
+            write_output_archive(sink, ARCHIVE_CODEC, source_dir=source_dir)
+            result = sink.finish()
+    except Exception:
+        sink.abort()
+        raise
+    METRICS.add_bytes("uploaded", sink.size)
     remote_size = int(result.get("contentLength", 0))
-    local_size = os.path.getsize(zip_path)
-    if local_size != remote_size:
-        raise RuntimeError(f"B2 verification failed: local {local_size} != remote {remote_size}")
+    if sink.size != remote_size:
+        raise RuntimeError(f"B2 verification failed: local {sink.size} != remote {remote_size}")
     return {
         "fileId": result.get("fileId"),
         "remote_name": remote_name,
-        "local_size": local_size,
-        "remote_size": remote_size
+        "local_size": sink.size,
+        "remote_size": remote_size,
+        "sha1": sink.sha1.hexdigest()
     }
 
+def b2_credentials():
+    """(key_id, app_key, bucket_id) из окружения или None, если B2 не настроен."""
+    key_id = os.environ.get("B2_KEY_ID")
+    app_key = os.environ.get("B2_APP_KEY")
+    bucket_id = os.environ.get("B2_BUCKET_ID")
+    if not all([key_id, app_key, bucket_id]):
+        return None
+    return key_id, app_key, bucket_id
+
+def upload_output_batch(progress, source_dir, final=False):
+    """
+    Выгружает содержимое source_dir на B2 (потоковый архив), пишет маркер B2_MARKER_FILE
+    и отмечает части в файле состояния. Возвращает True при успехе.
+    """
+    highest_part = get_highest_part_index_on_disk(source_dir)
+    archived_parts = get_part_indices_on_disk(source_dir)
+    mp3_mb = sum(os.path.getsize(p) for p in glob.glob(os.path.join(source_dir, "*.mp3"))) / (1024 * 1024)
+
+    try:
+        credentials = b2_credentials()
+        if credentials is None:
+            raise RuntimeError("B2 credentials or bucket id not set in environment variables.")
+        key_id, app_key, bucket_id = credentials
+        archive_name = archive_name_for(ARCHIVE_CODEC)
+        upload_result = stream_output_to_b2(f"{BOOK_BASENAME}/{archive_name}", bucket_id, key_id, app_key, source_dir=source_dir)
+        log_to_file(f"Архив {archive_name} ({ARCHIVE_CODEC}, {upload_result['local_size']} байт, сумма mp3: {mp3_mb:.2f} МБ) выгружен на B2 потоком, sha1={upload_result['sha1']}.")
+    except Exception as e:
+        log_to_file(f"Ошибка при {'финальной ' if final else ''}заливке на B2: {e}")
+        return False
+
+    # --- маркер для workflow с детальной информацией ---
+    marker = {
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "zip": archive_name,
+        "local_size": upload_result["local_size"],
+        "remote_size": upload_result["remote_size"],
+        "remote_name": upload_result["remote_name"],
+        "fileId": upload_result["fileId"],
+        "sha1": upload_result["sha1"],
+        "last_part": highest_part
+    }
+    with open(B2_MARKER_FILE, "w", encoding="utf-8") as mf:
+        json.dump(marker, mf)
+    log_to_file(f"B2: {'Финальная загрузка успешна' if final else 'Успешно загружено'} {marker['zip']} (last_part={highest_part}). Маркер {B2_MARKER_FILE} создан.")
+    progress.mark_uploaded(archived_parts, upload_result["remote_name"], upload_result["fileId"])
+    return True
+
+class BackgroundUploader:
+    """
+    Фоновая выгрузка пачек на B2, чтобы озвучка не стояла во время упаковки и загрузки.
+    main() «запечатывает» заполненную OUTPUT_MP3_DIR (переименовывает в OUTPUT_MP3_DIR_sealed_NNN)
+    и сразу продолжает писать в новую пустую папку, а поток выгрузки обрабатывает пачки по очереди.
+    Успешно выгруженная пачка удаляется; при ошибке её файлы возвращаются в OUTPUT_MP3_DIR,
+    чтобы попасть в артефакт workflow (или в следующую пачку).
+    Запечатывание и возврат файлов идут под одной блокировкой: иначе поток выгрузки мог бы
+    переносить файлы в OUTPUT_MP3_DIR в тот момент, когда main() её переименовывает.
+    """
+    def __init__(self, progress, output_size):
+        self.progress = progress
+        self.output_size = output_size
+        self.failures = 0
+        self._queue = queue.Queue()
+        self._dir_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="b2-uploader", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def pending_sealed_dirs():
+        """Запечатанные пачки, оставшиеся от прерванного запуска."""
+        return sorted(d for d in glob.glob(f"{OUTPUT_MP3_DIR}_sealed_*") if os.path.isdir(d))
+
+    def seal(self, final=False):
+        """Переименовывает OUTPUT_MP3_DIR в отдельную пачку и ставит её в очередь выгрузки."""
+        with self._dir_lock:
+            n = 1
+            while os.path.exists(f"{OUTPUT_MP3_DIR}_sealed_{n:03}"):
+                n += 1
+            sealed_dir = f"{OUTPUT_MP3_DIR}_sealed_{n:03}"
+            os.rename(OUTPUT_MP3_DIR, sealed_dir)
+            os.makedirs(OUTPUT_MP3_DIR, exist_ok=True)
+            self.output_size.reconcile()
+        log_to_file(f"[UPLOAD] Пачка запечатана в {sealed_dir} и поставлена в очередь выгрузки (в очереди: {self._queue.qsize() + 1}).")
+        self.submit(sealed_dir, final)
+        return sealed_dir
+
+    def submit(self, sealed_dir, final=False):
+        self._queue.put((sealed_dir, final))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            sealed_dir, final = item
+            try:
+                if upload_output_batch(self.progress, sealed_dir, final):
+                    shutil.rmtree(sealed_dir, ignore_errors=True)
+                    log_to_file(f"Пачка {sealed_dir} выгружена и удалена локально.")
+                else:
+                    self.failures += 1
+                    self._restore(sealed_dir)
+            except Exception as e:
+                self.failures += 1
+                log_to_file(f"[UPLOAD] Ошибка выгрузки {sealed_dir}: {e}")
+                self._restore(sealed_dir)
+
+    def _restore(self, sealed_dir):
+        """Возвращает файлы пачки в OUTPUT_MP3_DIR; ошибка не останавливает поток выгрузки."""
+        moved = 0
+        try:
+            with self._dir_lock:
+                os.makedirs(OUTPUT_MP3_DIR, exist_ok=True)
+                for name in os.listdir(sealed_dir):
+                    target = os.path.join(OUTPUT_MP3_DIR, name)
+                    shutil.move(os.path.join(sealed_dir, name), target)
+                    if name.endswith(".mp3"):
+                        self.output_size.add(os.path.getsize(target))
+                    moved += 1
+                shutil.rmtree(sealed_dir, ignore_errors=True)
+        except Exception as e:
+            # Непереносённые файлы остаются в запечатанной папке: она тоже попадает в артефакт
+            # и будет выгружена первой при следующем запуске
+            log_to_file(f"[UPLOAD] Не удалось вернуть файлы пачки {sealed_dir} ({moved} перенесено): {e}")
+            return
+        log_to_file(f"[UPLOAD] Пачка {sealed_dir} не выгружена — {moved} файлов возвращены в {OUTPUT_MP3_DIR} для артефакта.")
+
+    def close(self):
+        """Дожидается выгрузки всех пачек из очереди."""
+        pending = self._queue.qsize()
+        if pending:
+            log_to_file(f"[UPLOAD] Ожидание выгрузки: в очереди {pending} пачек.")
+        self._queue.put(None)
+        self._thread.join()
+        if self.failures:
+            print(f"Не выгружено на B2 пачек: {self.failures} — файлы оставлены для артефакта.")
+            log_to_file(f"[UPLOAD] Не выгружено на B2 пачек: {self.failures} — файлы оставлены в {OUTPUT_MP3_DIR} и {OUTPUT_MP3_DIR}_sealed_* для артефакта.")
+        return self.failures
+
 # ================== ГЛАВНАЯ ФУНКЦИЯ ==================
 def main():
+    install_log_signal_handlers()
+    # Сводка метрик пишется при любом завершении, в том числе по sys.exit и сигналу
+    atexit.register(METRICS.write)
+
     # Проверка наличия исходного файла
     if not os.path.isfile(TEXT_FILE_NAME):
         print(f"Файл {TEXT_FILE_NAME} не найден!")
@@ -609,76 +3654,56 @@ def main():
 
     # Создаем необходимые папки
     os.makedirs(OUTPUT_MP3_DIR, exist_ok=True)
-    os.makedirs(TMP_AUDIO_DIR, exist_ok=True)
-
-    # Чтение текста
-    if TEXT_FILE_NAME.lower().endswith(".fb2"):
-        text = clean_text_from_fb2(TEXT_FILE_NAME)
-    else:
-        text = read_text_file(TEXT_FILE_NAME)
-
-    session = make_freetts_session()
-    try:
-        voices = fetch_freetts_voices(session)
-        VOICES_DATA["voices"] = [v["name"] for v in voices]
-        if voices:
-            voice_list_text = ", ".join([f"{v['name']}({v['id']})" for v in voices])
-            print(f"Доступные голоса: {voice_list_text}")
-            log_to_file(f"Доступные голоса: {voice_list_text}")
-        else:
-            print("Список голосов пуст.")
-            log_to_file("Список голосов пуст.")
-            log_to_file(f"[FREETTS] env voice_id={FREETTS_VOICE_ID} fallback_voice_id={FREETTS_FALLBACK_VOICE_ID} lang_code={FREETTS_LANG_CODE} fallback_lang_code={FREETTS_FALLBACK_LANG_CODE} cookie_set={bool(FREETTS_COOKIE)} token_set={bool(FREETTS_TOKEN)}")
-    except Exception as e:
-        voices = []
-        print(f"Не удалось получить список голосов: {e}")
-        log_to_file(f"Не удалось получить список голосов: {e}")
-        log_to_file(f"[FREETTS] env voice_id={FREETTS_VOICE_ID} fallback_voice_id={FREETTS_FALLBACK_VOICE_ID} lang_code={FREETTS_LANG_CODE} fallback_lang_code={FREETTS_FALLBACK_LANG_CODE} cookie_set={bool(FREETTS_COOKIE)} token_set={bool(FREETTS_TOKEN)}")
-
-    try:
-        langs = fetch_freetts_langs(session)
-        LANGS_DATA["langs"] = [l["name"] for l in langs]
-        if langs:
-            lang_list_text = ", ".join([f"{l['name']}({l['code']})" for l in langs])
-            print(f"Доступные языки: {lang_list_text}")
-            log_to_file(f"Доступные языки: {lang_list_text}")
-        else:
-            print("Список языков пуст.")
-            log_to_file("Список языков пуст.")
-            log_to_file(f"[FREETTS] env voice_id={FREETTS_VOICE_ID} fallback_voice_id={FREETTS_FALLBACK_VOICE_ID} lang_code={FREETTS_LANG_CODE} fallback_lang_code={FREETTS_FALLBACK_LANG_CODE} cookie_set={bool(FREETTS_COOKIE)} token_set={bool(FREETTS_TOKEN)}")
-    except Exception as e:
-        langs = []
-        print(f"Не удалось получить список языков: {e}")
-        log_to_file(f"Не удалось получить список языков: {e}")
-        log_to_file(f"[FREETTS] env voice_id={FREETTS_VOICE_ID} fallback_voice_id={FREETTS_FALLBACK_VOICE_ID} lang_code={FREETTS_LANG_CODE} fallback_lang_code={FREETTS_FALLBACK_LANG_CODE} cookie_set={bool(FREETTS_COOKIE)} token_set={bool(FREETTS_TOKEN)}")
-
-    voice_id, voice_name = choose_voice_id(voices, VOICE_NAME, FREETTS_VOICE_ID)
-    if not voice_id:
-        print("Не выбран voice_id для freetts.ru")
-        log_to_file("Не выбран voice_id для freetts.ru")
-        sys.exit(1)
 
-    lang_code, lang_name = choose_lang_code(langs, LANG_NAME, FREETTS_LANG_CODE)
-    if not lang_code:
-        print("Не выбран язык для freetts.ru")
-        log_to_file("Не выбран язык для freetts.ru")
+    # Размер уже лежащих mp3 (например, после неудачной выгрузки) считаем один раз, дальше — счётчиком
+    output_size = OutputSizeTracker(OUTPUT_MP3_DIR)
+    output_size.reconcile()
+
+    # Провайдеры синтеза: каждый загружает свой каталог и выбирает голос
+    backends = []
+    warmup_started = time.monotonic()
+    for name in TTS_BACKENDS:
+        backend_class = TTS_BACKEND_CLASSES.get(name)
+        if backend_class is None:
+            log_to_file(f"[BACKEND] Неизвестный провайдер {name} (доступны: {', '.join(TTS_BACKEND_CLASSES)}) — пропускаем.")
+            continue
+        backend = backend_class()
+        if backend.prepare():
+            backends.append(backend)
+    if not backends:
+        print("Нет ни одного доступного провайдера синтеза.")
+        log_to_file(f"Нет ни одного доступного провайдера синтеза (TTS_BACKENDS={','.join(TTS_BACKENDS)}).")
         sys.exit(1)
-
-    print(f"Выбран голос: {voice_name} ({voice_id})")
-    log_to_file(f"Выбран голос: {voice_name} ({voice_id})")
-    print(f"Выбран язык: {lang_name} ({lang_code})")
-    log_to_file(f"Выбран язык: {lang_name} ({lang_code})")
-
-    # Разбиваем текст на фрагменты
-    all_chunks = split_text_fragments(text, max_length=980)
-
-    # Определяем последний обработанный фрагмент:
-    last_idx_book = get_last_processed_index_from_log(LOG_FILE)
-    last_idx_global = get_last_processed_index_from_log(GLOBAL_LOG_FILE)
-    last_idx = max(last_idx_book, last_idx_global)
+    METRICS.observe("warmup", time.monotonic() - warmup_started)
+    scheduler = BackendScheduler(backends)
+    if len(backends) > 1:
+        log_to_file(f"[BACKEND] Фрагменты распределяются между провайдерами: {', '.join(b.name for b in backends)}.")
+    # Сессия freetts нужна и для восстановления по сохранённым ссылкам
+    session = next((b.session for b in backends if b.name == FreettsBackend.name), None) or make_freetts_session()
+
+    # Определяем последний обработанный фрагмент по файлу состояния
+    # (при первом запуске после обновления он заполняется из логов).
+    progress = ProgressStore(PROGRESS_FILE)
+    atexit.register(progress.compact)
+    if not progress.loaded:
+        seeded = progress.seed_from_logs([LOG_FILE, GLOBAL_LOG_FILE])
+        log_to_file(f"[PROGRESS] Создан {PROGRESS_FILE}: перенесено {seeded} фрагментов из логов.")
+
+    # Разбиваем текст на фрагменты тем же алгоритмом, каким книга начата
+    # Текст читается и разбивается потоком по мере озвучки — первый запрос уходит, не дожидаясь разбора всей книги
+    splitter = resolve_text_splitter(progress, TEXT_FILE_NAME)
+    expected_total = progress.data.get("total") if progress.data.get("splitter") == splitter else None
+    chapters = ChapterManifest(CHAPTERS_FILE) if splitter == "chapters" else None
+    fragments = FragmentStream(iter_book_fragments(TEXT_FILE_NAME, splitter, chapters), expected_total, on_total=progress.set_total)
+    log_to_file(f"[SPLIT] Алгоритм разбивки: {splitter}, фрагментов в прошлый раз: {expected_total or 'нет данных'}.")
+    recorded_max = progress.data.get("fragment_max_chars")
+    if splitter != "legacy" and recorded_max and recorded_max != TEXT_FRAGMENT_MAX_CHARS:
+        log_to_file(f"[SPLIT] Внимание: книга начата с TEXT_FRAGMENT_MAX_CHARS={recorded_max}, сейчас {TEXT_FRAGMENT_MAX_CHARS} — номера частей сдвинутся.")
+    progress.set_splitter(splitter, 980 if splitter == "legacy" else TEXT_FRAGMENT_MAX_CHARS)
+    last_idx = progress.last_ok
     if last_idx > 0:
-        print(f"Возобновляем с фрагмента: {last_idx+1} (найдено в логах)")
-        log_to_file(f"Возобновление с фрагмента {last_idx+1} (book_log={last_idx_book}, global_log={last_idx_global})")
+        print(f"Возобновляем с фрагмента: {last_idx+1} (найдено в {PROGRESS_FILE})")
+        log_to_file(f"Возобновление с фрагмента {last_idx+1} ({PROGRESS_FILE})")
     else:
         print("Начинаем с самого начала (логов нет или нет записей).")
         log_to_file("Начало новой генерации (логов не найдено или нет успешных записей).")
@@ -689,19 +3714,78 @@ def main():
     text_saved_count = 0
     skipped_count = 0
 
-    # Основной цикл генерации аудио
-    for idx in range(last_idx, len(all_chunks)):
-        chunk = all_chunks[idx]
+    audio_cache = make_synthesis_cache()
+    if audio_cache is not None:
+        log_to_file(f"[CACHE] Кэш аудио: {audio_cache.count} записей, {audio_cache.size_bytes / (1024 * 1024):.1f} из {TTS_AUDIO_CACHE_MB:.0f} МБ, B2={TTS_AUDIO_CACHE_B2}.")
+
+    # Ответ проверяется в рабочем потоке, до записи: негодный сразу запрашивается заново
+    validator = AudioValidator(progress)
+    log_to_file(f"[VALIDATE] Проверка аудио: {'длительность и уровень' if validator.deep else 'только размер'}, ожидаемая длительность 1000 символов ~{validator.expected_duration(1000):.0f} с.")
+
+    def synthesize(idx, chunk):
+        with METRICS.timed("fragment"):
+            return synthesize_fragment(scheduler, idx, chunk, retry_attempts, retry_delay, cache=audio_cache, validator=validator)
+
+    # Выгрузка на B2 идёт в фоне; без настроек B2 пачки копятся в OUTPUT_MP3_DIR для артефакта
+    uploader = None
+    if b2_credentials() is not None:
+        uploader = BackgroundUploader(progress, output_size)
+        for sealed_dir in BackgroundUploader.pending_sealed_dirs():
+            log_to_file(f"[UPLOAD] Найдена невыгруженная пачка {sealed_dir} — ставим в очередь.")
+            uploader.submit(sealed_dir)
+
+    if TTS_RECOVER_FROM_URLS in ("1", "only"):
+        def seal_if_full():
+            if uploader is not None and output_size.total_mb >= AUDIO_SIZE_LIMIT_MB * (uploader.failures + 1):
+                uploader.seal()
+        recovered, _ = recover_from_audio_urls(session, progress, output_size, parse_part_ranges(TTS_RECOVER_PARTS), on_saved=seal_if_full)
+        print(f"Восстановлено по ссылкам: {recovered}")
+        last_idx = progress.last_ok
+
+    # Сначала пропуски до точки возобновления (по возрастанию номеров), затем — дальше по книге
+    gap_indices = []
+    if TTS_RESUME_GAPS and last_idx > 0:
+        gap_indices = [i - 1 for i in progress.missing_before(last_idx)]
+        ledger = read_audio_url_ledger()
+        with_url = sum(1 for i in gap_indices if f"part_{i+1:04}" in ledger)
+        print(f"Пропусков до фрагмента {last_idx+1}: {len(gap_indices)}")
+        log_to_file(f"[GAPS] Пропусков до фрагмента {last_idx+1}: {len(gap_indices)} (из них со ссылкой в {AUDIO_URLS_LOG}: {with_url}). Озвучиваем их в первую очередь.")
+    # Пропуски идут раньше точки возобновления, поэтому один проход по потоку фрагментов отдаёт их первыми
+    gap_set = set(gap_indices)
+    work_items = ((idx, chunk) for idx, chunk in fragments if idx in gap_set or idx >= last_idx)
+    if TTS_RECOVER_FROM_URLS == "only":
+        log_to_file("[RECOVER] Режим only: синтез не выполняется.")
+        work_items = iter(())
+    if scheduler.concurrency > 1 or scheduler.pending_jobs:
+        log_to_file(f"[POOL] Параллельная генерация: {scheduler.concurrency} запросов одновременно, до {scheduler.pending_jobs} фрагментов сверх них ждут готовности на сервере.")
+
+    # Фрагменты, сохранённые текстом после последнего успешного (нужны, если сработает размыкатель)
+    unvoiced_since_success = []
+    breaker_state = {}
+    results = stop_on_open_circuit(iter_synthesis_results(work_items, synthesize, scheduler.concurrency, scheduler.pending_jobs), breaker_state)
+    # WAV конвертируется в MP3 параллельно с синтезом следующих фрагментов
+    results = iter_transcoded_results(results)
+
+    # Основной цикл: результаты приходят по порядку номеров, здесь они сохраняются и учитываются
+    for idx, chunk, audio_content, content_type in results:
         base_name = f"part_{idx+1:04}"
-        tmp_wav = os.path.join(TMP_AUDIO_DIR, f"{base_name}.wav")
         out_mp3 = os.path.join(OUTPUT_MP3_DIR, f"{base_name}.mp3")
         out_txt = os.path.join(OUTPUT_MP3_DIR, f"{base_name}.txt")
 
-        print(f"Генерация {base_name}: {len(chunk)} символов.")
-        if idx > last_idx and FREETTS_REQUEST_DELAY > 0:
-            log_to_file(f"[DELAY] {FREETTS_REQUEST_DELAY} секунд перед запросом")
-            time.sleep(FREETTS_REQUEST_DELAY)
-        audio_content, content_type = generate_audio_with_retries(session, chunk, voice_id, voice_name, lang_code, lang_name, base_name, max_attempts=retry_attempts, delay=retry_delay)
+        if audio_content is None and (content_type or "").startswith("transcode-error:"):
+            METRICS.count("fragments.transcode_error")
+            log_to_file(f"Ошибка конвертации wav->mp3 для {base_name}: {content_type[len('transcode-error:'):]}")
+            continue
+
+        if audio_content is None and (content_type or "").startswith("invalid-audio:"):
+            # Все повторы дали негодное аудио — как раньше при проверке размера: пропуск (см. TTS_RESUME_GAPS)
+            reason = content_type[len("invalid-audio:"):]
+            log_to_file(f"Файл {out_mp3} не прошёл проверку: {reason}. Не сохранён.")
+            print(f"{base_name}: аудио не прошло проверку ({reason})")
+            skipped_count += 1
+            METRICS.count("fragments.skipped")
+            progress.mark(idx + 1, "skipped", reason=reason, chars=len(chunk))
+            continue
 
         if audio_content is None:
             # ничего не получилось — сохраняем текст фрагмента в OUTPUT_MP3_DIR с именем part_XXXX.txt
@@ -711,7 +3795,10 @@ def main():
                 log_to_file(f"Фрагмент {idx+1} не озвучен — сохранён как текст {out_txt}. Продолжаем.")
                 print(f"{base_name}: сохранён текст (аудио не получено)")
                 text_saved_count += 1
-                progress_line = f"Прогресс: {idx+1}/{len(all_chunks)} mp3={success_count} txt={text_saved_count} пропуск={skipped_count}"
+                METRICS.count("fragments.txt")
+                unvoiced_since_success.append((idx + 1, out_txt))
+                progress.mark(idx + 1, "txt", chars=len(chunk))
+                progress_line = f"Прогресс: {idx+1}/{fragments.total_label} mp3={success_count} txt={text_saved_count} пропуск={skipped_count}"
                 print(progress_line)
                 log_to_file(progress_line)
             except Exception as e:
@@ -719,26 +3806,24 @@ def main():
             continue
 
         # Сохранение и конвертация в зависимости от Content-Type
+        ctype = content_type.lower() if content_type else ""
+        # WAV сюда не доходит — его уже перекодировал iter_transcoded_results. Итоговый MP3
+        # проверяем до записи: у WAV размер и кадры не проверялись (в том числе при TTS_VALIDATE_AUDIO=0)
+        scan = None
+        if "mpeg" in ctype or "mp3" in ctype:
+            reason, scan = validator.check_mp3(audio_content)
+            if reason:
+                log_to_file(f"Файл {out_mp3} не прошёл проверку: {reason}. Не сохранён.")
+                print(f"{base_name}: аудио не прошло проверку ({reason})")
+                skipped_count += 1
+                METRICS.count("fragments.skipped")
+                METRICS.count("validate.rejected")
+                progress.mark(idx + 1, "skipped", reason=reason, chars=len(chunk))
+                continue
         try:
-            ctype = content_type.lower() if content_type else ""
-            if "wav" in ctype:
-                with open(tmp_wav, "wb") as f:
-                    f.write(audio_content)
-                # Конвертация WAV -> MP3
-                try:
-                    from pydub import AudioSegment
-                    audio = AudioSegment.from_wav(tmp_wav)
-                    if SAMPLE_RATE_HZ:
-                        audio = audio.set_frame_rate(SAMPLE_RATE_HZ)
-                    audio.export(out_mp3, format="mp3", bitrate=MP3_BITRATE)
-                except Exception as e:
-                    log_to_file(f"Ошибка конвертации wav->mp3 для {base_name}: {e}")
-                    if os.path.exists(tmp_wav):
-                        os.remove(tmp_wav)
-                    continue
-            elif "mpeg" in ctype or "mp3" in ctype or "audio/mpeg" in ctype:
+            if "mpeg" in ctype or "mp3" in ctype or "audio/mpeg" in ctype:
                 # API вернул mp3 — сохраняем сразу
-                with open(out_mp3, "wb") as f:
+                with open(out_mp3, "wb") as f, METRICS.timed("save"):
                     f.write(audio_content)
             else:
                 # Неподдерживаемый тип — лог и пропуск (хотя generate_audio_with_retries должен был это отфильтровать)
@@ -748,148 +3833,87 @@ def main():
             log_to_file(f"Ошибка сохранения/конвертации для {base_name}: {e}")
             continue
 
-        # Проверка размера mp3 файла
-        try:
-            size_kb = os.path.getsize(out_mp3) // 1024
-        except Exception as e:
-            log_to_file(f"Не могу получить размер {out_mp3}: {e}")
-            continue
+        # Размер и содержимое уже проверены AudioValidator до записи; длительность — по кадрам MP3
+        mp3_size = len(audio_content)
+        size_kb = mp3_size // 1024
+        duration = (scan or scan_mp3_frames(audio_content))["duration"]
+        validator.observe(len(chunk), duration)
 
-        if not (MIN_SIZE_KB < size_kb < MAX_SIZE_KB):
-            log_to_file(f"Файл {out_mp3} не прошёл по размеру: {size_kb} КБ. Удалён.")
+        # Успешная генерация фрагмента
+        log_to_file(f"Размер файла {out_mp3} {size_kb} КБ в пределах нормы, длительность {duration:.1f} с.")
+        success_count += 1
+        unvoiced_since_success = []
+        # Если раньше фрагмент был сохранён текстом — заглушка больше не нужна
+        if os.path.exists(out_txt):
             try:
-                os.remove(out_mp3)
+                os.remove(out_txt)
             except Exception:
                 pass
-            skipped_count += 1
-            continue
-
-        # Успешная генерация фрагмента
-        log_to_file(f"Размер файла {out_mp3} {size_kb} КБ в пределах нормы.")
-        success_count += 1
+        output_size.add(mp3_size)
+        with METRICS.timed("hash"):
+            sha1 = hashlib.sha1(audio_content).hexdigest()
+        progress.mark(idx + 1, "ok", size=mp3_size, sha1=sha1, chars=len(chunk), duration=round(duration, 2))
+        METRICS.count("fragments.ok")
+        METRICS.add_bytes("saved", mp3_size)
+        if success_count == 1:
+            # Время до первого сохранённого mp3 с начала запуска (прогрев, разбор книги, первый синтез)
+            METRICS.observe("first_audio", time.time() - METRICS.started)
         print(f"{base_name}: mp3 сохранён ({size_kb} КБ)")
 
-        progress_line = f"Прогресс: {idx+1}/{len(all_chunks)} mp3={success_count} txt={text_saved_count} пропуск={skipped_count}"
+        progress_line = f"Прогресс: {idx+1}/{fragments.total_label} mp3={success_count} txt={text_saved_count} пропуск={skipped_count}"
         print(progress_line)
         log_to_file(progress_line)
 
         # ===== ПРОВЕРКА ОБЩЕГО ЛИМИТА =====
-        total_mb = get_total_size_mb(OUTPUT_MP3_DIR)
+        total_mb = output_size.total_mb
         print(f"Текущий суммарный размер папки {OUTPUT_MP3_DIR}: {total_mb:.2f} МБ (лимит {AUDIO_SIZE_LIMIT_MB} МБ).")
-        if total_mb >= AUDIO_SIZE_LIMIT_MB:
-            # --- 1) создаём zip ---
-            zip_path, zip_size = zip_output_mp3()
-            log_to_file(f"Создан архив {zip_path}, размер {zip_size} байт (сумма mp3: {total_mb:.2f} МБ).")
-            # --- вычисляем highest part, чтобы записать в маркер ---
-            highest_part = get_highest_part_index_on_disk()
-
-            # --- 2) пытаемся залить на Backblaze B2 ---
-            key_id = os.environ.get("B2_KEY_ID")
-            app_key = os.environ.get("B2_APP_KEY")
-            bucket_id = os.environ.get("B2_BUCKET_ID")
-            bucket_name = os.environ.get("B2_BUCKET_NAME", "tts-archive")
-
+        # После неудачной выгрузки следующая попытка — когда накопится ещё одна пачка.
+        # При разбивке по главам пачка закрывается на конце главы (но не позже чем +20% к лимиту).
+        limit_mb = AUDIO_SIZE_LIMIT_MB * (uploader.failures + 1) if uploader is not None else None
+        if uploader is not None and total_mb >= limit_mb and (
+                chapters is None or chapters.ends_at(idx + 1) or total_mb >= limit_mb * 1.2):
+            uploader.seal()
+
+    # ---------- РАЗМЫКАТЕЛЬ: не оставляем текстовые заглушки за серию системных ошибок ----------
+    if "error" in breaker_state:
+        for _, path in unvoiced_since_success:
             try:
-                if not all([key_id, app_key, bucket_id]):
-                    raise RuntimeError("B2 credentials or bucket id not set in environment variables.")
-                upload_result = upload_zip_to_b2_and_verify(zip_path, bucket_id, bucket_name, key_id, app_key)
-
-                # --- 3) если успешно — создаём маркер для workflow с детальной информацией ---
-                marker = {
-                    "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
-                    "zip": os.path.basename(zip_path),
-                    "local_size": upload_result["local_size"],
-                    "remote_size": upload_result["remote_size"],
-                    "remote_name": upload_result["remote_name"],
-                    "fileId": upload_result["fileId"],
-                    "last_part": highest_part
-                }
-                with open(B2_MARKER_FILE, "w", encoding="utf-8") as mf:
-                    json.dump(marker, mf)
-                log_to_file(f"B2: Успешно загружено {marker['zip']} (last_part={highest_part}). Маркер {B2_MARKER_FILE} создан.")
-
-                # --- 4) Удаляем локальный zip чтобы runner не отправил его в артефакт по ошибке ---
-                try:
-                    os.remove(zip_path)
-                    log_to_file("Локальный zip удалён после успешной загрузки на B2.")
-                except Exception:
-                    pass
-
-                # --- 5) Удаляем все mp3-файлы из OUTPUT_MP3_DIR, т.к. они уже в B2 ---
-                try:
-                    deleted_count = 0
-                    for fpath in glob.glob(os.path.join(OUTPUT_MP3_DIR, "*.mp3")):
-                        try:
-                            os.remove(fpath)
-                            deleted_count += 1
-                        except Exception:
-                            pass
-                    log_to_file(f"Удалено {deleted_count} mp3-файлов из {OUTPUT_MP3_DIR} после успешной загрузки.")
-                except Exception as e:
-                    log_to_file(f"Ошибка при удалении локальных mp3 после загрузки: {e}")
-
-            except Exception as e:
-                log_to_file(f"Ошибка при заливке на B2: {e}")
-                # в случае ошибки — оставляем mp3 и zip (zip если остался) чтобы workflow мог отправить их в артефакт
-                # (не удаляем local mp3)
-            # конец блока обработки загрузки
-
-        # Удаляем временный WAV файл
-        if os.path.exists(tmp_wav):
-            try:
-                os.remove(tmp_wav)
+                os.remove(path)
             except Exception:
                 pass
+        progress.forget([index for index, _ in unvoiced_since_success])
+        resume_from = progress.last_ok + 1
+        log_to_file(f"[BREAKER] Генерация остановлена: {breaker_state['error']}. Удалено текстовых заглушек: {len(unvoiced_since_success)}. Следующий запуск продолжит с фрагмента {resume_from}.")
+        print(f"Генерация остановлена размыкателем: {breaker_state['error']}")
 
-    # ---------- ФИНАЛ: залить остаток (если остался) ----------
+    # ---------- ФИНАЛ: залить остаток (если остался) и дождаться очереди выгрузки ----------
     remaining = glob.glob(os.path.join(OUTPUT_MP3_DIR, "*.mp3"))
     if remaining:
         log_to_file(f"По завершении цикла обнаружено {len(remaining)} mp3-файлов. Попытка финальной упаковки и загрузки в B2.")
+        if uploader is not None:
+            uploader.seal(final=True)
+    if uploader is not None:
+        uploader.close()
+    remaining = glob.glob(os.path.join(OUTPUT_MP3_DIR, "*.mp3"))
+    if remaining:
+        if uploader is None:
+            log_to_file("Ошибка при финальной заливке на B2: B2 credentials or bucket id not set in environment variables.")
         zip_path, zip_size = zip_output_mp3()
         log_to_file(f"Создан финальный архив {zip_path}, размер {zip_size} байт.")
-        highest_part = get_highest_part_index_on_disk()
-
-        key_id = os.environ.get("B2_KEY_ID")
-        app_key = os.environ.get("B2_APP_KEY")
-        bucket_id = os.environ.get("B2_BUCKET_ID")
-        bucket_name = os.environ.get("B2_BUCKET_NAME", "tts-archive")
+        log_to_file("Оставляю финальный zip/mp3 в каталоге, чтобы workflow мог экспортировать их в артефакт.")
 
-        try:
-            if not all([key_id, app_key, bucket_id]):
-                raise RuntimeError("B2 credentials or bucket id not set in environment variables.")
-            upload_result = upload_zip_to_b2_and_verify(zip_path, bucket_id, bucket_name, key_id, app_key)
-
-            marker = {
-                "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
-                "zip": os.path.basename(zip_path),
-                "local_size": upload_result["local_size"],
-                "remote_size": upload_result["remote_size"],
-                "remote_name": upload_result["remote_name"],
-                "fileId": upload_result["fileId"],
-                "last_part": highest_part
-            }
-            with open(B2_MARKER_FILE, "w", encoding="utf-8") as mf:
-                json.dump(marker, mf)
-            log_to_file(f"B2: Финальная загрузка успешна {marker['zip']} (last_part={highest_part}). Маркер {B2_MARKER_FILE} создан.")
-
-            # удаляем локальный zip и mp3
-            try:
-                os.remove(zip_path)
-            except Exception:
-                pass
-            deleted_count = 0
-            for fpath in glob.glob(os.path.join(OUTPUT_MP3_DIR, "*.mp3")):
-                try:
-                    os.remove(fpath)
-                    deleted_count += 1
-                except Exception:
-                    pass
-            log_to_file(f"Удалено {deleted_count} mp3-файлов из {OUTPUT_MP3_DIR} после финальной загрузки.")
-        except Exception as e:
-            log_to_file(f"Ошибка при финальной заливке на B2: {e}")
-            log_to_file("Оставляю финальный zip/mp3 в каталоге, чтобы workflow мог экспортировать их в артефакт.")
+    if "error" in breaker_state:
+        sys.exit(3)
 
     print("Все фрагменты обработаны.")
+    if fragments.total is not None:
+        log_to_file(f"[SPLIT] Всего фрагментов в книге: {fragments.total}.")
+    if audio_cache is not None:
+        log_to_file(f"[CACHE] Из кэша: {audio_cache.hits}, синтезировано заново: {audio_cache.misses}.")
+    if len(backends) > 1:
+        log_to_file(f"[BACKEND] Итог по провайдерам: {scheduler.summary()}.")
+    if SYNTHESIS_JOBS.polls:
+        log_to_file(f"[POLL] Опросов незавершённых заданий: {SYNTHESIS_JOBS.polls}.")
     log_to_file("Все фрагменты обработаны.")
 
 # ================== ЗАПУСК СКРИПТА ==================
@@ -900,3 +3924,6 @@ if __name__ == "__main__":
         print(f"КРИТИЧЕСКАЯ ОШИБКА: {exc}")
         log_to_file(f"КРИТИЧЕСКАЯ ОШИБКА: {exc}")
         sys.exit(1)
+    finally:
+        # До того, как интерпретатор станет ждать рабочие потоки (запрос в полёте — до его таймаута)
+        LOG_WRITER.flush()
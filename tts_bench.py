@@ -0,0 +1,358 @@
+# tts_bench.py
+# Локальные бенчмарки для tts_batch.py (к TTS API и B2 не обращаются)
+# Команды:
+# - archive: время и размер архива пачки для каждого ARCHIVE_CODEC
+# - chunker: число фрагментов и распределение их длины для алгоритмов разбивки текста
+# - pipeline: полный прогон tts_batch.py на начале каждой книги против tts_mock_server.py
+#   (синтез, проверка, сохранение, выгрузка на «B2»): фрагментов/с, МБ/с и время по этапам
+#
+# Примеры:
+#   python tts_bench.py archive                      # синтетическая пачка ~450 МБ
+#   python tts_bench.py archive --dir output_mp3     # реальная пачка
+#   python tts_bench.py chunker                      # все книги из корня репозитория
+#   python tts_bench.py pipeline --mode mix --error-rate 0.05
+#   python tts_bench.py pipeline --env TTS_BACKENDS=freetts,openai_fm --json before.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import subprocess
+import hashlib
+import glob
+import argparse
+import tempfile
+import contextlib
+
+import tts_batch
+import tts_mock_server
+
+# ================== ОБЩЕЕ ==================
+
+class CountingSink:
+    """Файловый объект «только запись»: считает байты и SHA-1, как B2StreamingUpload, но ничего не отправляет."""
+    def __init__(self):
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+def print_table(headers, rows):
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    line = "  ".join(str(h).ljust(w) for h, w in zip(headers, widths))
+    print(line)
+    print("-" * len(line))
+    for r in rows:
+        print("  ".join(str(c).ljust(w) for c, w in zip(r, widths)))
+
+# ================== ARCHIVE ==================
+
+def make_synthetic_batch(directory, total_mb, part_kb, txt_count):
+    """
+    Пачка, похожая на реальную: part_XXXX.mp3 по part_kb КБ случайных байт
+    (MP3 практически не сжимается, как и случайные данные) плюс несколько txt-заглушек.
+    """
+    os.makedirs(directory, exist_ok=True)
+    count = max(1, int(total_mb * 1024 // part_kb))
+    for i in range(1, count + 1):
+        with open(os.path.join(directory, f"part_{i:04}.mp3"), "wb") as f:
+            f.write(os.urandom(part_kb * 1024))
+    sample = "Текст фрагмента, который не удалось озвучить. " * 20
+    for i in range(count + 1, count + 1 + txt_count):
+        with open(os.path.join(directory, f"part_{i:04}.txt"), "w", encoding="utf-8") as f:
+            f.write(sample)
+    return count
+
+def bench_archive(args):
+    tmp_dir = None
+    source_dir = args.dir
+    if not source_dir:
+        tmp_dir = tempfile.mkdtemp(prefix="tts_bench_")
+        source_dir = os.path.join(tmp_dir, "output_mp3")
+        count = make_synthetic_batch(source_dir, args.total_mb, args.part_kb, args.txt)
+        print(f"Синтетическая пачка: {count} mp3 по {args.part_kb} КБ + {args.txt} txt в {source_dir}")
+    total = sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(source_dir) for f in files)
+    print(f"Исходный объём: {total / (1024 * 1024):.1f} МБ")
+
+    rows = []
+    try:
+        for codec in args.codecs:
+            best = None
+            for _ in range(args.repeat):
+                sink = CountingSink()
+                started = time.perf_counter()
+                tts_batch.write_output_archive(sink, codec, source_dir=source_dir)
+                elapsed = time.perf_counter() - started
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, sink.size)
+            elapsed, size = best
+            rows.append([
+                codec,
+                f"{elapsed:.2f}",
+                f"{size / (1024 * 1024):.1f}",
+                f"{size / total * 100:.2f}%",
+                f"{total / (1024 * 1024) / elapsed:.0f}",
+            ])
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print()
+    print_table(["codec", "время, с", "архив, МБ", "от исходного", "МБ/с"], rows)
+
+# ================== CHUNKER ==================
+
+def bundled_books():
+    return sorted(f for f in glob.glob("*.txt") + glob.glob("*.fb2") if not f.startswith("requirements"))
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def count_mid_word_cuts(text, fragments):
+    """Сколько разрезов пришлось между двумя буквами/цифрами одного слова."""
+    cuts = 0
+    pos = 0
+    for fragment in fragments:
+        found = text.find(fragment, pos)
+        if found < 0:
+            continue
+        end = found + len(fragment)
+        if 0 < end < len(text) and text[end - 1].isalnum() and text[end].isalnum():
+            cuts += 1
+        pos = end
+    return cuts
+
+def bench_chunker(args):
+    books = args.books or bundled_books()
+    if not books:
+        print("Книги не найдены.")
+        return 1
+    rows = []
+    for book in books:
+        if book.lower().endswith(".fb2"):
+            with contextlib.redirect_stdout(None):
+                text = tts_batch.clean_text_from_fb2(book)
+        else:
+            text = tts_batch.read_text_file(book)
+        for name in args.splitters:
+            chapters = name == "chapters"
+            if chapters and not book.lower().endswith(".fb2"):
+                continue
+            started = time.perf_counter()
+            if chapters:
+                # Текст глав отличается от плоского (кавычки, переводы строк) — сверка с ним не нужна
+                fragments = list(tts_batch.iter_book_fragments(book, name))
+            else:
+                with contextlib.redirect_stdout(None):
+                    fragments = tts_batch.TEXT_SPLITTERS[name](text)
+            elapsed = time.perf_counter() - started
+            lengths = sorted(len(f) for f in fragments)
+            max_length = 980 if name == "legacy" else tts_batch.TEXT_FRAGMENT_MAX_CHARS
+            mean = sum(lengths) / len(lengths) if lengths else 0
+            rows.append([
+                os.path.splitext(os.path.basename(book))[0][:28],
+                name,
+                len(fragments),
+                f"{mean:.0f}",
+                f"{mean / max_length * 100:.0f}%",
+                f"{lengths[0] if lengths else 0}/{percentile(lengths, 0.1)}/{percentile(lengths, 0.5)}/{percentile(lengths, 0.9)}/{lengths[-1] if lengths else 0}",
+                sum(1 for n in lengths if n < max_length / 2),
+                "—" if chapters else count_mid_word_cuts(text, fragments),
+                sum(1 for f in fragments[1:] if f[:1].islower()),
+                "—" if chapters else ("да" if list(tts_batch.iter_book_fragments(book, name)) == [f.strip() for f in fragments] else "НЕТ"),
+                f"{elapsed * 1000:.0f}",
+            ])
+    print_table(["книга", "алгоритм", "фрагм.", "средн.", "заполн.", "min/p10/p50/p90/max", "< 50%", "обрыв слова", "посреди фразы", "поток = целиком", "мс"], rows)
+
+# ================== PIPELINE ==================
+
+# Окружение прогона: без кэша аудио и без пауз между запросами — измеряется сам конвейер,
+# а не ожидания, рассчитанные на настоящий freetts.ru; --env может переопределить любое значение
+PIPELINE_ENV = {
+    "TTS_AUDIO_CACHE_MB": "0",
+    "TTS_AUDIO_CACHE_B2": "0",
+    "FREETTS_RATE_INITIAL": "50",
+    "FREETTS_RATE_MAX": "50",
+    "FREETTS_RATE_BURST": "8",
+    "FREETTS_POLL_DELAY_SEC": "1",
+    "RETRY_DELAY_SEC": "1",
+    "OPENAIFM_REQUEST_DELAY_SEC": "0.02",
+}
+
+def prepare_bench_book(book, directory, max_chars):
+    """
+    Кладёт в directory первые max_chars символов книги (по границе слова) как .txt
+    (0 — книга копируется целиком). Возвращает (имя файла, число символов).
+    """
+    name = os.path.splitext(os.path.basename(book))[0]
+    if max_chars <= 0:
+        shutil.copy(book, directory)
+        return os.path.basename(book), None
+    if book.lower().endswith(".fb2"):
+        with contextlib.redirect_stdout(None):
+            text = tts_batch.clean_text_from_fb2(book)
+    else:
+        text = tts_batch.read_text_file(book)
+    if len(text) > max_chars:
+        cut = text.rfind(" ", 0, max_chars)
+        text = text[:cut if cut > 0 else max_chars]
+    with open(os.path.join(directory, name + ".txt"), "w", encoding="utf-8") as f:
+        f.write(text)
+    return name + ".txt", len(text)
+
+def read_run_metrics(path):
+    """Последняя сводка из файла метрик tts_batch.py (TTS_METRICS_FILE) или None."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except (OSError, ValueError):
+        return None
+
+def run_pipeline(book, args):
+    """Один прогон tts_batch.py в отдельной папке против свежего mock-сервера. Возвращает словарь метрик."""
+    workdir = tempfile.mkdtemp(prefix="tts_bench_pipeline_")
+    result = None
+    try:
+        text_file, chars = prepare_bench_book(book, workdir, args.max_chars)
+        server, state = tts_mock_server.start_mock_server(**tts_mock_server.mock_settings(args, os.path.join(workdir, "b2")))
+        env = dict(os.environ)
+        env.update(tts_mock_server.mock_env(state))
+        env.update(PIPELINE_ENV)
+        env["TTS_TEXT_FILE"] = text_file
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_batch.py")
+        started = time.time()
+        try:
+            with open(os.path.join(workdir, "run.out"), "wb") as out:
+                code = subprocess.call([sys.executable, script], cwd=workdir, env=env, stdout=out, stderr=subprocess.STDOUT, timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            code = "timeout"
+        finished = time.time()
+        server.shutdown()
+        server.server_close()
+
+        stats = state.stats.snapshot()
+        progress = tts_batch.read_progress_file(os.path.join(workdir, os.path.splitext(text_file)[0] + "_progress.json")) or {}
+        statuses = [f.get("status") for f in (progress.get("fragments") or {}).values()]
+        audio_bytes = sum(f.get("size") or 0 for f in (progress.get("fragments") or {}).values() if f.get("status") == "ok")
+        first = stats["first_synthesis"] or finished
+        last = stats["last_synthesis"] or first
+        latencies = sorted(stats["latency"].get("synthesis", []) + stats["latency"].get("openai", []))
+        wall = finished - started
+        result = {
+            "book": os.path.splitext(os.path.basename(book))[0],
+            "chars": chars,
+            "exit": code,
+            "ok": statuses.count("ok"),
+            "txt": statuses.count("txt"),
+            "skipped": statuses.count("skipped"),
+            "audio_mb": audio_bytes / (1024 * 1024),
+            "wall_sec": wall,
+            "fragments_per_sec": statuses.count("ok") / wall if wall > 0 else 0,
+            "mb_per_sec": audio_bytes / (1024 * 1024) / wall if wall > 0 else 0,
+            # Этапы по времени первого и последнего запроса синтеза, видимым со стороны сервера:
+            # запуск (разбор книги, каталог голосов), синтез, хвост (перекодирование, сохранение, выгрузка)
+            "stage_startup_sec": max(0.0, first - started),
+            "stage_synthesis_sec": max(0.0, last - first),
+            "stage_tail_sec": max(0.0, finished - last),
+            "request_p50_sec": percentile(latencies, 0.5),
+            "request_p95_sec": percentile(latencies, 0.95),
+            "b2_uploaded_mb": (stats["bytes"].get("b2_upload_received") or 0) / (1024 * 1024),
+            "server": stats["counts"],
+            # Сводка RunMetrics самого tts_batch.py (этапы и попытки изнутри процесса)
+            "metrics": read_run_metrics(os.path.join(workdir, os.path.splitext(text_file)[0] + "_metrics.jsonl")),
+        }
+        if code != 0:
+            result["workdir"] = workdir
+        return result
+    finally:
+        # Папка неудачного прогона остаётся для разбора (в ней run.out и логи книги)
+        if not args.keep and result is not None and result["exit"] == 0:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def bench_pipeline(args):
+    books = args.books or bundled_books()
+    if not books:
+        print("Книги не найдены.")
+        return 1
+    # Без ffmpeg mock-сервер не соберёт MP3, а tts_batch.py — не перекодирует WAV: прогон только упрётся в --timeout
+    if shutil.which(tts_batch.FFMPEG_BIN) is None:
+        print(f"ffmpeg не найден (FFMPEG_BIN={tts_batch.FFMPEG_BIN}) — он нужен и mock-серверу, и tts_batch.py.")
+        return 1
+    results = []
+    for book in books:
+        print(f"Прогон: {book} ...", flush=True)
+        result = run_pipeline(book, args)
+        results.append(result)
+        if result["exit"] != 0:
+            print(f"  tts_batch.py завершился с кодом {result['exit']}, подробности: {result['workdir']}/run.out")
+    rows = [[
+        r["book"][:28],
+        f"{r['ok']}/{r['txt']}/{r['skipped']}",
+        f"{r['fragments_per_sec']:.2f}",
+        f"{r['mb_per_sec']:.2f}",
+        f"{r['wall_sec']:.1f}",
+        f"{r['stage_startup_sec']:.1f}/{r['stage_synthesis_sec']:.1f}/{r['stage_tail_sec']:.1f}",
+        f"{r['request_p50_sec']:.2f}/{r['request_p95_sec']:.2f}",
+        f"{r['b2_uploaded_mb']:.1f}",
+        r["server"].get("errors", 0) + r["server"].get("throttled", 0),
+    ] for r in results]
+    print()
+    print_table(["книга", "ok/txt/skip", "фрагм./с", "МБ/с", "всего, с", "запуск/синтез/хвост, с", "запрос p50/p95, с", "B2, МБ", "ошибки"], rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.json}")
+    return 0 if all(r["exit"] == 0 for r in results) else 1
+
+# ================== ЗАПУСК ==================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальные бенчмарки tts_batch.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("archive", help="время и размер архива пачки для разных ARCHIVE_CODEC")
+    p.add_argument("--dir", help="готовая папка с пачкой (по умолчанию — синтетическая)")
+    p.add_argument("--total-mb", type=float, default=tts_batch.AUDIO_SIZE_LIMIT_MB, help="объём синтетической пачки, МБ")
+    p.add_argument("--part-kb", type=int, default=1100, help="размер одного mp3, КБ (в логах обычно 1000–1200)")
+    p.add_argument("--txt", type=int, default=10, help="число txt-заглушек в синтетической пачке")
+    p.add_argument("--codecs", nargs="+", default=["store", "deflate", "tar"])
+    p.add_argument("--repeat", type=int, default=1, help="повторов на каждый формат (берётся лучшее время)")
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser("chunker", help="число и длина фрагментов для алгоритмов разбивки текста")
+    p.add_argument("books", nargs="*", help="файлы книг (по умолчанию — все .txt/.fb2 в текущей папке)")
+    p.add_argument("--splitters", nargs="+", default=["legacy", "sentence", "chapters"], choices=tts_batch.TEXT_SPLITTER_NAMES,
+                   help="chapters применяется только к .fb2")
+    p.set_defaults(func=bench_chunker)
+
+    p = sub.add_parser("pipeline", help="полный прогон tts_batch.py против локального mock-сервера")
+    p.add_argument("books", nargs="*", help="файлы книг (по умолчанию — все .txt/.fb2 в текущей папке)")
+    p.add_argument("--max-chars", type=int, default=30000, help="сколько символов каждой книги озвучивать (0 — всю книгу)")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменная окружения для tts_batch.py (можно повторять)")
+    p.add_argument("--timeout", type=float, default=1800, help="предел одного прогона, с")
+    p.add_argument("--json", help="сохранить метрики в JSON (для сравнения прогонов)")
+    p.add_argument("--keep", action="store_true", help="не удалять рабочие папки прогонов")
+    tts_mock_server.add_mock_arguments(p)
+    p.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
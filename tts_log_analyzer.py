@@ -0,0 +1,472 @@
+# tts_log_analyzer.py
+# Разбор накопленных логов tts_batch(<книга>).log: где уходит время и что подкрутить
+# Лог читается построчно (потоком), понимает и текущий формат (freetts.ru), и прежний времён openai.fm.
+#
+# Что считается:
+# - запуски: начало, длительность, mp3/txt/пропуски, МБ, фрагментов в час, доля пауз
+# - задержка фрагмента (от первой попытки до сохранения), время удачной и неудачной попытки
+# - распределение повторов (на какой попытке пришёл успех) и частые ошибки
+# - КБ на символ, секунд звука на символ, время по длине фрагмента, постоянные затраты на запрос
+# - пропускная способность по часам суток и по дням, пачки B2 (объём, время набора и выгрузки)
+# Число символов фрагмента берётся из <книга>_progress.json или из разбивки текста книги
+# (в старых логах — алгоритм legacy, как тогда).
+#
+# Примеры:
+#   python tts_log_analyzer.py                                  # все tts_batch(*.log) в текущей папке
+#   python tts_log_analyzer.py "tts_batch(Pinto_Sekretnye-missii-antologiya-_2_Ohotnik-za-shpionami).log"
+#   python tts_log_analyzer.py --json report.json --run-gap-min 30
+
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+import datetime
+import contextlib
+import collections
+
+import tts_batch
+from tts_bench import print_table, percentile
+
+LOG_LINE_RE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?) (.*)$")
+ATTEMPT_RE = re.compile(r"^\[RETRY\] Попытка (\d+)/(\d+) генерации аудио")
+SUCCESS_RE = re.compile(r"^\[RETRY\] Успех на попытке (\d+)")
+ATTEMPT_ERROR_RE = re.compile(r"^\[RETRY\] Попытка (\d+) (?:— ошибка|— сервер ограничивает запросы|вернула некорректный Content-Type): (.*)$")
+GAVE_UP_RE = re.compile(r"^\[RETRY\] Все (\d+) попыток завершились неудачей")
+RETRY_SLEEP_RE = re.compile(r"^\[RETRY\] Ждём ([\d.]+) секунд")
+DELAY_RE = re.compile(r"^\[DELAY\] ([\d.]+) секунд перед запросом")
+SAVED_RE = re.compile(r"^Размер файла \S*?part_(\d+)\.mp3 (\d+) КБ в пределах нормы(?:, длительность ([\d.]+) с)?")
+TXT_RE = re.compile(r"^Фрагмент (\d+) не озвучен")
+REJECTED_RE = re.compile(r"^Файл \S*?part_(\d+)\.mp3 не прошёл (?:по размеру|проверку)")
+CACHE_RE = re.compile(r"^\[CACHE\] part_(\d+) взят из кэша")
+RUN_START_RE = re.compile(r"^(?:Начало новой генерации|Возобновление с фрагмента)")
+ARCHIVE_RE = re.compile(r"^Создан (?:финальный )?архив \S+, размер (\d+) байт")
+STREAMED_RE = re.compile(r"^Архив \S+ \(\S+, (\d+) байт, сумма mp3: ([\d.]+) МБ\) выгружен на B2 потоком")
+SEALED_RE = re.compile(r"^\[UPLOAD\] Пачка запечатана")
+UPLOADED_RE = re.compile(r"^B2: (?:Финальная загрузка успешна|Успешно загружено) \S+ \(last_part=(\d+)\)")
+RATE_RE = re.compile(r"^\[RATE\] Темп снижен")
+# Признаки формата: строки, которых не было во времена openai.fm
+CURRENT_FORMAT_RE = re.compile(r"^\[(?:FREETTS|DELAY|VALIDATE|SPLIT|PROGRESS|POOL|BACKEND|POLL|METRICS)\]|длительность [\d.]+ с")
+
+# Границы длины фрагмента (символов) для таблицы «время по длине»
+LENGTH_BUCKETS = (300, 600, 800, 900, 1000)
+
+def error_key(message):
+    """Короткое имя ошибки для подсчёта: без адресов и лишних подробностей."""
+    message = message.replace("error:", "").strip()
+    message = re.sub(r" for url: \S+", "", message)
+    message = re.sub(r"HTTPSConnectionPool\(host='([^']+)'[^)]*\): ", r"\1: ", message)
+    message = re.sub(r"\(read timeout=\d+\)", "", message)
+    return message.strip()[:70]
+
+def new_run(ts):
+    return {"start": ts, "end": ts, "ok": 0, "txt": 0, "skipped": 0, "kb": 0, "sleep_sec": 0.0, "attempts": 0, "errors": 0}
+
+def analyze_log(path, run_gap_sec=3600):
+    """
+    Один проход по логу. Возвращает dict с запусками, фрагментами (part, время, статус, КБ,
+    длительность звука, задержка, номер удачной попытки), попытками, ошибками и пачками B2.
+    Задержка фрагмента — от первой попытки (или сохранения предыдущего) до сохранения;
+    в запусках с FREETTS_CONCURRENCY > 1 это интервал между сохранениями, а не время одного запроса.
+    """
+    result = {
+        "path": path, "lines": 0, "parsed": 0, "format": "openai.fm", "runs": [], "fragments": [],
+        "attempt_ok_sec": [], "attempt_failed_sec": [], "success_attempt": collections.Counter(),
+        "gave_up": 0, "errors": collections.Counter(), "delay_sec": 0.0, "retry_sleep_sec": 0.0,
+        "rate_drops": 0, "cache_hits": 0, "batches": [],
+    }
+    run = None
+    open_attempts = collections.deque()
+    mark = None
+    last_success_attempt = None
+    last_ts = None
+    batch = None
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            result["lines"] += 1
+            m = LOG_LINE_RE.match(line)
+            if not m:
+                continue
+            try:
+                ts = datetime.datetime.fromisoformat(m.group(1))
+            except ValueError:
+                continue
+            message = m.group(2).rstrip()
+            result["parsed"] += 1
+            if result["format"] != "freetts" and CURRENT_FORMAT_RE.search(message):
+                result["format"] = "freetts"
+
+            # Новый запуск: явная отметка в логе или долгий перерыв между строками
+            if run is None or RUN_START_RE.match(message) or (last_ts and (ts - last_ts).total_seconds() > run_gap_sec):
+                run = new_run(ts)
+                result["runs"].append(run)
+                open_attempts.clear()
+                mark = None
+                batch = None
+            run["end"] = last_ts = ts
+
+            m = ATTEMPT_RE.match(message)
+            if m:
+                open_attempts.append(ts)
+                run["attempts"] += 1
+                if mark is None:
+                    mark = ts
+                continue
+            m = SUCCESS_RE.match(message)
+            if m:
+                last_success_attempt = int(m.group(1))
+                result["success_attempt"][last_success_attempt] += 1
+                if open_attempts:
+                    result["attempt_ok_sec"].append((ts - open_attempts.popleft()).total_seconds())
+                continue
+            m = ATTEMPT_ERROR_RE.match(message)
+            if m:
+                result["errors"][error_key(m.group(2))] += 1
+                run["errors"] += 1
+                if open_attempts:
+                    result["attempt_failed_sec"].append((ts - open_attempts.popleft()).total_seconds())
+                continue
+            if GAVE_UP_RE.match(message):
+                result["gave_up"] += 1
+                continue
+            m = RETRY_SLEEP_RE.match(message) or DELAY_RE.match(message)
+            if m:
+                seconds = float(m.group(1))
+                result["retry_sleep_sec" if message.startswith("[RETRY]") else "delay_sec"] += seconds
+                run["sleep_sec"] += seconds
+                continue
+            if CACHE_RE.match(message):
+                result["cache_hits"] += 1
+                continue
+            if RATE_RE.match(message):
+                result["rate_drops"] += 1
+                continue
+
+            m = SAVED_RE.match(message)
+            status = "ok" if m else None
+            if not m:
+                m = TXT_RE.match(message)
+                status = "txt" if m else None
+            if not m:
+                m = REJECTED_RE.match(message)
+                status = "skipped" if m else None
+            if m:
+                kb = int(m.group(2)) if status == "ok" else 0
+                duration = float(m.group(3)) if status == "ok" and m.group(3) else None
+                result["fragments"].append({
+                    "part": int(m.group(1)), "ts": ts, "status": status, "kb": kb, "duration": duration,
+                    "latency": (ts - mark).total_seconds() if mark else None,
+                    "attempt": last_success_attempt if status == "ok" else None,
+                })
+                run[status] += 1
+                run["kb"] += kb
+                mark = ts
+                last_success_attempt = None
+                continue
+
+            # Пачки: старый формат — архив на диске, затем загрузка; текущий — запечатывание и потоковая выгрузка
+            m = ARCHIVE_RE.match(message)
+            if m:
+                batch = {"ts": ts, "bytes": int(m.group(1)), "mp3_mb": None, "pack_sec": (ts - mark).total_seconds() if mark else None}
+                continue
+            if SEALED_RE.match(message):
+                batch = {"ts": ts, "bytes": None, "mp3_mb": None, "pack_sec": None}
+                mark = None
+                continue
+            m = STREAMED_RE.match(message)
+            if m and batch is not None:
+                batch.update(bytes=int(m.group(1)), mp3_mb=float(m.group(2)))
+                continue
+            m = UPLOADED_RE.match(message)
+            if m:
+                if batch is not None:
+                    batch.update(last_part=int(m.group(1)), upload_sec=(ts - batch["ts"]).total_seconds())
+                    result["batches"].append(batch)
+                batch = None
+                # Следующий фрагмент начнётся после выгрузки — её время в его задержку не входит
+                mark = None
+    return result
+
+def read_fragment_chars(log_path, book=None, splitter=None):
+    """
+    {номер части: символов}: из <книга>_progress.json рядом с логом, а для частей, которых там нет, —
+    разбивкой книги тем же алгоритмом (из файла состояния или legacy, как в старых логах).
+    """
+    directory = os.path.dirname(log_path)
+    m = re.match(r"tts_batch\((.+)\)\.log$", os.path.basename(log_path))
+    basename = m.group(1) if m else None
+    chars = {}
+    progress = tts_batch.read_progress_file(os.path.join(directory, f"{basename}_progress.json")) if basename else None
+    if isinstance(progress, dict):
+        for part, entry in (progress.get("fragments") or {}).items():
+            if entry.get("chars"):
+                chars[int(part)] = entry["chars"]
+        splitter = splitter or progress.get("splitter")
+    if book is None and basename:
+        book = next((p for p in (os.path.join(directory, basename + ext) for ext in (".txt", ".fb2")) if os.path.isfile(p)), None)
+    if book and os.path.isfile(book):
+        splitter = splitter or "legacy"
+        with contextlib.redirect_stdout(None):
+            for idx, fragment in enumerate(tts_batch.iter_book_fragments(book, splitter), 1):
+                chars.setdefault(idx, len(fragment))
+    return chars, book, splitter
+
+def linear_fit(points):
+    """Наименьшие квадраты y = a + b*x. Возвращает (a, b) или None."""
+    n = len(points)
+    if n < 10:
+        return None
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    b = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    return mean_y - b * mean_x, b
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "—"
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} ч"
+    if seconds >= 120:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds:.1f} с"
+
+def spread(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return "—"
+    return f"{percentile(values, 0.1):.1f}/{percentile(values, 0.5):.1f}/{percentile(values, 0.9):.1f}/{percentile(values, 0.99):.1f}/{values[-1]:.1f}"
+
+def length_bucket(chars):
+    lower = 0
+    for bound in LENGTH_BUCKETS:
+        if chars < bound:
+            return f"{lower}–{bound - 1}"
+        lower = bound
+    return f"{lower}+"
+
+def build_report(stats, chars):
+    """Сводка по разобранному логу: таблицы и рекомендации (dict, пригодный для JSON)."""
+    fragments = stats["fragments"]
+    ok = [f for f in fragments if f["status"] == "ok"]
+    for f in fragments:
+        f["chars"] = chars.get(f["part"])
+    # Задержки берём только у фрагментов, озвученных по сети (не из кэша и не первых после простоя)
+    latencies = [f["latency"] for f in ok if f["latency"] is not None]
+    attempts = sum(r["attempts"] for r in stats["runs"])
+    errors = sum(r["errors"] for r in stats["runs"])
+    busy = sum((r["end"] - r["start"]).total_seconds() for r in stats["runs"])
+
+    report = {
+        "log": os.path.basename(stats["path"]),
+        "format": stats["format"],
+        "lines": stats["lines"],
+        "period": [stats["runs"][0]["start"].isoformat(), stats["runs"][-1]["end"].isoformat()] if stats["runs"] else None,
+        "fragments": {s: sum(1 for f in fragments if f["status"] == s) for s in ("ok", "txt", "skipped")},
+        "attempts": attempts,
+        "attempt_errors": errors,
+        "gave_up": stats["gave_up"],
+        "cache_hits": stats["cache_hits"],
+        "rate_drops": stats["rate_drops"],
+        "busy_sec": busy,
+        "delay_sec": stats["delay_sec"],
+        "retry_sleep_sec": stats["retry_sleep_sec"],
+        "latency_sec": sorted(latencies),
+        "attempt_ok_sec": sorted(stats["attempt_ok_sec"]),
+        "attempt_failed_sec": sorted(stats["attempt_failed_sec"]),
+        "success_attempt": dict(sorted(stats["success_attempt"].items())),
+        "errors": stats["errors"].most_common(10),
+    }
+
+    report["runs"] = [{
+        "start": r["start"].isoformat(sep=" ", timespec="minutes"),
+        "sec": (r["end"] - r["start"]).total_seconds(),
+        "ok": r["ok"], "txt": r["txt"], "skipped": r["skipped"],
+        "mb": r["kb"] / 1024,
+        "per_hour": r["ok"] / ((r["end"] - r["start"]).total_seconds() / 3600) if r["end"] > r["start"] else 0,
+        # Пауза пишется в лог до сна, поэтому последняя может выйти за конец запуска
+        "sleep_share": min(1.0, r["sleep_sec"] / (r["end"] - r["start"]).total_seconds()) if r["end"] > r["start"] else 0,
+        "error_share": r["errors"] / r["attempts"] if r["attempts"] else 0,
+    } for r in stats["runs"] if r["ok"] or r["txt"] or r["skipped"]]
+
+    with_chars = [f for f in ok if f["chars"]]
+    report["kb_per_1000_chars"] = sorted(f["kb"] / f["chars"] * 1000 for f in with_chars)
+    report["audio_sec_per_1000_chars"] = sorted(f["duration"] / f["chars"] * 1000 for f in with_chars if f["duration"])
+    buckets = collections.OrderedDict()
+    for f in sorted(with_chars, key=lambda f: f["chars"]):
+        buckets.setdefault(length_bucket(f["chars"]), []).append(f)
+    report["by_length"] = [{
+        "bucket": name,
+        "count": len(items),
+        "chars": sum(f["chars"] for f in items) / len(items),
+        "latency_p50": percentile(sorted(f["latency"] for f in items if f["latency"] is not None), 0.5),
+        "sec_per_1000": percentile(sorted(f["latency"] / f["chars"] * 1000 for f in items if f["latency"] is not None), 0.5),
+        "retried": sum(1 for f in items if (f["attempt"] or 1) > 1) / len(items),
+    } for name, items in buckets.items()]
+    report["fit"] = linear_fit([(f["chars"], f["latency"]) for f in with_chars if f["latency"] is not None and (f["attempt"] or 1) == 1])
+
+    hours = collections.defaultdict(list)
+    days = collections.defaultdict(list)
+    for f in ok:
+        hours[f["ts"].hour].append(f)
+        days[f["ts"].date().isoformat()].append(f)
+    report["by_hour"] = [{
+        "hour": hour,
+        "count": len(items),
+        "latency_p50": percentile(sorted(f["latency"] for f in items if f["latency"] is not None), 0.5),
+        "retried": sum(1 for f in items if (f["attempt"] or 1) > 1) / len(items),
+    } for hour, items in sorted(hours.items())]
+    report["by_day"] = [{"day": day, "count": len(items), "mb": sum(f["kb"] for f in items) / 1024} for day, items in sorted(days.items())]
+
+    report["batches"] = [{
+        "ts": b["ts"].isoformat(sep=" ", timespec="minutes"),
+        "mb": (b["mp3_mb"] if b["mp3_mb"] is not None else (b["bytes"] or 0) / (1024 * 1024)),
+        "last_part": b.get("last_part"),
+        "pack_sec": b["pack_sec"],
+        "upload_sec": b.get("upload_sec"),
+    } for b in stats["batches"]]
+    report["advice"] = build_advice(report)
+    return report
+
+def build_advice(report):
+    """Рекомендации по FREETTS_REQUEST_DELAY_SEC/RETRY_DELAY_SEC, длине фрагмента и объёму пачки."""
+    advice = []
+    attempts = report["attempts"]
+    if attempts:
+        error_share = report["attempt_errors"] / attempts
+        sleep_share = (report["delay_sec"] + report["retry_sleep_sec"]) / report["busy_sec"] if report["busy_sec"] else 0
+        line = f"Ошибки в {error_share * 100:.1f}% попыток, паузы (темп и повторы) — {sleep_share * 100:.0f}% времени запусков."
+        if error_share < 0.02 and sleep_share > 0.1:
+            line += " Сервер почти не отказывает: FREETTS_REQUEST_DELAY_SEC можно уменьшить (адаптивный темп сам замедлится при ошибках)."
+        elif error_share > 0.1:
+            line += " Отказов много: стоит увеличить FREETTS_REQUEST_DELAY_SEC или RETRY_DELAY_SEC."
+        else:
+            line += " Текущий темп выглядит уравновешенным."
+        advice.append(line)
+        retried = {k: v for k, v in report["success_attempt"].items() if k > 1}
+        if retried:
+            second = report["success_attempt"].get(2, 0) / sum(retried.values())
+            advice.append(f"Из повторно запрошенных фрагментов {second * 100:.0f}% получены со 2-й попытки"
+                          + (" — пауза RETRY_DELAY_SEC достаточна." if second >= 0.8 else " — пауза между повторами, вероятно, коротка."))
+    fit = report["fit"]
+    if fit:
+        overhead, per_char = fit
+        line = f"Время фрагмента ≈ {overhead:.1f} с + {per_char * 1000:.1f} с на 1000 символов (по фрагментам с первой попытки)."
+        if overhead > 0 and per_char > 0:
+            max_chars = tts_batch.TEXT_FRAGMENT_MAX_CHARS
+            line += f" Постоянные затраты — {overhead / (overhead + per_char * max_chars) * 100:.0f}% времени фрагмента в {max_chars} символов"
+            line += ": фрагменты стоит набивать до предела TEXT_FRAGMENT_MAX_CHARS." if overhead > per_char * max_chars * 0.2 else "; длина фрагмента на скорость почти не влияет."
+        elif per_char > 0:
+            line += " Постоянных затрат на запрос не видно: время растёт пропорционально длине фрагмента."
+        advice.append(line)
+    if report["by_length"]:
+        worst = max(report["by_length"], key=lambda b: b["retried"])
+        if worst["retried"] > 0.1:
+            advice.append(f"Чаще всего повторяются фрагменты длиной {worst['bucket']} символов ({worst['retried'] * 100:.0f}%).")
+    kb = report["kb_per_1000_chars"]
+    latencies = report["latency_sec"]
+    if kb and latencies:
+        mb_per_fragment = percentile(kb, 0.5) * tts_batch.TEXT_FRAGMENT_MAX_CHARS * 0.9 / 1000 / 1024
+        per_batch = tts_batch.AUDIO_SIZE_LIMIT_MB / mb_per_fragment
+        fill_sec = per_batch * percentile(latencies, 0.5)
+        line = (f"{percentile(kb, 0.5):.0f} КБ на 1000 символов: пачка {tts_batch.AUDIO_SIZE_LIMIT_MB} МБ — около {per_batch:.0f} фрагментов,"
+                f" набирается за {format_seconds(fill_sec)}.")
+        uploads = [b["upload_sec"] for b in report["batches"] if b["upload_sec"] is not None]
+        if uploads:
+            line += f" Выгрузка пачки занимает {format_seconds(percentile(sorted(uploads), 0.5))}."
+        runs = sorted(r["sec"] for r in report["runs"])
+        if runs and fill_sec > percentile(runs, 0.5):
+            line += " Типичный запуск короче: пачки выгружаются только в конце запуска, меньший AUDIO_SIZE_LIMIT_MB снизит риск потерять их при отмене."
+        advice.append(line)
+    return advice
+
+def print_report(report):
+    print(f"=== {report['log']} ===")
+    period = " — ".join(p[:16].replace("T", " ") for p in report["period"]) if report["period"] else "нет записей"
+    frag = report["fragments"]
+    print(f"Формат: {report['format']}, строк: {report['lines']}, период: {period}")
+    print(f"Фрагменты: mp3 {frag['ok']}, txt {frag['txt']}, пропущено {frag['skipped']}; попыток {report['attempts']}, "
+          f"с ошибкой {report['attempt_errors']}, сдались {report['gave_up']}; из кэша {report['cache_hits']}; снижений темпа {report['rate_drops']}")
+    print(f"Паузы: темп {format_seconds(report['delay_sec'])}, перед повторами {format_seconds(report['retry_sleep_sec'])} из {format_seconds(report['busy_sec'])} работы")
+    print()
+    print_table(["величина, с", "p10/p50/p90/p99/max", "n"], [
+        ["задержка фрагмента", spread(report["latency_sec"]), len(report["latency_sec"])],
+        ["удачная попытка", spread(report["attempt_ok_sec"]), len(report["attempt_ok_sec"])],
+        ["неудачная попытка", spread(report["attempt_failed_sec"]), len(report["attempt_failed_sec"])],
+    ])
+    if report["success_attempt"]:
+        total = sum(report["success_attempt"].values()) + report["gave_up"]
+        print()
+        print("Успех на попытке: " + ", ".join(f"{k}: {v} ({v / total * 100:.1f}%)" for k, v in report["success_attempt"].items())
+              + (f", неудача: {report['gave_up']}" if report["gave_up"] else ""))
+    if report["errors"]:
+        print()
+        print_table(["ошибка", "раз"], report["errors"])
+    if report["runs"]:
+        print()
+        print_table(["запуск", "длит.", "mp3/txt/skip", "МБ", "фрагм./ч", "паузы", "ошибки"], [[
+            r["start"], format_seconds(r["sec"]), f"{r['ok']}/{r['txt']}/{r['skipped']}", f"{r['mb']:.0f}",
+            f"{r['per_hour']:.0f}", f"{r['sleep_share'] * 100:.0f}%", f"{r['error_share'] * 100:.1f}%",
+        ] for r in report["runs"]])
+    if report["kb_per_1000_chars"]:
+        print()
+        line = f"КБ на 1000 символов: {spread(report['kb_per_1000_chars'])} (p10/p50/p90/p99/max)"
+        if report["audio_sec_per_1000_chars"]:
+            line += f"; секунд звука на 1000 символов: {spread(report['audio_sec_per_1000_chars'])}"
+        print(line)
+        print()
+        print_table(["длина", "фрагм.", "средн. симв.", "задержка p50, с", "с на 1000 симв.", "с повтором"], [[
+            b["bucket"], b["count"], f"{b['chars']:.0f}", f"{b['latency_p50']:.1f}", f"{b['sec_per_1000']:.1f}", f"{b['retried'] * 100:.0f}%",
+        ] for b in report["by_length"]])
+    if report["by_hour"]:
+        print()
+        print_table(["час", "фрагм.", "задержка p50, с", "с повтором"], [[
+            f"{h['hour']:02}", h["count"], f"{h['latency_p50']:.1f}", f"{h['retried'] * 100:.0f}%",
+        ] for h in report["by_hour"]])
+    if len(report["by_day"]) > 1:
+        print()
+        print_table(["день", "фрагм.", "МБ"], [[d["day"], d["count"], f"{d['mb']:.0f}"] for d in report["by_day"]])
+    if report["batches"]:
+        print()
+        print_table(["пачка", "МБ", "last_part", "упаковка", "выгрузка"], [[
+            b["ts"], f"{b['mb']:.0f}", b["last_part"], format_seconds(b["pack_sec"]), format_seconds(b["upload_sec"]),
+        ] for b in report["batches"]])
+    if report["advice"]:
+        print()
+        print("Рекомендации:")
+        for line in report["advice"]:
+            print(f"  - {line}")
+    print()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Разбор логов tts_batch(<книга>).log")
+    parser.add_argument("logs", nargs="*", help="файлы логов (по умолчанию — все tts_batch(*.log) в текущей папке)")
+    parser.add_argument("--book", help="текст книги для подсчёта символов (по умолчанию <книга>.txt/.fb2 рядом с логом)")
+    parser.add_argument("--splitter", choices=tts_batch.TEXT_SPLITTER_NAMES, help="алгоритм разбивки (по умолчанию из файла состояния, иначе legacy)")
+    parser.add_argument("--run-gap-min", type=float, default=60, help="перерыв в логе, после которого считается новый запуск, мин")
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    args = parser.parse_args(argv)
+
+    logs = args.logs or sorted(glob.glob("tts_batch(*.log"))
+    if not logs:
+        print("Логи не найдены.")
+        return 1
+    reports = []
+    for path in logs:
+        stats = analyze_log(path, args.run_gap_min * 60)
+        chars, book, splitter = read_fragment_chars(path, args.book if len(logs) == 1 else None, args.splitter)
+        report = build_report(stats, chars)
+        report["book"], report["splitter"] = book, splitter
+        print_report(report)
+        reports.append(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2, default=str)
+        print(f"Отчёт сохранён в {args.json}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,591 @@
+# tts_mock_server.py
+# Локальная замена freetts.ru, openai.fm и B2 для проверки tts_batch.py без сети
+# (используется бенчмарком: python tts_bench.py pipeline)
+#
+# Что умеет:
+# - freetts: главная страница с голосами/языками/токеном; POST /api/synthesis отвечает
+#   аудио сразу (audio), JSON со строкой data:audio (data), ссылкой на mp3 (url) или
+#   заданием, которое надо опрашивать (poll); mix — случайно одно из четырёх;
+#   задержка ответа, доля ответов «Ошибка 666» и HTTP 429 настраиваются
+# - openai.fm: POST /api/generate отвечает WAV
+# - B2: b2_authorize_account, обычная и large file загрузка, скачивание по fileId и по имени;
+#   SHA-1 загрузок сверяется, файлы пишутся в --b2-dir (без него — только учитываются)
+# Длительность аудио — число символов / --chars-per-sec (не меньше 2 с), звук — тон,
+# чтобы проверка аудио в tts_batch.py принимала его как речь. Для MP3 нужен ffmpeg (FFMPEG_BIN).
+#
+# Пример:
+#   python tts_mock_server.py --port 8765 --mode mix --latency 0.3 --error-rate 0.05
+#   (переменные окружения для tts_batch.py печатаются при запуске)
+
+import os
+import sys
+import io
+import re
+import json
+import math
+import time
+import wave
+import base64
+import random
+import hashlib
+import argparse
+import itertools
+import threading
+import subprocess
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import tts_batch
+
+MOCK_MODES = ("audio", "data", "url", "poll", "mix")
+MOCK_VOICES = [("VbNqRtKmLpOz", "Виталий"), ("Xk2MockVoice", "Мария")]
+MOCK_LANGS = [("ru", "Русский"), ("en", "English")]
+MOCK_TOKEN = "mock-token"
+MOCK_BUCKET = ("mock-bucket-id", "mock-bucket")
+
+# ================== АУДИО ==================
+
+class MockAudio:
+    """
+    Тон 220 Гц с медленно меняющейся громкостью нужной длительности.
+    MP3 — один раз кодируется ffmpeg без резервуара битов (каждый кадр самостоятельный)
+    и дальше собирается из готовых кадров; WAV — повтор одной секунды PCM.
+    """
+    def __init__(self, sample_rate=24000, mp3_seconds=4):
+        self.sample_rate = sample_rate
+        second = bytearray()
+        for i in range(sample_rate):
+            amplitude = 6000 + 4000 * math.sin(2 * math.pi * i / sample_rate)
+            second += int(amplitude * math.sin(2 * math.pi * 220 * i / sample_rate)).to_bytes(2, "little", signed=True)
+        self._pcm_second = bytes(second)
+        self._mp3_frames = None
+        self._mp3_frame_sec = None
+        self._mp3_error = None
+        self._mp3_seconds = mp3_seconds
+        self._lock = threading.Lock()
+
+    def _encode_frames(self):
+        pcm = self._pcm_second * self._mp3_seconds
+        proc = subprocess.run(
+            [tts_batch.FFMPEG_BIN, "-hide_banner", "-loglevel", "error",
+             "-f", "s16le", "-ar", str(self.sample_rate), "-ac", "1", "-i", "pipe:0",
+             "-c:a", "libmp3lame", "-b:a", "128k", "-reservoir", "0",
+             "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"],
+            input=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        )
+        data = proc.stdout
+        scan = tts_batch.scan_mp3_frames(data)
+        frames = []
+        for start, end in scan["spans"]:
+            pos = start
+            while pos < end:
+                length = tts_batch.parse_mp3_frame_header(data, pos)["length"]
+                frames.append(data[pos:pos + length])
+                pos += length
+        # Первые и последние кадры кодера содержат задержку и затухание — берём середину
+        frames = frames[4:-4]
+        if not frames:
+            raise RuntimeError("ffmpeg вернул пустой MP3")
+        self._mp3_frames = frames
+        self._mp3_frame_sec = scan["duration"] / scan["frames"]
+
+    def mp3(self, seconds):
+        with self._lock:
+            if self._mp3_frames is None and self._mp3_error is None:
+                try:
+                    self._encode_frames()
+                except Exception as e:
+                    self._mp3_error = f"MP3 не собрать (нужен ffmpeg, FFMPEG_BIN={tts_batch.FFMPEG_BIN}): {e}"
+                    print(f"[MOCK] {self._mp3_error}", file=sys.stderr)
+            if self._mp3_error:
+                raise RuntimeError(self._mp3_error)
+        count = max(1, int(round(seconds / self._mp3_frame_sec)))
+        return b"".join(itertools.islice(itertools.cycle(self._mp3_frames), count))
+
+    def wav(self, seconds):
+        whole, rest = divmod(int(seconds * self.sample_rate), self.sample_rate)
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.sample_rate)
+            w.writeframes(self._pcm_second * whole + self._pcm_second[:rest * 2])
+        return buf.getvalue()
+
+# ================== СОСТОЯНИЕ ==================
+
+class MockStats:
+    """Счётчики и задержки по видам запросов; started/finished — время первого и последнего запроса синтеза."""
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.bytes = collections.Counter()
+        self.latency = collections.defaultdict(list)
+        self.first_synthesis = None
+        self.last_synthesis = None
+        self._lock = threading.Lock()
+
+    def record(self, kind, seconds, sent=0, received=0):
+        with self._lock:
+            self.counts[kind] += 1
+            self.bytes[kind + "_sent"] += sent
+            self.bytes[kind + "_received"] += received
+            self.latency[kind].append(seconds)
+            if kind in ("synthesis", "openai"):
+                now = time.time()
+                self.first_synthesis = self.first_synthesis or now - seconds
+                self.last_synthesis = now
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counts": dict(self.counts),
+                "bytes": dict(self.bytes),
+                "latency": {k: list(v) for k, v in self.latency.items()},
+                "first_synthesis": self.first_synthesis,
+                "last_synthesis": self.last_synthesis,
+            }
+
+class MockState:
+    """Настройки, статистика, задания синтеза и файлы B2 одного экземпляра сервера."""
+    def __init__(self, mode="audio", latency=0.2, jitter=0.5, render_sec=2.0, error_rate=0.0,
+                 throttle_rate=0.0, chars_per_sec=14.0, b2_dir=None, b2_latency=0.0, seed=None):
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.render_sec = render_sec
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.chars_per_sec = chars_per_sec
+        self.b2_dir = b2_dir
+        self.b2_latency = b2_latency
+        self.base_url = None
+        self.audio = MockAudio()
+        self.stats = MockStats()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # id задания -> {"ready_at", "text", "ext"}; текст -> id (опрос полным запросом)
+        self.jobs = {}
+        self.jobs_by_text = {}
+        # fileId -> {"name", "size", "sha1", "path"}; large file: fileId -> {номер части: (путь или None, размер, sha1)}
+        self.b2_files = {}
+        self.b2_large = {}
+        if b2_dir:
+            os.makedirs(b2_dir, exist_ok=True)
+
+    def roll(self, rate):
+        with self.lock:
+            return rate > 0 and self.random.random() < rate
+
+    def delay(self, base):
+        if base <= 0:
+            return
+        with self.lock:
+            spread = self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(0.0, base * spread))
+
+    def pick_mode(self):
+        if self.mode != "mix":
+            return self.mode
+        with self.lock:
+            return self.random.choice(MOCK_MODES[:-1])
+
+    def duration_for(self, text):
+        return max(2.0, len(text) / self.chars_per_sec)
+
+    def new_id(self):
+        return str(next(self.ids))
+
+# ================== HTTP ==================
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "tts-mock"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send(self, code, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list, str)):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def b2_error(self, code, message):
+        return self.send(code, {"status": code, "code": "bad_request", "message": message})
+
+    # --- маршрутизация ---
+    def do_GET(self):
+        self.guarded(self.route_get)
+
+    def do_POST(self):
+        self.guarded(self.route_post)
+
+    def guarded(self, route):
+        """Ошибка обработчика (например, нет ffmpeg для MP3) — явный ответ 500, а не оборванное соединение."""
+        try:
+            route()
+        except Exception as e:
+            self.state.stats.count("internal_errors")
+            self.send(500, {"status": "error", "message": f"mock: {e}"})
+
+    def route_get(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/":
+            self.send(200, self.page().encode("utf-8"), "text/html; charset=utf-8")
+        elif url.path == "/api/synthesis":
+            self.handle_poll(query)
+        elif url.path.startswith("/audio/"):
+            self.handle_audio_file(url.path)
+        elif url.path == "/b2api/v2/b2_authorize_account":
+            self.handle_b2_authorize()
+        elif url.path == "/b2api/v2/b2_download_file_by_id":
+            self.handle_b2_download(self.state.b2_files.get(query.get("fileId")))
+        elif url.path.startswith("/file/"):
+            name = url.path.split("/", 3)[-1]
+            self.handle_b2_download(next((f for f in self.state.b2_files.values() if f["name"] == name), None))
+        else:
+            self.send(404, {"status": "error", "message": "not found"})
+
+    def route_post(self):
+        url = urlparse(self.path)
+        if url.path == "/api/synthesis":
+            self.handle_synthesis()
+        elif url.path == "/api/generate":
+            self.handle_openai()
+        elif url.path.startswith("/b2api/v2/"):
+            self.handle_b2_api(url.path.rsplit("/", 1)[-1])
+        elif url.path == "/b2_mock/upload":
+            self.handle_b2_upload()
+        elif url.path.startswith("/b2_mock/part/"):
+            self.handle_b2_part(url.path.rsplit("/", 1)[-1])
+        else:
+            self.read_body()
+            self.send(404, {"status": "error", "message": "not found"})
+
+    # --- freetts ---
+    def page(self):
+        voices = "\n".join(f'<div data-type="voice" data-id="{i}" data-name="{n}"></div>' for i, n in MOCK_VOICES)
+        langs = "\n".join(f'<div data-type="lang" data-code="{c}" data-name="{n}"></div>' for c, n in MOCK_LANGS)
+        return f'<html><body>{voices}\n{langs}\n<script>window.app = {{token: "{MOCK_TOKEN}"}};</script></body></html>'
+
+    def audio_payload(self, text, ext):
+        seconds = self.state.duration_for(text)
+        if ext == "wav":
+            return self.state.audio.wav(seconds), "audio/wav"
+        return self.state.audio.mp3(seconds), "audio/mpeg"
+
+    def handle_synthesis(self):
+        started = time.monotonic()
+        state = self.state
+        try:
+            payload = json.loads(self.read_body() or b"{}")
+        except ValueError:
+            payload = {}
+        text = payload.get("text") or ""
+        ext = payload.get("ext") or "mp3"
+        state.delay(state.latency)
+        if state.roll(state.throttle_rate):
+            state.stats.count("throttled")
+            sent = self.send(429, {"status": "error", "message": "Too Many Requests"}, headers={"Retry-After": "1"})
+        elif not text or state.roll(state.error_rate):
+            state.stats.count("errors")
+            sent = self.send(200, {"status": "error", "message": "Ошибка 666"})
+        else:
+            sent = self.answer_synthesis(text, ext, state.pick_mode())
+        state.stats.record("synthesis", time.monotonic() - started, sent=sent)
+
+    def answer_synthesis(self, text, ext, mode):
+        state = self.state
+        if mode == "audio":
+            audio, content_type = self.audio_payload(text, ext)
+            return self.send(200, audio, content_type)
+        if mode == "data":
+            audio, content_type = self.audio_payload(text, ext)
+            return self.send(200, f"data:{content_type};base64,{base64.b64encode(audio).decode('ascii')}")
+        job_id = state.new_id()
+        with state.lock:
+            state.jobs[job_id] = {"ready_at": time.monotonic() + (state.render_sec if mode == "poll" else 0), "text": text, "ext": ext}
+            state.jobs_by_text[text] = job_id
+        if mode == "url":
+            return self.send(200, {"status": "success", "url": f"/audio/{job_id}.{ext}"})
+        return self.send(200, {"status": "processing", "message": "В очереди", "job_id": job_id})
+
+    def handle_poll(self, query):
+        started = time.monotonic()
+        state = self.state
+        with state.lock:
+            job_id = query.get("job_id") or state.jobs_by_text.get(query.get("text"))
+            job = state.jobs.get(job_id)
+        if job is None:
+            # Первый запрос без POST (резервный GET) — отвечаем как на синтез
+            if query.get("text") and "job_id" not in query:
+                self.state.delay(state.latency)
+                sent = self.answer_synthesis(query["text"], query.get("ext") or "mp3", state.pick_mode())
+                state.stats.record("synthesis", time.monotonic() - started, sent=sent)
+                return
+            sent = self.send(404, {"status": "error", "message": "Задание не найдено"})
+        elif time.monotonic() < job["ready_at"]:
+            sent = self.send(200, {"status": "processing", "message": "В очереди", "job_id": job_id})
+        else:
+            sent = self.send(200, {"status": "success", "url": f"/audio/{job_id}.{job['ext']}"})
+        state.stats.record("poll", time.monotonic() - started, sent=sent)
+
+    def handle_audio_file(self, path):
+        started = time.monotonic()
+        job_id, _, _ = os.path.basename(path).partition(".")
+        with self.state.lock:
+            job = self.state.jobs.get(job_id)
+        if job is None:
+            sent = self.send(404, {"status": "error", "message": "not found"})
+        else:
+            audio, content_type = self.audio_payload(job["text"], job["ext"])
+            sent = self.send(200, audio, content_type)
+        self.state.stats.record("audio", time.monotonic() - started, sent=sent)
+
+    # --- openai.fm ---
+    def handle_openai(self):
+        started = time.monotonic()
+        state = self.state
+        body = self.read_body().decode("utf-8", "replace")
+        match = re.search(r'name="input"\r\n\r\n(.*?)\r\n--', body, re.S)
+        text = match.group(1) if match else ""
+        state.delay(state.latency)
+        if state.roll(state.throttle_rate):
+            state.stats.count("throttled")
+            sent = self.send(429, {"error": "Too Many Requests"}, headers={"Retry-After": "1"})
+        elif not text or state.roll(state.error_rate):
+            state.stats.count("errors")
+            sent = self.send(500, {"error": "Internal Server Error"})
+        else:
+            sent = self.send(200, state.audio.wav(state.duration_for(text)), "audio/wav")
+        state.stats.record("openai", time.monotonic() - started, sent=sent, received=len(body))
+
+    # --- B2 ---
+    def handle_b2_authorize(self):
+        started = time.monotonic()
+        if not (self.headers.get("Authorization") or "").startswith("Basic "):
+            return self.b2_error(401, "no credentials")
+        self.state.delay(self.state.b2_latency)
+        base = self.state.base_url
+        sent = self.send(200, {
+            "accountId": "mock-account",
+            "authorizationToken": "mock-b2-token",
+            "apiUrl": base,
+            "downloadUrl": base,
+            "recommendedPartSize": 100 * 1024 * 1024,
+            "absoluteMinimumPartSize": 5 * 1024 * 1024,
+            "allowed": {"bucketId": MOCK_BUCKET[0], "bucketName": MOCK_BUCKET[1]},
+        })
+        self.state.stats.record("b2_api", time.monotonic() - started, sent=sent)
+
+    def handle_b2_api(self, method):
+        started = time.monotonic()
+        state = self.state
+        try:
+            payload = json.loads(self.read_body() or b"{}")
+        except ValueError:
+            return self.b2_error(400, "bad json")
+        state.delay(state.b2_latency)
+        base = state.base_url
+        if method == "b2_get_upload_url":
+            answer = {"bucketId": payload.get("bucketId"), "uploadUrl": f"{base}/b2_mock/upload", "authorizationToken": "mock-upload-token"}
+        elif method == "b2_start_large_file":
+            file_id = f"large_{state.new_id()}"
+            with state.lock:
+                state.b2_large[file_id] = {"name": payload.get("fileName"), "parts": {}}
+            answer = {"fileId": file_id, "fileName": payload.get("fileName")}
+        elif method == "b2_get_upload_part_url":
+            answer = {"fileId": payload.get("fileId"), "uploadUrl": f"{base}/b2_mock/part/{payload.get('fileId')}", "authorizationToken": "mock-upload-token"}
+        elif method == "b2_finish_large_file":
+            return self.finish_large_file(payload, started)
+        elif method == "b2_cancel_large_file":
+            with state.lock:
+                large = state.b2_large.pop(payload.get("fileId"), None)
+            for path, _, _ in (large or {}).get("parts", {}).values():
+                if path:
+                    os.remove(path)
+            answer = {"fileId": payload.get("fileId")}
+        else:
+            return self.b2_error(400, f"unsupported method {method}")
+        sent = self.send(200, answer)
+        state.stats.record("b2_api", time.monotonic() - started, sent=sent)
+
+    def store_body(self, name):
+        """Читает тело запроса потоком: (путь в --b2-dir или None, размер, SHA-1)."""
+        length = int(self.headers.get("Content-Length") or 0)
+        sha1 = hashlib.sha1()
+        path = os.path.join(self.state.b2_dir, name) if self.state.b2_dir else None
+        out = open(path, "wb") if path else None
+        try:
+            remaining = length
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                sha1.update(chunk)
+                if out:
+                    out.write(chunk)
+                remaining -= len(chunk)
+        finally:
+            if out:
+                out.close()
+        return path, length - remaining, sha1.hexdigest()
+
+    def handle_b2_upload(self):
+        started = time.monotonic()
+        state = self.state
+        file_id = f"file_{state.new_id()}"
+        path, size, sha1 = self.store_body(file_id)
+        state.delay(state.b2_latency)
+        expected = self.headers.get("X-Bz-Content-Sha1", "")
+        if expected not in (sha1, "do_not_verify"):
+            return self.b2_error(400, "sha1 mismatch")
+        name = self.headers.get("X-Bz-File-Name", file_id)
+        with state.lock:
+            state.b2_files[file_id] = {"name": name, "size": size, "sha1": sha1, "path": path}
+        sent = self.send(200, {"fileId": file_id, "fileName": name, "contentLength": size, "contentSha1": sha1})
+        state.stats.record("b2_upload", time.monotonic() - started, sent=sent, received=size)
+
+    def handle_b2_part(self, file_id):
+        started = time.monotonic()
+        state = self.state
+        number = int(self.headers.get("X-Bz-Part-Number") or 0)
+        path, size, sha1 = self.store_body(f"{file_id}.part{number}")
+        state.delay(state.b2_latency)
+        if self.headers.get("X-Bz-Content-Sha1") != sha1:
+            return self.b2_error(400, "sha1 mismatch")
+        with state.lock:
+            large = state.b2_large.get(file_id)
+            if large is not None:
+                large["parts"][number] = (path, size, sha1)
+        if large is None:
+            return self.b2_error(400, "unknown fileId")
+        sent = self.send(200, {"fileId": file_id, "partNumber": number, "contentLength": size, "contentSha1": sha1})
+        state.stats.record("b2_upload", time.monotonic() - started, sent=sent, received=size)
+
+    def finish_large_file(self, payload, started):
+        state = self.state
+        file_id = payload.get("fileId")
+        with state.lock:
+            large = state.b2_large.pop(file_id, None)
+        if large is None:
+            return self.b2_error(400, "unknown fileId")
+        parts = [large["parts"].get(n + 1) for n in range(len(payload.get("partSha1Array") or []))]
+        if None in parts or [p[2] for p in parts] != payload["partSha1Array"]:
+            return self.b2_error(400, "part sha1 array mismatch")
+        path = None
+        if state.b2_dir:
+            path = os.path.join(state.b2_dir, file_id)
+            with open(path, "wb") as out:
+                for part_path, _, _ in parts:
+                    with open(part_path, "rb") as f:
+                        while True:
+                            chunk = f.read(1024 * 1024)
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                    os.remove(part_path)
+        size = sum(p[1] for p in parts)
+        with state.lock:
+            state.b2_files[file_id] = {"name": large["name"], "size": size, "sha1": "none", "path": path}
+        sent = self.send(200, {"fileId": file_id, "fileName": large["name"], "contentLength": size, "contentSha1": "none"})
+        state.stats.record("b2_api", time.monotonic() - started, sent=sent)
+
+    def handle_b2_download(self, info):
+        started = time.monotonic()
+        if info is None or not info["path"]:
+            return self.b2_error(404, "file not found")
+        with open(info["path"], "rb") as f:
+            data = f.read()
+        sent = self.send(200, data, "application/octet-stream", headers={"X-Bz-Content-Sha1": info["sha1"], "X-Bz-File-Name": info["name"]})
+        self.state.stats.record("b2_download", time.monotonic() - started, sent=sent)
+
+# ================== ЗАПУСК ==================
+
+def start_mock_server(host="127.0.0.1", port=0, **settings):
+    """Поднимает сервер в фоновом потоке. Возвращает (server, state); остановка — server.shutdown()."""
+    state = MockState(**settings)
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    state.base_url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="tts-mock", daemon=True).start()
+    return server, state
+
+def mock_env(state):
+    """Переменные окружения, направляющие tts_batch.py на этот сервер."""
+    return {
+        "FREETTS_BASE_URL": state.base_url,
+        "FREETTS_TOKEN": MOCK_TOKEN,
+        "FREETTS_VOICE_ID": MOCK_VOICES[0][0],
+        "FREETTS_LANG_CODE": MOCK_LANGS[0][0],
+        "OPENAIFM_URL": state.base_url + "/api/generate",
+        "B2_API_URL": state.base_url,
+        "B2_KEY_ID": "mock-key",
+        "B2_APP_KEY": "mock-app-key",
+        "B2_BUCKET_ID": MOCK_BUCKET[0],
+        "B2_BUCKET_NAME": MOCK_BUCKET[1],
+    }
+
+def add_mock_arguments(parser):
+    parser.add_argument("--mode", choices=MOCK_MODES, default="mix", help="как freetts отдаёт аудио (mix — случайно)")
+    parser.add_argument("--latency", type=float, default=0.2, help="задержка ответа на синтез, с")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержки (доля, равномерно ±)")
+    parser.add_argument("--render-sec", type=float, default=2.0, help="через сколько секунд готово задание в режиме poll")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов «Ошибка 666»")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов HTTP 429")
+    parser.add_argument("--chars-per-sec", type=float, default=14.0, help="темп «речи»: символов на секунду аудио")
+    parser.add_argument("--b2-latency", type=float, default=0.0, help="задержка ответов B2, с")
+    parser.add_argument("--seed", type=int, help="зерно случайных ошибок и режимов")
+
+def mock_settings(args, b2_dir=None):
+    return {
+        "mode": args.mode, "latency": args.latency, "jitter": args.jitter, "render_sec": args.render_sec,
+        "error_rate": args.error_rate, "throttle_rate": args.throttle_rate, "chars_per_sec": args.chars_per_sec,
+        "b2_latency": args.b2_latency, "seed": args.seed, "b2_dir": b2_dir,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальная замена freetts.ru, openai.fm и B2 для tts_batch.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--b2-dir", help="куда сохранять загруженные на «B2» файлы (по умолчанию не сохраняются)")
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server, state = start_mock_server(args.host, args.port, **mock_settings(args, args.b2_dir))
+    print(f"Сервер запущен: {state.base_url} (режим {args.mode}). Окружение для tts_batch.py:")
+    for name, value in mock_env(state).items():
+        print(f"  export {name}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(json.dumps(state.stats.snapshot()["counts"], ensure_ascii=False))
+
+if __name__ == "__main__":
+    sys.exit(main())